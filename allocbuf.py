@@ -23,11 +23,23 @@ or remove one; its structure is already active, live, and valid.
 
 '''
 Head of file containing tree:
-word 0 nil
+word 0 nil; its first byte holds the word width of the file, 2, 4 or 8, and its
+       second the format of this head, 'fileformat'
 word 1 max
 word 2 record
 word 3 root
-word 4... rest
+word 4... 15 bins: heads of the size-class lists, for keys 4 words to 15 words
+word 16... 23 slabs: heads of the partial slab lists, for slots of 1 word to 8 words
+word 24 slab size
+word 25 journal: offset of the metadata journal, or 0
+word 26 generation: counts committed allocator calls, wrapping
+word 27 rover: end of the last allocation, for 'next' and 'hint' placement
+word 28 directory: offset of the named roots, or 0
+word 29 pending: head of the list of frees not yet made, for 'deferred'
+word 30 pending count
+word 31 addressed: 1 if free nodes are indexed by address too, fixed at creation
+word 32 address root: root of that index
+word 33... rest
 '''
 
 '''
@@ -43,6 +55,44 @@ balance  .    ] <---- size/key # of bytes
 .        .    ]
 .        .    ]
 self     self   <---- contains address of top of node
+
+in a file created 'addressed', a free node holds a second set of links after the
+first, 'address' (a copy of its own offset), 'left', 'right', 'parent' and 'balance',
+threading it into a PAVL tree keyed by offset.  the least key is then 9 words, not 4.
+
+'used' is 0 for a node in the freetree, 1 for an allocation, and 2 for a node parked
+in a size-class bin.  a binned node is free to 'alloc' but not in the freetree, so
+its neighbors do not join it; its 'left' links the next node in the bin.  3 marks a
+slab, which is carved into slots by 'slab_alloc'.  4 marks a node freed under
+'deferred' and not yet in the freetree; its 'left' links the next such.
+'''
+
+'''
+Journal structure:
+count     entries in use
+capacity  entries that fit
+active    1 while a transaction is open
+start     first entry of the open transaction
+boot      boot of the machine that wrote the first entry since the last checkpoint
+entries   address, old value; a word each
+'''
+
+'''
+Directory structure:
+capacity  slots, a power of 2
+count     names in use
+slots     name, 16 bytes padded with NUL; offset, a word.  an empty slot's name is
+          all NUL.  open addressing on the crc32 of the name, linear probing.
+'''
+
+'''
+Slab structure, at a multiple of the slab size:
+slot      size of each slot
+nfree     slots not in use
+next      next slab with a free slot, same slot size
+prev      previous one
+bitmap    one bit per slot, set if in use; whole words
+slots...
 '''
 
 '''
@@ -51,18 +101,22 @@ size is the key used to sort on.  size is expected size in bytes
 after allocation, not size of whole node.
 '''
 
+import array
+import bisect
 import struct
-packI= struct.Struct( 'I' )
-packi= struct.Struct( 'i' )
-word= 4
-packI= struct.Struct( 'H' )
-packi= struct.Struct( 'h' )
-word= 2
+import zlib
+word= 4 #default word width of new files, in bytes
+packs= { 2: ( struct.Struct( 'H' ), struct.Struct( 'h' ) ),
+	4: ( struct.Struct( 'I' ), struct.Struct( 'i' ) ),
+	8: ( struct.Struct( 'Q' ), struct.Struct( 'q' ) ) }
+packwidth= struct.Struct( 'B' ) #width byte, readable before the width is known
+fileformat= 1 #format byte, after the width; a change to the head's layout bumps it
 
 
 class Node(object):
-	'''ctypes substitute for accessing bytes.'''
-	lookup= { 'key': 0* word, 'left': 1* word, 'right': 2* word, 'parent': 3* word, 'balance': 4* word }
+	'''ctypes substitute for accessing bytes.  'lookup' is in words; the tree supplies
+	the width.'''
+	lookup= { 'key': 0, 'left': 1, 'right': 2, 'parent': 3, 'balance': 4 }
 	class Link( object ):
 		'''adapter to substitute 'link[0]' and 'link[1]' for 'left' and 'right' '''
 		__slots__= 'where', '_tree'
@@ -112,26 +166,26 @@ class Node(object):
 	
 	def _getkey( self ): #limited to one-word integral key.  override to access.
 		return self._tree.getI(
-			self.where+ self.lookup[ 'key' ] )
+			self.where+ self.lookup[ 'key' ]* self._tree.word )
 	def _setkey( self, val ):
 		self._tree.setI(
-			self.where+ self.lookup[ 'key' ], val )
+			self.where+ self.lookup[ 'key' ]* self._tree.word, val )
 	key= property( _getkey, _setkey )
 
 	def _getleft( self ):
 		return self._tree.getI(
-			self.where+ self.lookup[ 'left' ] )
+			self.where+ self.lookup[ 'left' ]* self._tree.word )
 	def _setleft( self, val ):
 		self._tree.setI(
-			self.where+ self.lookup[ 'left' ], val )
+			self.where+ self.lookup[ 'left' ]* self._tree.word, val )
 	left= property( _getleft, _setleft )
 
 	def _getright( self ):
 		return self._tree.getI(
-			self.where+ self.lookup[ 'right' ] )
+			self.where+ self.lookup[ 'right' ]* self._tree.word )
 	def _setright( self, val ):
 		self._tree.setI(
-			self.where+ self.lookup[ 'right' ], val )
+			self.where+ self.lookup[ 'right' ]* self._tree.word, val )
 	right= property( _getright, _setright )
 
 	def _getlink( self ):
@@ -146,10 +200,10 @@ class Node(object):
 
 	def _getparent( self ):
 		return self._tree.getI(
-			self.where+ self.lookup[ 'parent' ] )
+			self.where+ self.lookup[ 'parent' ]* self._tree.word )
 	def _setparent( self, val ):
 		self._tree.setI(
-			self.where+ self.lookup[ 'parent' ], val )
+			self.where+ self.lookup[ 'parent' ]* self._tree.word, val )
 	parent= property( _getparent, _setparent )
 
 	def _getpparent( self ):
@@ -161,18 +215,18 @@ class Node(object):
 
 	def _getbalance( self ):
 		return self._tree.geti(
-			self.where+ self.lookup[ 'balance' ] )
+			self.where+ self.lookup[ 'balance' ]* self._tree.word )
 	def _setbalance( self, val ):
 		self._tree.seti(
-			self.where+ self.lookup[ 'balance' ], val )
+			self.where+ self.lookup[ 'balance' ]* self._tree.word, val )
 	balance= property( _getbalance, _setbalance )
 
 
 class AdjNode( Node ):
 	''' additional properties to access 'top' footer of buffer-prior node,
 	'used' field, buffer-next node '''
-	lookup= { 'prevkey': -1* word, 'used': 0, 'key': 1* word,
-					'left': 2* word, 'right': 3* word, 'parent': 4* word, 'balance': 5* word }
+	lookup= { 'prevkey': -1, 'used': 0, 'key': 1,
+					'left': 2, 'right': 3, 'parent': 4, 'balance': 5 }
 	__slots__= 'where', '_tree'
 
 	def _getprevkey( self ):
@@ -182,28 +236,28 @@ class AdjNode( Node ):
 
 	def _getprevwhere( self ):
 		''' previous footer address '''
-		return self.where+ self.lookup[ 'prevkey' ]
+		return self.where+ self.lookup[ 'prevkey' ]* self._tree.word
 	prevwhere= property( _getprevwhere )
 	
 	def _getused( self ):
 		''' zero for unused (has left, right, parent, balance; non-zero for used '''
 		return self._tree.getI(
-			self.where+ self.lookup[ 'used' ] )
+			self.where+ self.lookup[ 'used' ]* self._tree.word )
 	def _setused( self, val ):
 		self._tree.setI(
-			self.where+ self.lookup[ 'used' ], val )
+			self.where+ self.lookup[ 'used' ]* self._tree.word, val )
 	used= property( _getused, _setused )
 
 	def _getfoot( self ):
 		''' slight asymmetry; get returns address of foot; set sets value *at* foot '''
-		return self.where+ self.key+ 2* word
+		return self.where+ self.key+ 2* self._tree.word
 	def _setfoot( self, val ):
 		self._tree.setI( self.foot, val )
 	foot= property( _getfoot, _setfoot )
 	
 	def _getnext( self ):
 		''' next node is located at self.foot + 1* word == self.where + self.key+ 2* word+ 1* word'''
-		return self.__class__( self.foot+ 1* word, self._tree )
+		return self.__class__( self.foot+ 1* self._tree.word, self._tree )
 	next= property( _getnext )
 
 	def _getprev( self ):
@@ -211,6 +265,49 @@ class AdjNode( Node ):
 		return self.__class__( self.prevkey, self._tree )
 	prev= property( _getprev )
 
+class CachedNode( AdjNode ):
+	''' AdjNode that reads its header, 'used' to 'balance', from the tree's node cache,
+	decoded once; writes go to the tree as before, which writes them through to the
+	cached copy '''
+	__slots__= 'where', '_tree'
+
+	def _getused( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 0 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 0 ]
+	used= property( _getused, AdjNode._setused )
+	def _getkey( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 1 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 1 ]
+	key= property( _getkey, Node._setkey )
+	def _getleft( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 2 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 2 ]
+	left= property( _getleft, Node._setleft )
+	def _getright( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 3 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 3 ]
+	right= property( _getright, Node._setright )
+	def _getparent( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 4 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 4 ]
+	parent= property( _getparent, Node._setparent )
+	def _getbalance( self ):
+		try:
+			return self._tree._nodes[ self.where ][ 5 ]
+		except KeyError:
+			return self._tree._header( self.where )[ 5 ]
+	balance= property( _getbalance, Node._setbalance )
+
 class BufferTree( object ):
 	''' tree class with 'add_at' and 'remove_at' methods, and buffer header information.  see:
 			http://www.stanford.edu/~blp/avl/libavl.html/index.html#toc_AVL-Trees-with-Parent-Pointers
@@ -260,6 +357,7 @@ class BufferTree( object ):
 
 	def __init__( self, rootaddr ):
 		self._rootaddr= rootaddr
+		self.rotations= 0 #by 'add_at' and 'remove_at'; a double rotation counts 2
 
 	def __getitem__( self, where ):
 		''' magic property: create a non-buffer / heap / external Node about a particular offset into buffer '''
@@ -409,6 +507,7 @@ class BufferTree( object ):
 					y.plink[ 1 ].pparent= y
 		else:
 			return
+		self.rotations+= 1 if w== x else 2
 		if w.pparent!= Node.Null:
 			w.pparent.plink[ y!= w.pparent.plink[ 0 ] ]= w
 		else:
@@ -507,6 +606,7 @@ class BufferTree( object ):
 						if y.plink[ 1 ]!= Node.Null:
 							y.plink[ 1 ].pparent= y
 						q.plink[ dir ]= w
+						self.rotations+= 2
 					else:
 						y.plink[ 1 ]= x.plink[ 0 ]
 						x.plink[ 0 ]= y
@@ -515,6 +615,7 @@ class BufferTree( object ):
 						if y.plink[ 1 ]!= Node.Null:
 							y.plink[ 1 ].pparent= y
 						q.plink[ dir ]= x
+						self.rotations+= 1
 						if x.balance== 0:
 							x.balance= -1
 							y.balance= 1
@@ -550,6 +651,7 @@ class BufferTree( object ):
 						if y.plink[ 0 ]!= Node.Null:
 							y.plink[ 0 ].pparent= y
 						q.plink[ dir ]= w
+						self.rotations+= 2
 					else:
 						y.plink[ 0 ]= x.plink[ 1 ]
 						x.plink[ 1 ]= y
@@ -558,6 +660,7 @@ class BufferTree( object ):
 						if y.plink[ 0 ]!= Node.Null:
 							y.plink[ 0 ].pparent= y
 						q.plink[ dir ]= x
+						self.rotations+= 1
 						if x.balance== 0:
 							x.balance= 1
 							y.balance= -1
@@ -566,39 +669,531 @@ class BufferTree( object ):
 							x.balance= y.balance= 0
 							y= x
 
+class FlatBufferTree( BufferTree ):
+	''' the same PAVL 'add_at' and 'remove_at' as BufferTree, run on raw integer offsets
+	instead of Node objects.  fields are read with the tree's struct objects, bound once
+	per call, straight from 'self.map'; writes still go through 'setI' and 'seti' so
+	that subclasses observing them see every change.  keys are ordered as integers,
+	the 'compare' hook is not consulted.  the resulting buffer is byte-identical to the
+	one BufferTree produces.
+
+	mix in below AllocTree, so that its specializations still apply:
+		class FlatMmapAllocTree( MmapAllocTree, FlatBufferTree )
+	'''
+	def _getfields( self ):
+		''' byte offsets of key, left, right, parent, balance in the tree's node type '''
+		lk, word= self[ 0 ].lookup, self.word
+		return ( lk[ 'key' ]* word, lk[ 'left' ]* word, lk[ 'right' ]* word,
+			lk[ 'parent' ]* word, lk[ 'balance' ]* word )
+
+	def add_at( self, where, key ):
+		''' see BufferTree.add_at '''
+		K, L, R, P, B= self._getfields( )
+		LR= L, R
+		m, gI, gi= self.map, self.packI.unpack_from, self.packi.unpack_from
+		sI, si= self.setI, self.seti
+		rootaddr= self._rootaddr
+
+		y= p= gI( m, rootaddr )[ 0 ]
+		q= 0
+		dir= 0
+		while p:
+			dir= key>= gI( m, p+ K )[ 0 ]
+			if gi( m, p+ B )[ 0 ]!= 0:
+				y= p
+			q, p= p, gI( m, p+ LR[ dir ] )[ 0 ]
+
+		n= where
+		sI( n+ L, 0 )
+		sI( n+ R, 0 )
+		sI( n+ P, q )
+		sI( n+ K, key )
+		if q:
+			sI( q+ LR[ dir ], n )
+		else:
+			sI( rootaddr, n )
+		si( n+ B, 0 )
+		if not q:
+			return
+
+		p= n
+		while p!= y:
+			q= gI( m, p+ P )[ 0 ]
+			if gI( m, q+ L )[ 0 ]== p:
+				si( q+ B, gi( m, q+ B )[ 0 ]- 1 )
+			else:
+				si( q+ B, gi( m, q+ B )[ 0 ]+ 1 )
+			p= q
+
+		yb= gi( m, y+ B )[ 0 ]
+		if yb== -2:
+			x= gI( m, y+ L )[ 0 ]
+			if gi( m, x+ B )[ 0 ]== -1:
+				w= x
+				sI( y+ L, gI( m, x+ R )[ 0 ] )
+				sI( x+ R, y )
+				si( x+ B, 0 )
+				si( y+ B, 0 )
+				sI( x+ P, gI( m, y+ P )[ 0 ] )
+				sI( y+ P, x )
+				t= gI( m, y+ L )[ 0 ]
+				if t:
+					sI( t+ P, y )
+			else:
+				assert gi( m, x+ B )[ 0 ]== 1
+				w= gI( m, x+ R )[ 0 ]
+				sI( x+ R, gI( m, w+ L )[ 0 ] )
+				sI( w+ L, x )
+				sI( y+ L, gI( m, w+ R )[ 0 ] )
+				sI( w+ R, y )
+				wb= gi( m, w+ B )[ 0 ]
+				if wb== -1:
+					si( x+ B, 0 ); si( y+ B, 1 )
+				elif wb== 0:
+					si( x+ B, 0 ); si( y+ B, 0 )
+				else:
+					si( x+ B, -1 ); si( y+ B, 0 )
+				si( w+ B, 0 )
+				sI( w+ P, gI( m, y+ P )[ 0 ] )
+				sI( x+ P, w )
+				sI( y+ P, w )
+				t= gI( m, x+ R )[ 0 ]
+				if t:
+					sI( t+ P, x )
+				t= gI( m, y+ L )[ 0 ]
+				if t:
+					sI( t+ P, y )
+		elif yb== 2:
+			x= gI( m, y+ R )[ 0 ]
+			if gi( m, x+ B )[ 0 ]== 1:
+				w= x
+				sI( y+ R, gI( m, x+ L )[ 0 ] )
+				sI( x+ L, y )
+				si( x+ B, 0 )
+				si( y+ B, 0 )
+				sI( x+ P, gI( m, y+ P )[ 0 ] )
+				sI( y+ P, x )
+				t= gI( m, y+ R )[ 0 ]
+				if t:
+					sI( t+ P, y )
+			else:
+				assert gi( m, x+ B )[ 0 ]== -1
+				w= gI( m, x+ L )[ 0 ]
+				sI( x+ L, gI( m, w+ R )[ 0 ] )
+				sI( w+ R, x )
+				sI( y+ R, gI( m, w+ L )[ 0 ] )
+				sI( w+ L, y )
+				wb= gi( m, w+ B )[ 0 ]
+				if wb== 1:
+					si( x+ B, 0 ); si( y+ B, -1 )
+				elif wb== 0:
+					si( x+ B, 0 ); si( y+ B, 0 )
+				else:
+					si( x+ B, 1 ); si( y+ B, 0 )
+				si( w+ B, 0 )
+				sI( w+ P, gI( m, y+ P )[ 0 ] )
+				sI( x+ P, w )
+				sI( y+ P, w )
+				t= gI( m, x+ L )[ 0 ]
+				if t:
+					sI( t+ P, x )
+				t= gI( m, y+ R )[ 0 ]
+				if t:
+					sI( t+ P, y )
+		else:
+			return
+		self.rotations+= 1 if w== x else 2
+		wp= gI( m, w+ P )[ 0 ]
+		if wp:
+			sI( wp+ LR[ y!= gI( m, wp+ L )[ 0 ] ], w )
+		else:
+			sI( rootaddr, w )
+
+	def remove_at( self, where ):
+		''' see BufferTree.remove_at '''
+		K, L, R, P, B= self._getfields( )
+		LR= L, R
+		m, gI, gi= self.map, self.packI.unpack_from, self.packi.unpack_from
+		sI, si= self.setI, self.seti
+		rootaddr= self._rootaddr
+		proxy= rootaddr- L #pseudo-node whose left link is the root word
+
+		p= where
+		dir= 0
+
+		if gI( m, rootaddr )[ 0 ]== 0:
+			raise KeyError
+
+		pp= gI( m, p+ P )[ 0 ]
+		if pp and gI( m, pp+ R )[ 0 ]== p:
+			dir= 1
+
+		q= pp
+		if not q:
+			q= proxy
+			dir= 0
+
+		if gI( m, p+ R )[ 0 ]== 0:
+			t= gI( m, p+ L )[ 0 ]
+			sI( q+ LR[ dir ], t )
+			if t:
+				sI( t+ P, pp )
+		else:
+			r= gI( m, p+ R )[ 0 ]
+			if gI( m, r+ L )[ 0 ]== 0:
+				sI( r+ L, gI( m, p+ L )[ 0 ] )
+				sI( q+ LR[ dir ], r )
+				sI( r+ P, pp )
+				t= gI( m, r+ L )[ 0 ]
+				if t:
+					sI( t+ P, r )
+				si( r+ B, gi( m, p+ B )[ 0 ] )
+				q= r
+				dir= 1
+			else:
+				s= gI( m, r+ L )[ 0 ]
+				while gI( m, s+ L )[ 0 ]:
+					s= gI( m, s+ L )[ 0 ]
+				r= gI( m, s+ P )[ 0 ]
+				sI( r+ L, gI( m, s+ R )[ 0 ] )
+				sI( s+ L, gI( m, p+ L )[ 0 ] )
+				sI( s+ R, gI( m, p+ R )[ 0 ] )
+				sI( q+ LR[ dir ], s )
+				t= gI( m, s+ L )[ 0 ]
+				if t:
+					sI( t+ P, s )
+				sI( gI( m, s+ R )[ 0 ]+ P, s )
+				sI( s+ P, pp )
+				t= gI( m, r+ L )[ 0 ]
+				if t:
+					sI( t+ P, r )
+				si( s+ B, gi( m, p+ B )[ 0 ] )
+				q= r
+				dir= 0
+
+		breakflag= q== proxy
+		while not breakflag:
+			y= q
+			q= gI( m, y+ P )[ 0 ]
+			if not q:
+				breakflag= True
+				q= proxy
+
+			if dir== 0:
+				dir= gI( m, q+ L )[ 0 ]!= y
+				yb= gi( m, y+ B )[ 0 ]+ 1
+				si( y+ B, yb )
+				if yb== 1:
+					break
+				elif yb== 2:
+					x= gI( m, y+ R )[ 0 ]
+					if gi( m, x+ B )[ 0 ]== -1:
+						w= gI( m, x+ L )[ 0 ]
+						sI( x+ L, gI( m, w+ R )[ 0 ] )
+						sI( w+ R, x )
+						sI( y+ R, gI( m, w+ L )[ 0 ] )
+						sI( w+ L, y )
+						wb= gi( m, w+ B )[ 0 ]
+						if wb== 1:
+							si( x+ B, 0 ); si( y+ B, -1 )
+						elif wb== 0:
+							si( x+ B, 0 ); si( y+ B, 0 )
+						else:
+							si( x+ B, 1 ); si( y+ B, 0 )
+						si( w+ B, 0 )
+						sI( w+ P, gI( m, y+ P )[ 0 ] )
+						sI( x+ P, w )
+						sI( y+ P, w )
+						t= gI( m, x+ L )[ 0 ]
+						if t:
+							sI( t+ P, x )
+						t= gI( m, y+ R )[ 0 ]
+						if t:
+							sI( t+ P, y )
+						sI( q+ LR[ dir ], w )
+						self.rotations+= 2
+					else:
+						sI( y+ R, gI( m, x+ L )[ 0 ] )
+						sI( x+ L, y )
+						sI( x+ P, gI( m, y+ P )[ 0 ] )
+						sI( y+ P, x )
+						t= gI( m, y+ R )[ 0 ]
+						if t:
+							sI( t+ P, y )
+						sI( q+ LR[ dir ], x )
+						self.rotations+= 1
+						if gi( m, x+ B )[ 0 ]== 0:
+							si( x+ B, -1 )
+							si( y+ B, 1 )
+							break
+						else:
+							si( x+ B, 0 )
+							si( y+ B, 0 )
+			else:
+				dir= gI( m, q+ L )[ 0 ]!= y
+				yb= gi( m, y+ B )[ 0 ]- 1
+				si( y+ B, yb )
+				if yb== -1:
+					break
+				elif yb== -2:
+					x= gI( m, y+ L )[ 0 ]
+					if gi( m, x+ B )[ 0 ]== 1:
+						w= gI( m, x+ R )[ 0 ]
+						sI( x+ R, gI( m, w+ L )[ 0 ] )
+						sI( w+ L, x )
+						sI( y+ L, gI( m, w+ R )[ 0 ] )
+						sI( w+ R, y )
+						wb= gi( m, w+ B )[ 0 ]
+						if wb== -1:
+							si( x+ B, 0 ); si( y+ B, 1 )
+						elif wb== 0:
+							si( x+ B, 0 ); si( y+ B, 0 )
+						else:
+							si( x+ B, -1 ); si( y+ B, 0 )
+						si( w+ B, 0 )
+						sI( w+ P, gI( m, y+ P )[ 0 ] )
+						sI( x+ P, w )
+						sI( y+ P, w )
+						t= gI( m, x+ R )[ 0 ]
+						if t:
+							sI( t+ P, x )
+						t= gI( m, y+ L )[ 0 ]
+						if t:
+							sI( t+ P, y )
+						sI( q+ LR[ dir ], w )
+						self.rotations+= 2
+					else:
+						sI( y+ L, gI( m, x+ R )[ 0 ] )
+						sI( x+ R, y )
+						sI( x+ P, gI( m, y+ P )[ 0 ] )
+						sI( y+ P, x )
+						t= gI( m, y+ L )[ 0 ]
+						if t:
+							sI( t+ P, y )
+						sI( q+ LR[ dir ], x )
+						self.rotations+= 1
+						if gi( m, x+ B )[ 0 ]== 0:
+							si( x+ B, 1 )
+							si( y+ B, -1 )
+							break
+						else:
+							si( x+ B, 0 )
+							si( y+ B, 0 )
+
 class AllocTree( BufferTree ):
 	'''
-	'nil' is reserved and must be at address 0 with value 0.
+	'nil' is reserved at address 0: its first byte holds 'word', its second the format
+	of the head, and the rest are 0.
 	'root' is location of root of freenode tree.
 	'max' is size'
+	'word' is the width in bytes of every offset, size and link, 2, 4 or 8.  it is fixed
+	when the buffer is created and recorded in the first byte of 'nil'.
 	'record' is user-defined field for storing one address between sessions.  set and query
 	this field for an initial known location.  (you only get to remember one location.)
+	for more, 'set_root' and 'get_root' keep offsets by name, up to 16 bytes, in a
+	directory allocated from the buffer, so that several users can share a file
+	without agreeing on a layout.
 	
 	open memory starts after the header, excluding the node head there.  first 'alloc' from
 	a brand new buffer will be at 'tree size' + 'used node head size'
 
 	tree analogue to a 'free list': a 'freetree'.
 
+	set 'bins' to keep freed allocations of 4 to 15 words in exact-size lists, headed in
+	the file header, instead of the freetree.  small requests are rounded up to a whole
+	word and served from their list first.  binned nodes are given back to the freetree
+	by 'flush_bins', which 'alloc' calls before giving up or growing.
+
+	'slab_alloc' hands out slots of 1 to 8 words from slabs, nodes aligned to the slab
+	size, so that a slot costs one bit instead of three words.  the slab size is fixed
+	at the first 'slab_alloc', from 'slabsize'.
+
+	'placement' picks the free node an 'alloc' carves from: 'best' the smallest that
+	fits, 'first' the lowest addressed, 'next' the lowest at or after the end of the
+	previous allocation, wrapping around, and 'hint' the nearest to the 'hint' passed
+	to 'alloc', by default that same end.  all but 'best' visit every free node big
+	enough, except in an 'addressed' buffer, where 'first' and 'next' walk the free
+	nodes in address order from where they start and stop at the first that fits.
+	binned sizes come from their bins first whatever the policy.
+
+	an 'addressed' buffer, chosen at creation, keeps its free nodes in a second PAVL
+	tree, 'index', ordered by offset, kept by 'add_at' and 'remove_at' alongside the
+	freetree.  'alloc_within' allocates inside a range of offsets, lowest first;
+	'free_extents' lists the free space in a range, in order; 'highwater' is the end
+	of the last node in use, below which the buffer could be cut.  each finds its
+	first node in O(log n).  the price is the least key, 9 words instead of 4.
+
+	'compact' slides the used nodes down over the free ones, so that the free space is
+	one node at the end, and returns the old and new offsets as a 'Relocations'.
+	slabs stay where they are.  'fragmentation' says when it is worth it.
+
+	set 'deferred' to park freed nodes on a pending list in the file, instead of
+	joining them to their neighbors and adding them to the freetree one at a time.
+	'alloc' takes a parked node that fits without a split straight off the list;
+	the rest go to the freetree together, joined where adjacent, when 'alloc' misses
+	or 'pendingmax' are parked, or on 'flush_bins'.
+
+	'stats' reports counters kept as the tree works, and the state of the heap.
+	'timed' samples the latency of chosen methods, at no cost until it is called.
 	'''
 	nil= 0
-	sizeaddr= 1* word
-	recordaddr= 2* word
-	rootaddr= 3* word
-	mapheadsize= 4* word
+	BINNED= 2
+	SLAB= 3
+	PENDING= 4
+	nbins= 12
+	bins= False
+	deferred= False
+	pendingmax= 64
+	placement= 'best'
+	pagesize= 4096 #for 'no_cross_page'
+	addressed= False
+	namesize= 16
+	nslabs= 8
+	slabsize= 4096
 
 	class AllocException( Exception ): pass
 
+	class Relocations( object ):
+		''' the nodes 'compact' moved, in buffer order.  index with any old offset,
+		at or inside a node, for its new one; other offsets map to themselves. '''
+		def __init__( self, word ):
+			self.word= word
+			self.olds, self.news, self.sizes= array.array( 'L' ), array.array( 'L' ), array.array( 'L' )
+		def add( self, old, new, size ):
+			''' a whole node of 'size' bytes moved from 'old' to 'new' '''
+			self.olds.append( old )
+			self.news.append( new )
+			self.sizes.append( size )
+		def __len__( self ):
+			return len( self.olds )
+		def __iter__( self ):
+			''' old, new and size of each allocation moved '''
+			word= self.word
+			for old, new, size in zip( self.olds, self.news, self.sizes ):
+				yield old+ 2* word, new+ 2* word, size- 3* word
+		def __getitem__( self, offset ):
+			i= bisect.bisect_right( self.olds, offset )- 1
+			if i>= 0 and offset< self.olds[ i ]+ self.sizes[ i ]:
+				return offset+ self.news[ i ]- self.olds[ i ]
+			return offset
+		def rewrite( self, tree, wheres ):
+			''' relocate the offsets stored at 'wheres', themselves old offsets, in
+			'tree'; 0 stays 0 '''
+			for where in wheres:
+				where= self[ where ]
+				val= tree.getI( where )
+				if val:
+					tree.setI( where, self[ val ] )
+
+	class AddressIndex( FlatBufferTree ):
+		''' the 'addressed' tree: the same free nodes, keyed by their own offsets, through
+		the second set of links.  reads go to the owner's map, writes through its 'setI'
+		and 'seti', so the journal and the node cache see them. '''
+		def __init__( self, tree ):
+			FlatBufferTree.__init__( self, tree.addressrootaddr )
+			self._tree= tree
+			self.word, self.packI, self.packi= tree.word, tree.packI, tree.packi
+		def _getmap( self ):
+			return self._tree.map
+		map= property( _getmap )
+		def getI( self, offt ):
+			return self._tree.getI( offt )
+		def setI( self, offt, val ):
+			self._tree.setI( offt, val )
+		def geti( self, offt ):
+			return self._tree.geti( offt )
+		def seti( self, offt, val ):
+			self._tree.seti( offt, val )
+		def _getfields( self ):
+			word= self.word
+			return 6* word, 7* word, 8* word, 9* word, 10* word
+		def floor( self, offt ):
+			''' the last node at or before 'offt', failing that the first; 0 if none '''
+			getI, word= self.getI, self.word
+			where, best= self.root, 0
+			while where:
+				if where<= offt:
+					best, where= where, getI( where+ 8* word )
+				else:
+					where= getI( where+ 7* word )
+			return best or self.end( 0 )
+		def end( self, dir ):
+			''' the first node, or the last if 'dir'; 0 if none '''
+			getI, link= self.getI, ( 7+ dir )* self.word
+			where= self.root
+			while where and getI( where+ link ):
+				where= getI( where+ link )
+			return where
+		def after( self, where ):
+			''' the node next in address order after 'where', or 0 '''
+			getI, word= self.getI, self.word
+			right= getI( where+ 8* word )
+			if right:
+				while getI( right+ 7* word ):
+					right= getI( right+ 7* word )
+				return right
+			parent= getI( where+ 9* word )
+			while parent and getI( parent+ 8* word )== where:
+				where, parent= parent, getI( parent+ 9* word )
+			return parent
+
 	def __getitem__( self, where ):
 		return AdjNode( where, self )
 
-	def __init__( self ):
-		super( AllocTree, self ).__init__( AllocTree.rootaddr )
-
-	def _where_smallest_gte( self, size ):
-		''' custom find step prior to 'remove_at' '''
+	def __init__( self, word= word ):
+		if word not in packs:
+			raise ValueError( 'word width must be one of %s, not %r'% ( sorted( packs ), word ) )
+		self.word= word
+		self.packI, self.packi= packs[ word ]
+		self.sizeaddr= 1* word
+		self.recordaddr= 2* word
+		self.rootaddr= 3* word
+		self.binaddr= 4* word
+		self.slabaddr= ( 4+ self.nbins )* word
+		self.slabsizeaddr= ( 4+ self.nbins+ self.nslabs )* word
+		self.journaladdr= ( 5+ self.nbins+ self.nslabs )* word
+		self.generationaddr= ( 6+ self.nbins+ self.nslabs )* word
+		self.roveraddr= ( 7+ self.nbins+ self.nslabs )* word
+		self.directoryaddr= ( 8+ self.nbins+ self.nslabs )* word
+		self.pendingaddr= ( 9+ self.nbins+ self.nslabs )* word
+		self.pendingcountaddr= ( 10+ self.nbins+ self.nslabs )* word
+		self.addressedaddr= ( 11+ self.nbins+ self.nslabs )* word
+		self.addressrootaddr= ( 12+ self.nbins+ self.nslabs )* word
+		self.mapheadsize= ( 13+ self.nbins+ self.nslabs )* word
+		self.minkey= 4* word #least key of a node; see 'addressed'
+		self.packname= struct.Struct( '%i%s'% ( self.namesize// word, self.packI.format ) )
+		super( AllocTree, self ).__init__( self.rootaddr )
+		self.reallocs= dict( same= 0, shrink= 0, grow= 0, move= 0 ) #path taken by 'realloc'
+		self.counts= dict( allocs= 0, frees= 0, splits= 0, joinprev= 0, joinnext= 0, searches= 0, searchdepth= 0,
+			reuses= 0 )
+		self.sizehist= [ 0 ]* ( 8* word+ 1 ) #requests by bit length of their size
+		self.latency= { } #see 'timed'
+
+	def _where_smallest_gte( self, size, place= None ):
+		''' custom find step prior to 'remove_at'.  with a 'place', the smallest node that
+		'_fit' finds room in, looking through the nodes of at least 'size' in order. '''
 		cur= self.root
 		best, bestsize= None, None
+		self.counts[ 'searches' ]+= 1
+		if place:
+			stack= [ ]
+			while stack or cur:
+				while cur:
+					self.counts[ 'searchdepth' ]+= 1
+					if self[ cur ].key>= size:
+						stack.append( cur )
+						cur= self[ cur ].left
+					else:
+						cur= self[ cur ].right
+				if not stack:
+					break
+				cur= stack.pop( )
+				if self._fit( cur, size, place ) is not None:
+					return cur
+				cur= self[ cur ].right
+			return None
 		while cur:
+			self.counts[ 'searchdepth' ]+= 1
 			cursize= self[ cur ].key
 			if size== cursize:
 				best, bestsize= cur, cursize
@@ -610,59 +1205,848 @@ class AllocTree( BufferTree ):
 			else:
 				cur= self[ cur ].right
 		return best
-		
-	def alloc( self, size ):
-		''' remove the node, add remainder if big enough '''
+
+	def _where_all_gte( self, size ):
+		''' every free node of at least 'size', in no particular order '''
+		word= self.word
+		stack= [ self.root ] if self.root else [ ]
+		while stack:
+			where= stack.pop( )
+			right= self.getI( where+ 3* word )
+			if right:
+				stack.append( right )
+			if self.getI( where+ word )>= size:
+				yield where
+				left= self.getI( where+ 2* word )
+				if left:
+					stack.append( left )
+
+	def _fit( self, where, size, place ):
+		''' where in the free node at 'where' an allocation of 'size' can start, for
+		'place', ( align, page ): at a multiple of 'align', not across a multiple of
+		'page' if that is not 0, and either at the start of the node or far enough on
+		that the front can stand as a node.  None if nowhere. '''
+		align, page= place
+		word= self.word
+		start= where+ 2* word
+		gap= self.minkey+ 3* word
+		first= -( -start// align )* align
+		while True:
+			if start< first< start+ gap:
+				first= -( -( start+ gap )// align )* align
+			elif page and first// page!= ( first+ size- 1 )// page:
+				first= -( -( first// page+ 1 )* page// align )* align
+			else:
+				break
+		if first+ size> start+ self.getI( where+ word ):
+			return None
+		return first
+
+	def _where_fit( self, size, hint= None, place= None ):
+		''' free node for 'size' per 'placement', and '_fit' if 'place', or None '''
+		placement= self.placement
+		if placement== 'best':
+			return self._where_smallest_gte( size, place )
+		if placement not in ( 'first', 'next', 'hint' ):
+			raise ValueError( 'unknown placement policy %r'% placement )
+		if self.addressed and placement!= 'hint':
+			return self._where_first( size, self.getI( self.roveraddr ) if placement== 'next' else 0, place )
+		fits= list( self._where_all_gte( size ) )
+		if place:
+			fits= [ where for where in fits if self._fit( where, size, place ) is not None ]
+		if not fits:
+			return None
+		if placement== 'first':
+			return min( fits )
+		rover= self.getI( self.roveraddr )
+		if placement== 'next':
+			return min( [ where for where in fits if where>= rover ] or fits )
+		if hint is None:
+			hint= rover
+		return min( fits, key= lambda where: abs( where- hint ) )
+
+	def alloc( self, size, hint= None, align= None, no_cross_page= False ):
+		''' remove the node, add remainder if big enough.  'hint' is an offset to
+		allocate near, under 'hint' placement.  'align' puts the allocation at a
+		multiple of 'align' bytes; 'no_cross_page' keeps it inside one page of
+		'pagesize' bytes, or starts it on one if it is bigger.  either passes the bins
+		and pending list by, and gives the gap it leaves in front back to the
+		freetree. '''
 		#print 'alloc', size
-		size= max( size, 4* word )
-		where= self._where_smallest_gte( size )
+		word= self.word
+		self.counts[ 'allocs' ]+= 1
+		self.sizehist[ min( size.bit_length( ), 8* word ) ]+= 1
+		size= max( size, self.minkey )
+		place= None
+		if align or no_cross_page:
+			align, page= align or 1, self.pagesize if no_cross_page else 0
+			if page and size> page:
+				align, page= max( align, page ), 0
+			place= align, page
+		elif self.bins and size<= ( 3+ self.nbins )* word:
+			size= ( size+ word- 1 )// word* word
+			bin= self.binaddr+ size- 4* word
+			where= self.getI( bin )
+			if where:
+				self._retire( [ where+ 2* word ] )
+				self.setI( bin, self[ where ].left )
+				self[ where ].used= 1
+				return where+ 2* word
+		if self.deferred and not place and self.getI( self.pendingaddr ):
+			where= self._take_pending( size )
+			if where:
+				return where+ 2* word
+		where= self._where_or_grow( size, hint, place )
 		if where is None:
 			raise AllocTree.AllocException()
 
 		self.remove_at( where )
+		if place:
+			first= self._fit( where, size, place )
+			if first!= where+ 2* word:
+				where= self._cutfront( where, first )
 
 		oldsize= self[ where ].key
-		if oldsize>= size+ 7* word:
+		if oldsize>= size+ self.minkey+ 3* word:
+			self.counts[ 'splits' ]+= 1
 			self[ where ].key= size
 			self[ where ].foot= where
 			self.add_at( self[ where ].next.where, oldsize- size- 3* word )
+		if self.placement!= 'best':
+			self.setI( self.roveraddr, self[ where ].foot+ word )
 
 		return where+ 2* word
 
+	def _where_or_grow( self, size, hint= None, place= None ):
+		''' free node for 'size', flushing bins or growing the buffer if need be, or None '''
+		where= self._where_fit( size, hint, place )
+		if where is None and self.flush_bins( ):
+			where= self._where_fit( size, hint, place )
+		while where is None:
+			if not self._grow( size+ ( self.minkey+ 3* self.word+ max( place ) if place else 0 ) ):
+				return None
+			where= self._where_fit( size, hint, place )
+		return where
+
+	def alloc_many( self, sizes ):
+		''' allocate one block per size in 'sizes', carving them in sequence from a single
+		free node: one search and one 'remove_at' for the lot, one 'add_at' for what is
+		left.  without a node that large, falls back to one 'alloc' each.  returns the
+		offsets in order, as an array of the same type if 'sizes' is an array. '''
+		word= self.word
+		keys= [ max( size, self.minkey ) for size in sizes ]
+		ret= [ ]
+		if keys:
+			where= self._where_or_grow( sum( keys )+ 3* word* ( len( keys )- 1 ) )
+			if where is None:
+				ret= [ self.alloc( size ) for size in sizes ]
+			else:
+				self.counts[ 'allocs' ]+= len( keys )
+				for size in sizes:
+					self.sizehist[ min( size.bit_length( ), 8* word ) ]+= 1
+				self.remove_at( where )
+				end= where+ self[ where ].key+ 3* word
+				for key in keys[ :-1 ]:
+					self[ where ].used= 1
+					self[ where ].key= key
+					self[ where ].foot= where
+					ret.append( where+ 2* word )
+					where+= key+ 3* word
+				key, rest= keys[ -1 ], end- where- 3* word
+				self[ where ].used= 1
+				if rest>= key+ self.minkey+ 3* word:
+					self.counts[ 'splits' ]+= 1
+					self[ where ].key= key
+					self[ where ].foot= where
+					self.add_at( where+ key+ 3* word, rest- key- 3* word )
+				else:
+					self[ where ].key= rest
+					self[ where ].foot= where
+				ret.append( where+ 2* word )
+		if isinstance( sizes, array.array ):
+			return array.array( sizes.typecode, ret )
+		return ret
+
+	def free_many( self, offsets ):
+		''' free every offset in 'offsets'.  physically adjacent ones are joined first,
+		then each run joins its free neighbors and goes into the freetree once.  bins are
+		bypassed. '''
+		word= self.word
+		heads= sorted( where- 2* word for where in offsets )
+		self.counts[ 'frees' ]+= len( heads )
+		self._free_heads( heads )
+
+	def _free_heads( self, heads ):
+		''' 'free_many' of the used nodes at 'heads', in buffer order '''
+		word= self.word
+		self._retire( [ offt for where in heads for offt in ( where, where+ word, self[ where ].foot ) ] )
+		i= 0
+		while i< len( heads ):
+			where= heads[ i ]
+			end= where+ self[ where ].key+ 3* word
+			i+= 1
+			while i< len( heads ) and heads[ i ]== end:
+				end+= self[ end ].key+ 3* word
+				i+= 1
+			if self[ where ].prevwhere>= self.mapheadsize and not self[ where ].prev.used:
+				self.counts[ 'joinprev' ]+= 1
+				where= self[ where ].prev.where
+				self.remove_at( where )
+			if end< self.size and not self[ end ].used:
+				self.counts[ 'joinnext' ]+= 1
+				self.remove_at( end )
+				end+= self[ end ].key+ 3* word
+			self.add_at( where, end- where- 3* word )
+
+	def _grow( self, size ):
+		''' extend the buffer so that a block of 'size' fits, and return true; or return
+		false if it cannot.  plain buffers cannot. '''
+		return False
+
+	def _split( self, where, size ):
+		''' cut the used node at 'where' down to 'size', freeing the tail, if the tail can
+		stand as a node of its own '''
+		word= self.word
+		oldsize= self[ where ].key
+		if oldsize< size+ self.minkey+ 3* word:
+			return False
+		self.counts[ 'splits' ]+= 1
+		self[ where ].key= size
+		self[ where ].foot= where
+		tail= self[ where ].next.where
+		self[ tail ].used= 1
+		self[ tail ].key= oldsize- size- 3* word
+		self[ tail ].foot= tail
+		self._free( tail+ 2* word )
+		return True
+
+	def _alloc_aligned( self, size, align ):
+		''' allocate at a multiple of 'align'; see 'alloc' '''
+		return self.alloc( size, align= align )
+
+	def _cutfront( self, where, first ):
+		''' cut the used node at 'where' so that its allocation starts at 'first'
+		instead, and free the front, which must have room for a node of its own.
+		returns the new node. '''
+		word= self.word
+		start, key= where+ 2* word, self[ where ].key
+		self[ where ].key= first- start- 3* word
+		self[ where ].foot= where
+		where= first- 2* word
+		self[ where ].used= 1
+		self[ where ].key= key- ( first- start )
+		self[ where ].foot= where
+		self._free( start )
+		return where
+
+	def _needindex( self ):
+		if not self.addressed:
+			raise ValueError( 'the buffer was not created addressed' )
+
+	def _where_first( self, size, start= 0, place= None ):
+		''' lowest addressed free node of at least 'size' at or after 'start', wrapping
+		around to the lowest overall, by the address index; or None.  with a 'place',
+		the lowest that '_fit' finds room in. '''
+		index, getI, word= self.index, self.getI, self.word
+		where= index.floor( start )
+		if where and where< start:
+			where= index.after( where )
+		stop= where
+		while where:
+			if getI( where+ word )>= size and ( not place or self._fit( where, size, place ) is not None ):
+				return where
+			where= index.after( where )
+		where= index.end( 0 )
+		while where and where!= stop:
+			if getI( where+ word )>= size and ( not place or self._fit( where, size, place ) is not None ):
+				return where
+			where= index.after( where )
+		return None
+
+	def alloc_within( self, size, lo, hi ):
+		''' allocate 'size' bytes lying wholly between offsets 'lo' and 'hi', as low as
+		there is room.  a free node reaching in from below 'lo' is cut, if what is
+		left in front can stand as a node.  bins and the pending list are passed by,
+		and the buffer is not grown; raises AllocException. '''
+		self._needindex( )
+		word, index= self.word, self.index
+		self.counts[ 'allocs' ]+= 1
+		size= max( size, self.minkey )
+		where= index.floor( lo )
+		while where and where+ 2* word< hi:
+			start, key= where+ 2* word, self[ where ].key
+			first= max( start, lo )
+			if start< first< start+ self.minkey+ 3* word:
+				first= start+ self.minkey+ 3* word
+			if first+ size<= min( start+ key, hi ):
+				self.remove_at( where )
+				if first!= start:
+					where= self._cutfront( where, first )
+				self._split( where, size )
+				return first
+			where= index.after( where )
+		raise AllocTree.AllocException( )
+
+	def free_extents( self, lo= 0, hi= None ):
+		''' offset and size, as 'alloc' would give them, of each free node that reaches
+		between offsets 'lo' and 'hi', in address order '''
+		self._needindex( )
+		word, index= self.word, self.index
+		if hi is None:
+			hi= self.size
+		ret= [ ]
+		where= index.floor( lo )
+		while where and where+ 2* word< hi:
+			key= self.getI( where+ word )
+			if where+ 2* word+ key> lo:
+				ret.append( ( where+ 2* word, key ) )
+			where= index.after( where )
+		return ret
+
+	def highwater( self ):
+		''' end of the last node that is not free: the size the buffer could be cut to '''
+		self._needindex( )
+		where= self.index.end( 1 )
+		if where and where+ self.getI( where+ self.word )+ 3* self.word== self.size:
+			return where
+		return self.size
+
+	def _slabgeometry( self, slot, slabsize ):
+		''' number of slots and of bitmap words in a slab '''
+		word= self.word
+		bits= 8* word
+		n= ( slabsize- 7* word )// slot
+		while 4* word+ ( n+ bits- 1 )// bits* word+ n* slot> slabsize- 3* word:
+			n-= 1
+		return n, ( n+ bits- 1 )// bits
+
+	def _slabunlink( self, head, slab ):
+		''' take 'slab' off the partial list at 'head' '''
+		word= self.word
+		next, prev= self.getI( slab+ 2* word ), self.getI( slab+ 3* word )
+		if prev:
+			self.setI( prev+ 2* word, next )
+		else:
+			self.setI( head, next )
+		if next:
+			self.setI( next+ 3* word, prev )
+
+	def slab_alloc( self, size ):
+		''' allocate a slot of up to 8 words from a slab; free with 'slab_free' only '''
+		word= self.word
+		bits= 8* word
+		full= ( 1<< bits )- 1
+		slot= ( max( size, 1 )+ word- 1 )// word* word
+		if slot> self.nslabs* word:
+			raise ValueError( 'slab slots hold at most %i bytes, not %i'% ( self.nslabs* word, size ) )
+		head= self.slabaddr+ slot- word
+		slabsize= self.getI( self.slabsizeaddr )
+		if not slabsize:
+			slabsize= self.slabsize
+			self.setI( self.slabsizeaddr, slabsize )
+		n, nmap= self._slabgeometry( slot, slabsize )
+		slab= self.getI( head )
+		if not slab:
+			slab= self._alloc_aligned( slabsize- 3* word, slabsize )
+			self[ slab- 2* word ].used= self.SLAB
+			self.setI( slab, slot )
+			self.setI( slab+ word, n )
+			self.setI( slab+ 2* word, 0 )
+			self.setI( slab+ 3* word, 0 )
+			for i in range( nmap ):
+				self.setI( slab+ ( 4+ i )* word, 0 )
+			extra= nmap* bits- n #bits past the last slot stay set
+			if extra:
+				self.setI( slab+ ( 3+ nmap )* word, full^ ( full>> extra ) )
+			self.setI( head, slab )
+		for i in range( nmap ):
+			bitmap= self.getI( slab+ ( 4+ i )* word )
+			if bitmap!= full:
+				break
+		bit= ( ~bitmap& ( bitmap+ 1 ) ).bit_length( )- 1
+		self.setI( slab+ ( 4+ i )* word, bitmap| 1<< bit )
+		nfree= self.getI( slab+ word )- 1
+		self.setI( slab+ word, nfree )
+		if nfree== 0:
+			self._slabunlink( head, slab )
+		return slab+ ( 4+ nmap )* word+ ( i* bits+ bit )* slot
+
+	def slab_free( self, where ):
+		''' give back a slot from 'slab_alloc'; an emptied slab goes back to the freetree '''
+		word= self.word
+		bits= 8* word
+		slabsize= self.getI( self.slabsizeaddr )
+		slab= where- where% slabsize
+		slot= self.getI( slab )
+		head= self.slabaddr+ slot- word
+		n, nmap= self._slabgeometry( slot, slabsize )
+		i, bit= divmod( ( where- slab- ( 4+ nmap )* word )// slot, bits )
+		bitmap= self.getI( slab+ ( 4+ i )* word )
+		assert bitmap& 1<< bit, 'slot not in use'
+		self.setI( slab+ ( 4+ i )* word, bitmap& ~( 1<< bit ) )
+		nfree= self.getI( slab+ word )+ 1
+		self.setI( slab+ word, nfree )
+		if nfree== 1:
+			next= self.getI( head )
+			self.setI( slab+ 2* word, next )
+			self.setI( slab+ 3* word, 0 )
+			if next:
+				self.setI( next+ 3* word, slab )
+			self.setI( head, slab )
+		if nfree== n:
+			self._slabunlink( head, slab )
+			self[ slab- 2* word ].used= 1
+			self._free( slab )
+
+	def _absorbnext( self, where ):
+		''' join the free node after the used node at 'where' onto it '''
+		word= self.word
+		next= self[ where ].next
+		self._retire( [ self[ where ].foot ] )
+		self.remove_at( next.where )
+		self[ where ].key+= next.key+ 3* word
+		self[ where ].foot= where
+
 	def realloc( self, where, size ):
-		raise
+		''' resize an allocation and return its offset.  shrinking returns the tail to the
+		freetree; growing takes over the next node if it is free and big enough; only
+		otherwise are the contents moved to a new allocation. '''
+		word= self.word
+		size= max( size, self.minkey )
+		where-= 2* word
+		oldsize= self[ where ].key
+		next= self[ where ].next
+		nextfree= next.where< self.size and not next.used
+		if size<= oldsize:
+			if self._split( where, size ):
+				self.reallocs[ 'shrink' ]+= 1
+			elif nextfree:
+				self._absorbnext( where )
+				self._split( where, size )
+				self.reallocs[ 'shrink' ]+= 1
+			else:
+				self.reallocs[ 'same' ]+= 1
+			return where+ 2* word
+		if nextfree and oldsize+ 3* word+ next.key>= size:
+			self._absorbnext( where )
+			self._split( where, size )
+			self.reallocs[ 'grow' ]+= 1
+			return where+ 2* word
+		new= self.alloc( size )
+		self.memmove( new, where+ 2* word, oldsize )
+		self.free( where+ 2* word )
+		self.reallocs[ 'move' ]+= 1
+		return new
 
 	def free( self, where ):
+		''' give back an allocation; to its bin if 'bins' is set and it is an exact size
+		class, else to the freetree '''
+		self.counts[ 'frees' ]+= 1
+		if self.bins:
+			word= self.word
+			where-= 2* word
+			key= self[ where ].key
+			if key< ( 4+ self.nbins )* word and key% word== 0:
+				bin= self.binaddr+ key- 4* word
+				self[ where ].used= self.BINNED
+				self[ where ].left= self.getI( bin )
+				self.setI( bin, where )
+				return
+			where+= 2* word
+		if self.deferred:
+			where-= 2* self.word
+			self[ where ].used= self.PENDING
+			self[ where ].left= self.getI( self.pendingaddr )
+			self.setI( self.pendingaddr, where )
+			count= self.getI( self.pendingcountaddr )+ 1
+			self.setI( self.pendingcountaddr, count )
+			if count>= self.pendingmax:
+				self._flush_pending( )
+			return
+		self._free( where )
+
+	def _take_pending( self, size ):
+		''' a parked node that 'size' fits without a split, taken off the pending list
+		and marked used; or None '''
+		word= self.word
+		link, where= self.pendingaddr, self.getI( self.pendingaddr )
+		while where:
+			key= self[ where ].key
+			if size<= key< size+ self.minkey+ 3* word:
+				self._retire( [ where+ 2* word ] )
+				self.setI( link, self[ where ].left )
+				self.setI( self.pendingcountaddr, self.getI( self.pendingcountaddr )- 1 )
+				self[ where ].used= 1
+				self.counts[ 'reuses' ]+= 1
+				return where
+			link, where= where+ 2* word, self[ where ].left
+		return None
+
+	def _flush_pending( self ):
+		''' put every parked node in the freetree, joining adjacent ones first.  return
+		the number put. '''
+		heads= [ ]
+		where= self.getI( self.pendingaddr )
+		while where:
+			heads.append( where )
+			self[ where ].used= 1
+			where= self[ where ].left
+		self.setI( self.pendingaddr, 0 )
+		self.setI( self.pendingcountaddr, 0 )
+		self._free_heads( sorted( heads ) )
+		return len( heads )
+
+	def flush_bins( self ):
+		''' move every binned and pending node to the freetree, joining neighbors.
+		return the number moved. '''
+		word= self.word
+		count= self._flush_pending( )
+		for bin in range( self.binaddr, self.slabaddr, word ):
+			where= self.getI( bin )
+			while where:
+				self.setI( bin, self[ where ].left )
+				self[ where ].used= 1
+				self._free( where+ 2* word )
+				count+= 1
+				where= self.getI( bin )
+		return count
+
+	def compact( self, moved= None ):
+		''' slide every used node down over the free ones and rebuild the freetree as
+		one node at the end, plus any gaps in front of slabs, which stay put.  calls
+		'moved( old, new, size )' per allocation moved, in buffer order, and returns
+		the 'Relocations'.  'record' and the journal address are relocated; any other
+		offset the caller keeps is theirs to relocate. '''
+		word= self.word
+		AllocTree.flush_bins( self ) #unjournaled, as are the moves
+		relocations= self.Relocations( word )
+		gaps= [ ]
+		last= None
+		dst, where, size= self.mapheadsize, self.mapheadsize, self.size
+		def gap( end ): #free space from dst to end
+			if end- dst>= self.minkey+ 3* word:
+				gaps.append( ( dst, end- dst- 3* word ) )
+			elif end> dst: #too small for a node; the one before takes it
+				self[ last ].key+= end- dst
+				self[ last ].foot= last
+		while where< size:
+			used, key= self.getI( where ), self.getI( where+ word )
+			if used== self.SLAB:
+				gap( where )
+				dst= last= where
+			elif used:
+				if dst!= where:
+					self.memmove( dst, where, key+ 3* word )
+					self[ dst ].foot= dst
+					relocations.add( where, dst, key+ 3* word )
+					if moved:
+						moved( where+ 2* word, dst+ 2* word, key )
+				last= dst
+			else:
+				where+= key+ 3* word
+				continue
+			dst+= key+ 3* word
+			where+= key+ 3* word
+		gap( size )
+		self.root= 0
+		if self.addressed:
+			self.index.root= 0
+		for where, key in gaps:
+			self.add_at( where, key )
+		self.setI( self.roveraddr, dst )
+		if self.record:
+			self.record= relocations[ self.record ]
+		if self.getI( self.journaladdr ):
+			self.setI( self.journaladdr, relocations[ self.getI( self.journaladdr ) ] )
+		directory= self.getI( self.directoryaddr )
+		if directory:
+			directory= relocations[ directory ]
+			self.setI( self.directoryaddr, directory )
+			for slot in self._rootslots( directory ):
+				offt= slot+ self.namesize
+				self.setI( offt, relocations[ self.getI( offt ) ] )
+		return relocations
+
+	def _rootname( self, name ):
+		''' a name as the words it is stored as '''
+		if not 0< len( name )<= self.namesize or '\0' in name:
+			raise ValueError( 'root names are 1 to %i bytes, without NUL, not %r'% ( self.namesize, name ) )
+		return self.packname.unpack( name.ljust( self.namesize, '\0' ) )
+
+	def _rootslots( self, directory ):
+		''' addresses of the slots in use '''
+		step= self.namesize+ self.word
+		first= directory+ 2* self.word
+		for slot in range( first, first+ self.getI( directory )* step, step ):
+			if self.getI( slot ):
+				yield slot
+
+	def _rootslot( self, directory, name ):
+		''' the slot holding 'name', or the empty one it would go in, and whether found '''
+		word, step= self.word, self.namesize+ self.word
+		words= self._rootname( name )
+		mask= self.getI( directory )- 1
+		i= zlib.crc32( name )& mask
+		while True:
+			slot= directory+ 2* word+ i* step
+			first= self.getI( slot )
+			if not first:
+				return slot, False
+			if first== words[ 0 ] and all( self.getI( slot+ j* word )== words[ j ]
+					for j in range( 1, len( words ) ) ):
+				return slot, True
+			i= ( i+ 1 )& mask
+
+	def _rootslotname( self, slot ):
+		word= self.word
+		return self.packname.pack( *[ self.getI( slot+ j* word )
+			for j in range( self.namesize// word ) ] ).rstrip( '\0' )
+
+	def _newdirectory( self, capacity ):
+		word= self.word
+		directory= self.alloc( 2* word+ capacity* ( self.namesize+ word ) )
+		self.setI( directory, capacity )
+		for offt in range( directory+ word, directory+ 2* word+ capacity* ( self.namesize+ word ), word ):
+			self.setI( offt, 0 )
+		return directory
+
+	def get_root( self, name ):
+		''' the offset kept under 'name', or None '''
+		directory= self.getI( self.directoryaddr )
+		if not directory:
+			self._rootname( name )
+			return None
+		slot, found= self._rootslot( directory, name )
+		if not found:
+			return None
+		return self.getI( slot+ self.namesize )
+
+	def set_root( self, name, where ):
+		''' keep 'where' under 'name'; return what was there, or None.  the offset is
+		written before the name, so a reader sees a new name with its offset. '''
+		word= self.word
+		directory= self.getI( self.directoryaddr )
+		if not directory:
+			directory= self._newdirectory( 8 )
+			self.setI( self.directoryaddr, directory )
+		slot, found= self._rootslot( directory, name )
+		if found:
+			old= self.getI( slot+ self.namesize )
+			self.setI( slot+ self.namesize, where )
+			return old
+		count= self.getI( directory+ word )+ 1
+		if 4* count> 3* self.getI( directory ):
+			directory= self._growdirectory( directory )
+			slot, found= self._rootslot( directory, name )
+		self.setI( slot+ self.namesize, where )
+		for j, val in reversed( list( enumerate( self._rootname( name ) ) ) ):
+			self.setI( slot+ j* word, val )
+		self.setI( directory+ word, count )
+		return None
+
+	def swap_root( self, name, old, new ):
+		''' keep 'new' under 'name' only if 'old' is there now, None for absent; true
+		if it was.  'new' None removes. '''
+		if self.get_root( name )!= old:
+			return False
+		if new is None:
+			self.del_root( name )
+		else:
+			self.set_root( name, new )
+		return True
+
+	def del_root( self, name ):
+		''' forget 'name'; return its offset, or None '''
+		word, step= self.word, self.namesize+ self.word
+		directory= self.getI( self.directoryaddr )
+		if not directory:
+			self._rootname( name )
+			return None
+		slot, found= self._rootslot( directory, name )
+		if not found:
+			return None
+		old= self.getI( slot+ self.namesize )
+		mask= self.getI( directory )- 1
+		first= directory+ 2* word
+		i= j= ( slot- first )// step
+		while True: #shift later names of the same run back over the hole
+			j= ( j+ 1 )& mask
+			later= first+ j* step
+			if not self.getI( later ):
+				break
+			home= zlib.crc32( self._rootslotname( later ) )& mask
+			if ( i< j and ( home<= i or home> j ) ) or ( j< i and home<= i and home> j ):
+				for k in range( step// word ):
+					self.setI( first+ i* step+ k* word, self.getI( later+ k* word ) )
+				i= j
+		for k in range( step// word ):
+			self.setI( first+ i* step+ k* word, 0 )
+		self.setI( directory+ word, self.getI( directory+ word )- 1 )
+		return old
+
+	def roots( self ):
+		''' ( name, offset ) for every name kept '''
+		directory= self.getI( self.directoryaddr )
+		if not directory:
+			return [ ]
+		return [ ( self._rootslotname( slot ), self.getI( slot+ self.namesize ) )
+			for slot in self._rootslots( directory ) ]
+
+	def _growdirectory( self, directory ):
+		''' move the names to a directory twice the size '''
+		new= self._newdirectory( 2* self.getI( directory ) )
+		for name, where in self.roots( ):
+			slot, found= self._rootslot( new, name )
+			self.setI( slot+ self.namesize, where )
+			for j, val in enumerate( self._rootname( name ) ):
+				self.setI( slot+ j* self.word, val )
+		self.setI( new+ self.word, self.getI( directory+ self.word ) )
+		self.setI( self.directoryaddr, new )
+		self.free( directory )
+		return new
+
+	def fragmentation( self ):
+		''' 1- largest free node/ free bytes in the freetree; 0 for one node or none '''
+		word= self.word
+		total= largest= 0
+		stack= [ self.root ] if self.root else [ ]
+		while stack:
+			where= stack.pop( )
+			key= self.getI( where+ word )
+			total+= key
+			largest= max( largest, key )
+			for child in self.getI( where+ 2* word ), self.getI( where+ 3* word ):
+				if child:
+					stack.append( child )
+		if not total:
+			return 0.
+		return 1.- float( largest )/ total
+
+	def stats( self ):
+		''' snapshot of what this tree object has done, and of the heap now, as a dict:
+		allocs, frees      calls
+		splits             nodes cut in two by 'alloc' and 'realloc'
+		joinprev, joinnext  frees that joined the free node before, after
+		rotations          rebalancing of the freetree
+		searches, searchdepth  best fit searches, and the nodes they visited
+		reallocs           path taken by 'realloc', as 'reallocs'
+		sizehist           requests by bit length of their size: [ i ] counts sizes of
+		                   2** ( i- 1 ) to 2** i- 1
+		freebytes, freenodes, largestfree  in the freetree
+		binned             bytes of nodes in bins
+		pending            bytes of nodes on the pending list, see 'deferred'
+		reuses             allocs served from the pending list
+		inuse              bytes of the heap neither free, binned nor pending, node heads
+		                   included
+		latency            see 'timed'
+		the heap figures walk the freetree and bins. '''
+		word= self.word
+		ret= dict( self.counts, rotations= self.rotations, reallocs= dict( self.reallocs ),
+			sizehist= list( self.sizehist ), latency= dict( ( op, list( hist ) ) for op, hist in self.latency.items( ) ) )
+		free= nodes= largest= binned= 0
+		stack= [ self.root ] if self.root else [ ]
+		while stack:
+			where= stack.pop( )
+			key= self.getI( where+ word )
+			free+= key
+			nodes+= 1
+			largest= max( largest, key )
+			for child in self.getI( where+ 2* word ), self.getI( where+ 3* word ):
+				if child:
+					stack.append( child )
+		for bin in range( self.binaddr, self.slabaddr, word ):
+			where= self.getI( bin )
+			while where:
+				binned+= self[ where ].key+ 3* word
+				where= self[ where ].left
+		pending= 0
+		where= self.getI( self.pendingaddr )
+		while where:
+			pending+= self[ where ].key+ 3* word
+			where= self[ where ].left
+		ret.update( freebytes= free, freenodes= nodes, largestfree= largest, binned= binned, pending= pending,
+			inuse= self.size- self.mapheadsize- free- 3* word* nodes- binned- pending )
+		return ret
+
+	def timed( self, ops= ( 'alloc', 'free', 'realloc' ), every= 1 ):
+		''' time one call in 'every' to each method in 'ops', into 'latency': per method,
+		counts of calls by bit length of their microseconds.  the timing wrappers are
+		instance attributes over the class's methods, so an untimed tree, or one after
+		'untimed', pays nothing for them. '''
+		for op in ops:
+			hist= self.latency.setdefault( op, [ 0 ]* 32 )
+			setattr( self, op, self._timer( getattr( type( self ), op ).__get__( self ), hist, every ) )
+
+	def _timer( self, method, hist, every ):
+		import time
+		timer= time.time
+		skip= [ 0 ] #calls until the next timed one
+		def wrapper( *args, **kwargs ):
+			if skip[ 0 ]:
+				skip[ 0 ]-= 1
+				return method( *args, **kwargs )
+			skip[ 0 ]= every- 1
+			start= timer( )
+			try:
+				return method( *args, **kwargs )
+			finally:
+				hist[ min( int( ( timer( )- start )* 1e6 ).bit_length( ), 31 ) ]+= 1
+		return wrapper
+
+	def untimed( self ):
+		''' take the timing wrappers off again; 'latency' keeps what they recorded '''
+		for op in self.latency:
+			self.__dict__.pop( op, None )
+
+	def _free( self, where ):
 		''' add the node, joining prior and/or next if also free '''
 		#print 'free', where
+		word= self.word
 		_joinprev, _joinnext= True, True
 		where-= 2* word
 		if self[ where ].prevwhere< self.mapheadsize or self[ where ].prev.used:
 			_joinprev= False
-		if self[ where ].next.where>= self.map.size() or self[ where ].next.used:
+		if self[ where ].next.where>= self.size or self[ where ].next.used:
 			_joinnext= False
+		if _joinprev: #the head goes inside the joined node
+			self._retire( [ where, where+ word ] )
+		if _joinnext: #and the foot
+			self._retire( [ self[ where ].foot ] )
 
 		newkey= self[ where ].key
 		newwhere= where
 		if _joinprev: # join prior
+			self.counts[ 'joinprev' ]+= 1
 			self.remove_at( self[ where ].prev.where )
 			newkey+= self[ where ].prev.key+ 3* word
 			newwhere= self[ where ].prev.where
 		if _joinnext: # join next
+			self.counts[ 'joinnext' ]+= 1
 			self.remove_at( self[ where ].next.where )
 			newkey+= self[ where ].next.key+ 3* word
 		self.add_at( newwhere, newkey )
 
+	def _retire( self, offts ):
+		''' the words at 'offts' hold allocator structure that is about to become free
+		space or someone's data, which is written without journaling; a journaling tree
+		keeps their values first.  nothing here '''
+		pass
+
 	def add_at( self, where, key ):
 		''' small specialization of add_at '''
 		super( AllocTree, self ).add_at( where, key )
-		assert key>= 4* word
+		assert key>= self.minkey
 		self[ where ].used= 0
 		self[ where ].foot= where
+		if self.addressed:
+			self.index.add_at( where, where )
 
 	def remove_at( self, where ):
 		''' small specialization of remove_at '''
+		self._retire( range( where+ self.word, where+ self.minkey+ 2* self.word, self.word )+ [ self[ where ].foot ] )
 		super( AllocTree, self ).remove_at( where )
+		if self.addressed:
+			self.index.remove_at( where )
 		self[ where ].used= 1
 
 class CheckingTree( AllocTree ):
@@ -693,233 +2077,938 @@ class CheckingTree( AllocTree ):
 			return ret
 		return list_io_rec( self.root )
 	def print_used( self ):
-		n= self.root
-		while n.where< self.size():
-			assert self.getI( n.foot )== n.where
-			if not n.used:
-				if n.right: assert self[ n.right ].parent== n.where
-				if n.left: assert self[ n.left ].parent== n.where
-				if n.parent: assert n.where in [ self[ n.parent ].right, self[ n.parent ].left ]
-			n= n.next
-		io= self.list_io()
-		assert io== sorted( io )
-	def check_used( self, n= None ):
-		''' rather strong and lengthy integrity check '''
-		if n is None:
-			n= self.root
-		if n== 0:
-			return
-		def height_rec( where ):
-			if not where: return 0
-			lheight= height_rec( self[ where ].left )
-			rheight= height_rec( self[ where ].right )
-			return 1 + max(lheight, rheight)
-		lheight= height_rec( self[ n ].left )
-		rheight= height_rec( self[ n ].right )
-		#print n, self[ n ].balance, rheight, lheight
-		assert self[ n ].balance== rheight- lheight
-		if self[ n ].left:
-			assert self[ self[ n ].left ].parent== n
-		if self[ n ].right:
-			assert self[ self[ n ].right ].parent== n
-		self.check_used( self[ n ].left )
-		self.check_used( self[ n ].right )
-
+		''' one line per node, in buffer order '''
+		where, size= self.mapheadsize, self.size
+		while where< size:
+			n= self[ where ]
+			if n.used:
+				print '%8i used %i key %i'% ( where, n.used, n.key )
+			else:
+				print '%8i free key %i left %i right %i parent %i balance %+i'% ( where,
+					n.key, n.left, n.right, n.parent, n.balance )
+			where= n.foot+ self.word
+
+	class Verifier( object ):
+		''' one pass over the buffer in node order, then over the freetree with an
+		explicit stack, then the address index if any, then over the bin and slab
+		lists.  nothing asserts; findings go to 'errors' as ( where, message ), totals
+		to the other attributes.
+
+		'step( n )' does at most n nodes of work, under the tree's lock if it has one,
+		so a live file can be checked in slices.  each slice sees the tree as it is
+		then.  once the generation moves between slices, 'stale' is set, findings go
+		to 'suspects' instead, and the cross-checks at the end are skipped; a suspect
+		is worth a 'verify' of its own. '''
+		def __init__( self, tree ):
+			self._tree= tree
+			self.errors, self.suspects= [ ], [ ]
+			self.blocks= self.used= self.nodes= self.binned= self.pending= self.slabs= 0
+			self.freebytes= self.largest= self.height= 0
+			self.done= self.stale= False
+			self._mark= self._getmark( )
+			self._work= self._run( )
+		def step( self, n= 1000 ):
+			''' do up to 'n' nodes of work; true once finished '''
+			tree= self._tree
+			lockable= hasattr( tree, 'lock' )
+			if lockable:
+				tree.lock( )
+			try:
+				if self._getmark( )!= self._mark:
+					self.stale= True
+				for i in xrange( n ):
+					next( self._work )
+			except StopIteration:
+				self.done= True
+			finally:
+				if lockable:
+					tree.unlock( )
+			return self.done
+		def _getmark( self ):
+			tree= self._tree
+			return tree.root, tree.size, tree.getI( tree.generationaddr )
+		def run( self ):
+			''' finish in one go '''
+			while not self.step( 1<< 30 ):
+				pass
+			return self
+		def report( self ):
+			return dict( ( name, getattr( self, name ) ) for name in ( 'errors', 'suspects',
+				'blocks', 'used', 'nodes', 'binned', 'pending', 'slabs', 'freebytes', 'largest', 'height',
+				'done', 'stale' ) )
+		def _error( self, where, message ):
+			( self.suspects if self.stale else self.errors ).append( ( where, message ) )
+		def _run( self ):
+			tree= self._tree
+			word, getI, geti= tree.word, tree.getI, tree.geti
+			size, start= tree.size, tree.mapheadsize
+			free, binned, pending, slabs= set( ), set( ), set( ), { }
+			where, prevfree= start, False
+			while where< size: #buffer order
+				used, key= getI( where ), getI( where+ word )
+				if key< tree.minkey or where+ key+ 3* word> size:
+					self._error( where, 'key %i runs off the buffer'% key )
+					break
+				if getI( where+ key+ 2* word )!= where:
+					self._error( where, 'footer holds %i'% getI( where+ key+ 2* word ) )
+				self.blocks+= 1
+				if used== 0:
+					if prevfree:
+						self._error( where, 'free next to a free node' )
+					free.add( where )
+					self.freebytes+= key
+					self.largest= max( self.largest, key )
+				elif used== 1:
+					self.used+= 1
+				elif used== tree.BINNED:
+					binned.add( where )
+				elif used== tree.SLAB:
+					slabs[ where+ 2* word ]= self._checkslab( where+ 2* word )
+				elif used== tree.PENDING:
+					pending.add( where )
+				else:
+					self._error( where, 'used is %i'% used )
+				prevfree= used== 0
+				where+= key+ 3* word
+				yield
+			if where!= size and not self.errors:
+				self._error( where, 'last node ends past %i'% size )
+			unindexed= set( free ) if tree.addressed else set( )
+			heights, lastkey= { 0: 0 }, 0
+			stack= [ ( tree.root, 0 ) ] if tree.root else [ ]
+			while stack: #freetree, in order
+				where, state= stack.pop( )
+				if state== 0:
+					if where not in free:
+						self._error( where, 'in the freetree, but not a free node' )
+						heights[ where ]= 0
+						continue
+					free.discard( where )
+					self.nodes+= 1
+					stack.append( ( where, 1 ) )
+					left= getI( where+ 2* word )
+					if left:
+						if getI( left+ 4* word )!= where:
+							self._error( left, 'parent is not %i'% where )
+						stack.append( ( left, 0 ) )
+				elif state== 1:
+					key= getI( where+ word )
+					if key< lastkey:
+						self._error( where, 'key %i after %i'% ( key, lastkey ) )
+					lastkey= key
+					stack.append( ( where, 2 ) )
+					right= getI( where+ 3* word )
+					if right:
+						if getI( right+ 4* word )!= where:
+							self._error( right, 'parent is not %i'% where )
+						stack.append( ( right, 0 ) )
+				else:
+					lheight= heights.pop( getI( where+ 2* word ), 0 )
+					rheight= heights.pop( getI( where+ 3* word ), 0 )
+					balance= geti( where+ 5* word )
+					if balance!= rheight- lheight or not -1<= balance<= 1:
+						self._error( where, 'balance %+i, heights %i %i'% ( balance, lheight, rheight ) )
+					heights[ where ]= 1+ max( lheight, rheight )
+				yield
+			self.height= heights.get( tree.root, 0 )
+			if tree.root and getI( tree.root+ 4* word ):
+				self._error( tree.root, 'root has a parent' )
+			where, last= tree.index.end( 0 ) if tree.addressed else 0, 0
+			while where: #address index, in order
+				if where<= last:
+					self._error( where, 'in the address index after %i'% last )
+					break
+				if where not in unindexed:
+					self._error( where, 'in the address index, but not a free node' )
+					break
+				unindexed.discard( where )
+				if getI( where+ 6* word )!= where:
+					self._error( where, 'address holds %i'% getI( where+ 6* word ) )
+				for child in getI( where+ 7* word ), getI( where+ 8* word ):
+					if child and getI( child+ 9* word )!= where:
+						self._error( child, 'address parent is not %i'% where )
+				last, where= where, tree.index.after( where )
+				yield
+			for bin in range( tree.binaddr, tree.slabaddr, word ):
+				where= getI( bin )
+				while where:
+					if where not in binned:
+						self._error( where, 'in bin %i, but not a binned node'% bin )
+						break
+					binned.discard( where )
+					self.binned+= 1
+					if getI( where+ word )!= bin- tree.binaddr+ 4* word:
+						self._error( where, 'key %i in bin %i'% ( getI( where+ word ), bin ) )
+					where= getI( where+ 2* word )
+					yield
+			where= getI( tree.pendingaddr )
+			while where:
+				if where not in pending:
+					self._error( where, 'on the pending list, but not a pending node' )
+					break
+				pending.discard( where )
+				self.pending+= 1
+				where= getI( where+ 2* word )
+				yield
+			if self.pending!= getI( tree.pendingcountaddr ):
+				self._error( tree.pendingcountaddr, 'pending count %i of %i'% ( getI( tree.pendingcountaddr ), self.pending ) )
+			for head in range( tree.slabaddr, tree.slabaddr+ tree.nslabs* word, word ):
+				slab, prev= getI( head ), 0
+				while slab:
+					if not slabs.get( slab ):
+						self._error( slab, 'on a partial list, but not a partial slab' )
+						break
+					if getI( slab+ 3* word )!= prev:
+						self._error( slab, 'prev is not %i'% prev )
+					slabs[ slab ]= 0
+					slab, prev= getI( slab+ 2* word ), slab
+					yield
+			self.slabs= len( slabs )
+			if self.stale:
+				return
+			for where in sorted( free ):
+				self._error( where, 'free node missing from the freetree' )
+			for where in sorted( unindexed ):
+				self._error( where, 'free node missing from the address index' )
+			for where in sorted( binned ):
+				self._error( where, 'binned node missing from its bin' )
+			for where in sorted( pending ):
+				self._error( where, 'pending node missing from the pending list' )
+			for slab, nfree in sorted( slabs.items( ) ):
+				if nfree:
+					self._error( slab, 'partial slab missing from its list' )
+		def _checkslab( self, slab ):
+			''' check the slab's bitmap against its count; return the count '''
+			tree= self._tree
+			word= tree.word
+			slabsize= tree.getI( tree.slabsizeaddr )
+			slot, nfree= tree.getI( slab ), tree.getI( slab+ word )
+			if not slabsize or slab% slabsize or not 0< slot<= tree.nslabs* word or slot% word:
+				self._error( slab, 'slab of slot %i misplaced'% slot )
+				return 0
+			n, nmap= tree._slabgeometry( slot, slabsize )
+			inuse= sum( bin( tree.getI( slab+ ( 4+ i )* word ) ).count( '1' ) for i in range( nmap ) )
+			if nfree!= nmap* 8* word- inuse:
+				self._error( slab, '%i free slots, bitmap says %i'% ( nfree, nmap* 8* word- inuse ) )
+			return nfree
+
+	def verify( self ):
+		''' check the whole tree in one pass; a finished Verifier '''
+		return self.Verifier( self ).run( )
+	def check_used( self ):
+		''' 'verify', and raise on the first few errors '''
+		errors= self.verify( ).errors
+		assert not errors, '; '.join( '%i: %s'% error for error in errors[ :5 ] )
+
+import fcntl
 import mmap
 import os
+import threading
+def _bootmark( ):
+	''' identifies this boot of the machine, or 0 where the platform does not say '''
+	try:
+		with open( '/proc/sys/kernel/random/boot_id' ) as f:
+			return zlib.crc32( f.read( ) )& 0xffffffff or 1
+	except IOError:
+		return 0
+bootmark= _bootmark( )
+
 class MmapAllocTree( CheckingTree ):
-	''' specialization of AllocTree into mmap '''
-	def __init__( self, map ):
+	''' specialization of AllocTree into mmap
+
+	set 'grow' to extend the file when 'alloc' finds no block, instead of raising:
+	'geometric' doubles the file, 'chunk' adds multiples of 'growchunk' bytes.  the
+	file never grows past 'maxsize' (or what the word width can address).  offsets
+	stay valid across growth; 'growths' and 'grownbytes' count what it cost.
+
+	set 'locking' when several processes or threads allocate from one file.  every
+	allocator call then holds an exclusive flock on the file, and picks up growth by
+	other processes.  (flock, not a byte-range lock: mmap duplicates the descriptor,
+	and closing a map on 'remap' would drop byte-range locks.)  open the file in each
+	process; a descriptor inherited over fork shares its lock.  'locked' holds the
+	lock across several calls:
+		with mt.locked( ):
+			a= mt.alloc( 10 ); mt.free( b )
+	reads and writes of allocated data take no lock.  readers that do not allocate
+	call 'remap' to see growth.
+
+	'enable_journal' makes allocator calls crash-safe.  each call is a transaction;
+	before it changes a word, the word's address and old value go to an undo journal
+	in the file.  'checkpoint' flushes the map and empties the journal, every
+	'commitevery' transactions, on 'flush', and on 'close', so that msync is paid once
+	per group.  'transaction' also groups several calls, and any 'setI' to user data
+	between them, into one:
+		with mt.transaction( ):
+			a= mt.alloc( 10 ); mt.setI( mt.recordaddr, a )
+	a transaction left open by a process that died is undone by the next transaction
+	or 'open'.  after an OS crash (the boot id differs), 'open' undoes everything since
+	the last checkpoint.  the page cache is shared, so a process dying at any point is
+	covered; an OS crash only so far as the journal reaches the disk before the pages
+	it describes, since mmap gives no way to order the writeback.
+
+	set 'nodecache' to a number of nodes to keep their headers decoded, so that a walk
+	of the tree unpacks each node once; past that many, they are all dropped.  'setI'
+	and 'seti' write through to a cached field at the offset they write; 'setB' and
+	'memmove' drop the headers they overlap, and a transaction that finds the
+	generation moved on by another process drops them all.  'nodemisses' counts the
+	headers decoded.  see 'nodecache_bench'.
+	'''
+	grow= None
+	nodecache= 0
+	pagesize= mmap.PAGESIZE
+	growchunk= 1<< 20
+	maxsize= None
+	locking= False
+	commitevery= 64
+	_statsroot= None
+	statnames= ( 'allocs', 'frees', 'splits', 'joinprev', 'joinnext', 'rotations', 'searches',
+		'searchdepth', 'freebytes', 'freenodes', 'largestfree', 'binned', 'inuse', 'pending', 'reuses' )
+
+	class JournalFull( AllocTree.AllocException ): pass
+
+	class Locked( object ):
+		''' context manager for 'lock' and 'unlock' '''
+		__slots__= '_tree'
+		def __init__( self, tree ):
+			self._tree= tree
+		def __enter__( self ):
+			self._tree.lock( )
+			return self._tree
+		def __exit__( self, *exc ):
+			self._tree.unlock( )
+
+	class Transaction( object ):
+		''' context manager for 'begin' and 'commit', or 'abort' on an exception '''
+		__slots__= '_tree'
+		def __init__( self, tree ):
+			self._tree= tree
+		def __enter__( self ):
+			self._tree.begin( )
+			return self._tree
+		def __exit__( self, type, value, traceback ):
+			if type is None:
+				self._tree.commit( )
+			else:
+				self._tree.abort( )
+
+	def __init__( self, map, word= None ):
+		''' 'word' defaults to the width recorded in the map '''
 		self.map= map
-		super( MmapAllocTree, self ).__init__( )
+		if word is None:
+			word= packwidth.unpack_from( self.map, 0 )[ 0 ]
+		super( MmapAllocTree, self ).__init__( word )
+		self.growths= self.grownbytes= 0
+		self._rlock, self._lockdepth= threading.RLock( ), 0
+		self._journal, self._txdepth, self._txcount= 0, 0, 0
+		self._nodes, self._nodefields, self._nodesgeneration= { }, { }, None
+		self.nodemisses= 0
+		self.packheader= struct.Struct( self.packI.format* 5+ self.packi.format )
+		self._openindex( )
+	def _openindex( self ):
+		''' take 'addressed' from the header '''
+		if self.getI( self.addressedaddr ):
+			self.addressed, self.minkey= True, 9* self.word
+			self.index= self.AddressIndex( self )
+	def __getitem__( self, where ):
+		if self.nodecache:
+			return CachedNode( where, self )
+		return AdjNode( where, self )
+	def _header( self, where ):
+		''' used, key, left, right, parent and balance of the node at 'where', decoded
+		into the node cache, and 'where' after them '''
+		nodes, fields, word= self._nodes, self._nodefields, self.word
+		self.nodemisses+= 1
+		if where+ self.packheader.size> len( self.map ):
+			return tuple( self.getI( where+ i* word ) for i in range( 2 ) )+ ( 0, 0, 0, 0, where )
+		if len( nodes )>= self.nodecache:
+			self._clearnodes( )
+		header= list( self.packheader.unpack_from( self.map, where ) )
+		header.append( where )
+		for offt in range( where, where+ 6* word, word ):
+			other= fields.get( offt )
+			if other is not None: #an older header overlapping this one; one owner per field
+				self._dropnode( other[ 6 ] )
+			fields[ offt ]= header
+		nodes[ where ]= header
+		return header
+	def _dropnode( self, where ):
+		fields= self._nodefields
+		del self._nodes[ where ]
+		for offt in range( where, where+ 6* self.word, self.word ):
+			del fields[ offt ]
+	def _dropnodes( self, offt, len_ ):
+		''' forget the headers that cover any of 'len_' bytes from 'offt' '''
+		lo, hi= offt- self.packheader.size+ 1, offt+ len_
+		for where in [ where for where in self._nodes if lo<= where< hi ]:
+			self._dropnode( where )
+	def _clearnodes( self ):
+		self._nodes.clear( )
+		self._nodefields.clear( )
+	def _checknodes( self ):
+		''' forget every header if the generation is not the one they were read at '''
+		generation= self.packI.unpack_from( self.map, self.generationaddr )[ 0 ]
+		if generation!= self._nodesgeneration:
+			self._clearnodes( )
+			self._nodesgeneration= generation
+	def lock( self ):
+		''' take the allocator lock, reentrant; nothing unless 'locking' '''
+		if not self.locking:
+			return
+		self._rlock.acquire( )
+		self._lockdepth+= 1
+		if self._lockdepth== 1:
+			fcntl.flock( self.f, fcntl.LOCK_EX )
+			if self.size> len( self.map ):
+				self.remap( )
+	def unlock( self ):
+		if not self.locking:
+			return
+		self._lockdepth-= 1
+		if self._lockdepth== 0:
+			fcntl.flock( self.f, fcntl.LOCK_UN )
+		self._rlock.release( )
+	def locked( self ):
+		''' 'with' statement access to the lock '''
+		return self.Locked( self )
+	def begin( self ):
+		''' start a transaction, or nest in the current one; takes the lock '''
+		self.lock( )
+		self._txdepth+= 1
+		if self._txdepth== 1:
+			if self.nodecache:
+				self._checknodes( )
+			journal= self.getI( self.journaladdr )
+			if journal:
+				word, packI= self.word, self.packI
+				if packI.unpack_from( self.map, journal+ 2* word )[ 0 ]: #its writer died
+					self._rollback( journal, packI.unpack_from( self.map, journal+ 3* word )[ 0 ] )
+				count= packI.unpack_from( self.map, journal )[ 0 ]
+				if 2* count> packI.unpack_from( self.map, journal+ word )[ 0 ]:
+					self._checkpoint( journal )
+					count= 0
+				if count== 0:
+					packI.pack_into( self.map, journal+ 4* word, bootmark& ( 1<< 8* word )- 1 )
+				packI.pack_into( self.map, journal+ 2* word, 1 )
+				packI.pack_into( self.map, journal+ 3* word, count )
+				self._txstart, self._txwords= count, set( )
+			self._journal= journal
+	def commit( self ):
+		''' end a transaction; the outermost one bumps the generation and counts toward
+		the next checkpoint '''
+		self._txdepth-= 1
+		if self._txdepth== 0:
+			self._nextgeneration( )
+		if self._txdepth== 0 and self._journal:
+			journal, self._journal= self._journal, 0
+			self.packI.pack_into( self.map, journal+ 2* self.word, 0 )
+			self._txcount+= 1
+			if self._txcount>= self.commitevery:
+				self.checkpoint( )
+		self.unlock( )
+	def _nextgeneration( self ):
+		old= self.packI.unpack_from( self.map, self.generationaddr )[ 0 ]
+		generation= ( old+ 1 )& ( 1<< 8* self.word )- 1
+		self.packI.pack_into( self.map, self.generationaddr, generation )
+		if self._nodesgeneration== old: #the cached headers are still current
+			self._nodesgeneration= generation
+	def abort( self ):
+		''' end a transaction; the outermost one undoes its writes '''
+		self._txdepth-= 1
+		if self._txdepth== 0 and self._journal:
+			journal, self._journal= self._journal, 0
+			self._rollback( journal, self._txstart )
+		self.unlock( )
+	def transaction( self ):
+		''' 'with' statement access to 'begin' and 'commit' '''
+		return self.Transaction( self )
+	def _log( self, offt ):
+		''' journal the old value of the word at 'offt', once per transaction '''
+		if offt in self._txwords:
+			return
+		self._txwords.add( offt )
+		word, packI, journal= self.word, self.packI, self._journal
+		count= packI.unpack_from( self.map, journal )[ 0 ]
+		if count>= packI.unpack_from( self.map, journal+ word )[ 0 ]:
+			raise self.JournalFull( )
+		entry= journal+ ( 5+ 2* count )* word
+		packI.pack_into( self.map, entry, offt )
+		packI.pack_into( self.map, entry+ word, packI.unpack_from( self.map, offt )[ 0 ] )
+		packI.pack_into( self.map, journal, count+ 1 )
+	def _retire( self, offts ):
+		if self._journal:
+			for offt in offts:
+				self._log( offt )
+	def _rollback( self, journal, start= 0 ):
+		''' restore the words journaled since entry 'start', newest first, and close
+		the transaction '''
+		word, packI= self.word, self.packI
+		self._clearnodes( )
+		count= packI.unpack_from( self.map, journal )[ 0 ]
+		for i in range( count- 1, start- 1, -1 ):
+			entry= journal+ ( 5+ 2* i )* word
+			offt, val= packI.unpack_from( self.map, entry )[ 0 ], packI.unpack_from( self.map, entry+ word )[ 0 ]
+			packI.pack_into( self.map, offt, val )
+		packI.pack_into( self.map, journal, start )
+		packI.pack_into( self.map, journal+ 2* word, 0 )
+	def checkpoint( self ):
+		''' make everything so far durable and empty the journal; inside a transaction
+		this waits for its end '''
+		if self._txdepth:
+			self._txcount= self.commitevery
+			return
+		with self.locked( ):
+			journal= self.getI( self.journaladdr )
+			if journal:
+				self._checkpoint( journal )
+	def _checkpoint( self, journal ):
+		self._txcount= 0
+		if not self.getI( journal ):
+			return
+		self.map.flush( )
+		self.packI.pack_into( self.map, journal, 0 )
+		page= journal- journal% mmap.ALLOCATIONGRANULARITY
+		self.map.flush( page, journal+ self.word- page )
+	def recover( self ):
+		''' undo a transaction left open by a dead process, or after an OS crash,
+		everything since the last checkpoint; 'open' calls this.  returns the number
+		of words restored. '''
+		journal= self.getI( self.journaladdr )
+		if not journal:
+			return 0
+		word= self.word
+		held= self.locking and self._lockdepth
+		if not held:
+			fcntl.flock( self.f, fcntl.LOCK_EX )
+		try:
+			count= self.getI( journal )
+			if count and bootmark and self.getI( journal+ 4* word )!= bootmark& ( 1<< 8* word )- 1:
+				start= 0
+			elif self.getI( journal+ 2* word ):
+				start= self.getI( journal+ 3* word )
+			else:
+				return 0
+			self._rollback( journal, start )
+			self.map.flush( )
+			return count- start
+		finally:
+			if not held:
+				fcntl.flock( self.f, fcntl.LOCK_UN )
+	def enable_journal( self, capacity= 4096 ):
+		''' allocate a journal of 'capacity' entries.  a transaction starts with at
+		least half of it free; one journaling more raises JournalFull and is undone '''
+		if self.getI( self.journaladdr ):
+			return
+		word= self.word
+		journal= self.alloc( ( 5+ 2* capacity )* word )
+		for i in range( 5 ):
+			self.setI( journal+ i* word, 0 )
+		self.setI( journal+ word, capacity )
+		self.setI( self.journaladdr, journal )
+		self.flush( )
+	def disable_journal( self ):
+		journal= self.getI( self.journaladdr )
+		if journal:
+			self.checkpoint( )
+			self.setI( self.journaladdr, 0 )
+			self.free( journal )
+	def _getstatsroot( self ):
+		return self._statsroot
+	def _setstatsroot( self, name ):
+		if name:
+			with self.transaction( ):
+				if self.get_root( name ) is None:
+					self.set_root( name, self.alloc( len( self.statnames )* self.word ) )
+		self._statsroot= name
+	statsroot= property( _getstatsroot, _setstatsroot ) #root name to mirror 'stats' under
+	def stats( self ):
+		''' see AllocTree.stats.  with 'statsroot' set, also writes the figures in
+		'statnames' to the file, a word each, under that root, for other processes '''
+		with self.locked( ):
+			stats= super( MmapAllocTree, self ).stats( )
+			self._mirror( stats )
+		return stats
+	def _mirror( self, stats ):
+		''' write the figures in 'statnames' that 'stats' has under 'statsroot' '''
+		where= self.statsroot and self.get_root( self.statsroot )
+		if not where:
+			return
+		mask= ( 1<< 8* self.word )- 1
+		with self.transaction( ):
+			for i, name in enumerate( self.statnames ):
+				if name in stats:
+					self.setI( where+ i* self.word, stats[ name ]& mask )
+	def mirrored_stats( self, name= None ):
+		''' the figures last written by 'stats' under root 'name', by default
+		'statsroot', as a dict; or None '''
+		name= name or self.statsroot
+		where= name and self.get_root( name )
+		if where is None:
+			return None
+		return dict( ( stat, self.getI( where+ i* self.word ) ) for i, stat in enumerate( self.statnames ) )
+	def alloc( self, size, hint= None, align= None, no_cross_page= False ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).alloc( size, hint, align, no_cross_page )
+	def free( self, where ):
+		with self.transaction( ):
+			super( MmapAllocTree, self ).free( where )
+	def realloc( self, where, size ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).realloc( where, size )
+	def alloc_many( self, sizes ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).alloc_many( sizes )
+	def free_many( self, offsets ):
+		with self.transaction( ):
+			super( MmapAllocTree, self ).free_many( offsets )
+	def flush_bins( self ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).flush_bins( )
+	def slab_alloc( self, size ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).slab_alloc( size )
+	def slab_free( self, where ):
+		with self.transaction( ):
+			super( MmapAllocTree, self ).slab_free( where )
+	def get_root( self, name ):
+		with self.locked( ):
+			return super( MmapAllocTree, self ).get_root( name )
+	def set_root( self, name, where ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).set_root( name, where )
+	def swap_root( self, name, old, new ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).swap_root( name, old, new )
+	def del_root( self, name ):
+		with self.transaction( ):
+			return super( MmapAllocTree, self ).del_root( name )
+	def roots( self ):
+		with self.locked( ):
+			return super( MmapAllocTree, self ).roots( )
+	def compact( self, moved= None, truncate= False ):
+		''' offline: no other process may have the file open, and the moves are not
+		journaled, so keep a copy if a crash would matter.  'truncate' cuts the file
+		off after the last used node. '''
+		with self.locked( ):
+			self.checkpoint( )
+			self._clearnodes( ) #the moves are not seen by 'setI'
+			relocations= super( MmapAllocTree, self ).compact( moved )
+			if truncate:
+				tail= self.getI( self.size- self.word )
+				if not self[ tail ].used:
+					self.remove_at( tail )
+					os.ftruncate( self.f, tail )
+					self.remap( )
+					self.setI( self.sizeaddr, tail )
+			self._nextgeneration( )
+			self.map.flush( )
+		return relocations
 	def setI( self, offt, val ):
 		#print self.map.size(), offt, val
-		assert type( val )== int
-		packI.pack_into( self.map, offt, val )
+		assert isinstance( val, ( int, long ) )
+		if self._journal:
+			self._log( offt )
+		self.packI.pack_into( self.map, offt, val )
+		if self._nodes:
+			header= self._nodefields.get( offt )
+			if header is not None: #write through; 'balance' is signed
+				i= ( offt- header[ 6 ] )// self.word
+				header[ i ]= val if i< 5 else self.packi.unpack_from( self.map, offt )[ 0 ]
 	def getI( self, offt ):
 		#print self.map.size(), offt
-		return packI.unpack_from( self.map, offt )[ 0 ]
+		return self.packI.unpack_from( self.map, offt )[ 0 ]
 	def seti( self, offt, val ):
 		#print self.map.size(), offt, val
-		assert type( val )== int
-		packi.pack_into( self.map, offt, val )
+		assert isinstance( val, ( int, long ) )
+		if self._journal:
+			self._log( offt )
+		self.packi.pack_into( self.map, offt, val )
+		if self._nodes:
+			header= self._nodefields.get( offt )
+			if header is not None:
+				i= ( offt- header[ 6 ] )// self.word
+				header[ i ]= val if i== 5 else self.packI.unpack_from( self.map, offt )[ 0 ]
 	def geti( self, offt ):
 		#print self.map.size(), offt
-		return packi.unpack_from( self.map, offt )[ 0 ]
-	@staticmethod
-	def lenS( val ):
+		return self.packi.unpack_from( self.map, offt )[ 0 ]
+	def lenS( self, val ):
 		''' calculate space needed for length-preceded strings '''
-		return len( val )+ word
+		return len( val )+ self.word
 	def setS( self, offt, val ):
 		''' additional for packing length-preceded strings '''
 		assert type( val )== str
+		word= self.word
 		self.setI( offt, len( val ) )
 		self.map[ offt+ word: offt+ word+ len( val ) ]= val
+	def setB( self, offt, val ):
+		''' write the bytes 'val'; journaled, as 'setI' is, a word at a time '''
+		word= self.word
+		if self._journal:
+			end= offt+ len( val )
+			for o in range( offt, end, word ):
+				self._log( min( o, max( end- word, offt ) ) )
+		if self._nodes:
+			self._dropnodes( offt, len( val ) )
+		self.map[ offt: offt+ len( val ) ]= val
+	def getB( self, offt, len_ ):
+		return self.map[ offt: offt+ len_ ]
+	def memmove( self, dst, src, len_ ):
+		''' copy 'len_' bytes; the ranges may overlap '''
+		if self._nodes:
+			self._dropnodes( dst, len_ )
+		self.map[ dst: dst+ len_ ]= self.map[ src: src+ len_ ]
 	def getS( self, offt ):
+		word= self.word
 		len_= self.getI( offt )
 		return self.map[ offt+ word: offt+ word+ len_ ]
 	@classmethod
 	def open( cls, file, access= mmap.ACCESS_WRITE ):
+		''' word width is read from the file; a file of another 'fileformat' raises
+		ValueError '''
 		f= os.open( file, os.O_RDWR ) #O_BINARY? O_RANDOM?
 		m= mmap.mmap( f, 0, access= access )
+		format= packwidth.unpack_from( m, 1 )[ 0 ]
+		if format!= fileformat:
+			m.close( )
+			os.close( f )
+			raise ValueError( '%s is in format %i, not %i'% ( file, format, fileformat ) )
 		mm= cls( m )
-		mm.f= f
+		mm.f, mm.access= f, access
+		mm.recover( )
 		return mm
 	@classmethod
-	def createNB( cls, file, size, access= mmap.ACCESS_WRITE ):
-		''' create without default whole-file block, poss. for testing '''
+	def createNB( cls, file, size, word= word, access= mmap.ACCESS_WRITE, addressed= False ):
+		''' create without default whole-file block, poss. for testing.  'addressed'
+		indexes the free nodes by offset as well, for good. '''
+		if word not in packs:
+			raise ValueError( 'word width must be one of %s, not %r'% ( sorted( packs ), word ) )
+		if size>= 1<< 8* word:
+			raise ValueError( '%i bytes cannot be addressed with %i-byte words'% ( size, word ) )
 		f= os.open( file, os.O_RDWR| os.O_CREAT| os.O_TRUNC ) #O_BINARY? O_RANDOM?
+		os.ftruncate( f, size )
 		m= mmap.mmap( f, size, access= access )
-		mm= cls( m )
-		mm.f= f
+		packwidth.pack_into( m, 0, word )
+		packwidth.pack_into( m, 1, fileformat )
+		mm= cls( m, word )
+		mm.f, mm.access= f, access
+		if addressed:
+			mm.setI( mm.addressedaddr, 1 )
+			mm._openindex( )
 		return mm
 	@classmethod
-	def create( cls, file, size, access= mmap.ACCESS_WRITE ):
+	def create( cls, file, size, word= word, access= mmap.ACCESS_WRITE, addressed= False ):
 		''' create and add default whole-file block to freetree '''
-		mm= cls.createNB( file, size, access= access )
+		mm= cls.createNB( file, size, word= word, access= access, addressed= addressed )
+		word= mm.word
 		mm.setI( mm.sizeaddr, mm.map.size( ) ) 
 		mm.add_at( mm.mapheadsize, mm.map.size( )- mm.mapheadsize- 3* word )
 		return mm
+	def remap( self ):
+		''' map the file again at its current length '''
+		self.map.close( )
+		self.map= mmap.mmap( self.f, os.fstat( self.f ).st_size, access= self.access )
+	def _grow( self, size ):
+		''' extend the file per 'grow' policy; the new tail is freed as one block, which
+		joins a free block at the old end '''
+		if self.grow is None:
+			return False
+		word= self.word
+		old= self.size
+		need= size+ 3* word
+		if self.grow== 'geometric':
+			new= old* 2
+			while new- old< need:
+				new*= 2
+		elif self.grow== 'chunk':
+			new= old+ ( need+ self.growchunk- 1 )// self.growchunk* self.growchunk
+		else:
+			raise ValueError( 'unknown growth policy %r'% self.grow )
+		limit= ( 1<< 8* word )- 1
+		if self.maxsize is not None:
+			limit= min( limit, self.maxsize )
+		new= min( new, limit )
+		if new- old< need:
+			return False
+		os.ftruncate( self.f, new )
+		self.remap( )
+		self.setI( self.sizeaddr, new )
+		self[ old ].used= 1
+		self[ old ].key= new- old- 3* word
+		self[ old ].foot= old
+		self._free( old+ 2* word )
+		self.growths+= 1
+		self.grownbytes+= new- old
+		return True
 	def flush( self ):
+		if self.statsroot: #the counters only; the heap figures wait for 'stats'
+			self._mirror( dict( self.counts, rotations= self.rotations ) )
 		self.map.flush( )
+		self.checkpoint( )
 	def close( self ):
+		self.checkpoint( )
 		self.map.close( )
 		self.map= None
 		#self.f.close( )
 		os.close( self.f )
 		del self.f
 
-'''test suite of 4 functions.  recommend useful_test.'''
+class FlatMmapAllocTree( MmapAllocTree, FlatBufferTree ):
+	''' MmapAllocTree on the flat 'add_at' / 'remove_at' engine '''
 
-def concurrency_test( ):
-	''' test concurrency integrity of mmap, multiple unsynchronized writers '''
-	import time
+class AllocCache( object ):
+	''' process-local front for a shared tree, after tcmalloc's thread caches.  requests
+	up to 'maxwords' words are rounded up to a whole word and served from in-memory
+	lists of blocks of that exact size.  an empty list is refilled with 'batch' blocks
+	by one 'alloc_many', so one lock; a list longer than 'highwater' gives all but
+	'batch' back by one 'free_many'.  larger requests go straight to the tree.
 
-	def th_w( ix= 0 ):
-		if ix== 0:
-			mt= MmapAllocTree.createNB( 'mappedtree.dat', 3000 )
-		else:
-			mt= MmapAllocTree.open( 'mappedtree.dat' )
-		j= 0
-		base= mt.mapheadsize
-		while 1:
-			for i in range( ix* word, 1000, 3* word ):
-				mt.setI( i+ base, j )
-			time.sleep( .05 )
-			j+= 1
-			mt.flush( )
-		
-	def th_r( ):
-		mt= MmapAllocTree.open( 'mappedtree.dat' )
-		j= 0
-		base= mt.mapheadsize 
-		while 1:
-			for i in range( 0, 1000, 100 ):
-				print mt.getI( i+ base ),
-			print
-			time.sleep( .1 )
-	
-	import thread
-	thread.start_new_thread( th_w, ( 0, ) )
-	time.sleep( .1 )
-	thread.start_new_thread( th_w, ( 1, ) )
-	time.sleep( .1 )
-	thread.start_new_thread( th_w, ( 2, ) )
-	time.sleep( .1 )
-	th_r( )
-#if __name__== '__main__':
-#	concurrency_test( )			
-
-def insert_stress():
-	''' test of add_at.  insert nodes, assuming size 30, until file is full.'''
-	while 1:
-		print '======================='
-		mt= MmapAllocTree.createNB( 'mappedtree.dat', 3000 )
-		i= 100
-		seq= [ 10, 11, 13, 17, 33, 43, 65, 72, 85, 93, 107, 113, 120 ]
-		import random as ran
-		ran.shuffle( seq )
-
-		while i< 2800:
-			x= ran.randint( 16, 100 )
-			mt.add_at( i, x )
-			mt.print_list()
-			mt.check_used()
-			i+= 30
-		mt.close()
-#if __name__== '__main__':
-#	insert_stress()
-
-def stress():
-	''' stress-test alloc/free.  randomly choose either alloc of random size (if
-	below record limit) or free (if any are allocated).  loop 10000 times (ten seconds).
-	store up to 100 offsets that have been allocated + count.
-	optionally reopen file on second run, read count + list of offsets, and run
-	10000 more.
+	cached blocks are allocated as far as the file is concerned: call 'drain' before
+	exiting, or they leak.  not thread-safe; make one per thread.
 	'''
+	def __init__( self, tree, batch= 32, highwater= 128, maxwords= 32 ):
+		self.tree= tree
+		self.word= tree.word
+		self.batch, self.highwater= batch, highwater
+		self.maxkey= maxwords* self.word
+		self.lists= { }
+		self.hits= self.misses= self.direct= self.refills= self.returns= 0
+
+	def alloc( self, size ):
+		word= self.word
+		key= ( max( size, 4* word )+ word- 1 )// word* word
+		if key> self.maxkey:
+			self.direct+= 1
+			return self.tree.alloc( size )
+		blocks= self.lists.get( key )
+		if blocks:
+			self.hits+= 1
+			return blocks.pop( )
+		self.misses+= 1
+		self.refills+= 1
+		blocks= self.lists[ key ]= self.tree.alloc_many( [ key ]* self.batch )
+		return blocks.pop( )
+
+	def free( self, where ):
+		word= self.word
+		key= self.tree[ where- 2* word ].key
+		if key> self.maxkey or key% word:
+			self.direct+= 1
+			self.tree.free( where )
+			return
+		blocks= self.lists.setdefault( key, [ ] )
+		blocks.append( where )
+		if len( blocks )> self.highwater:
+			self.returns+= 1
+			self.tree.free_many( blocks[ self.batch: ] )
+			del blocks[ self.batch: ]
+
+	def drain( self ):
+		''' give every cached block back to the tree '''
+		blocks= [ ]
+		for key in self.lists:
+			blocks.extend( self.lists[ key ] )
+		self.lists.clear( )
+		self.tree.free_many( blocks )
+
+	def stats( self ):
+		''' hit and miss counts, and the hit rate of cacheable requests '''
+		return dict( hits= self.hits, misses= self.misses, direct= self.direct,
+			refills= self.refills, returns= self.returns,
+			hitrate= float( self.hits )/ ( self.hits+ self.misses or 1 ),
+			cached= sum( len( blocks ) for blocks in self.lists.values( ) ) )
+
+'''test suite of 4 functions.  recommend useful_test.'''
+
+def _concurrency_writer( ix, seconds, counts, hitrates= None ):
+	''' one writer process of concurrency_test; through an AllocCache if 'hitrates' '''
 	import random as ran
-	mems= set( ) #external store of what offsets are currently allocated
-	_recordlimit= 100
 	import time
-	print time.clock( )
-	if 1: #change to if '0' to set to 'reopen', not 'create'
-		#create a file, plus allocate space to store 100 offsets between runs
-		mt= MmapAllocTree.create( 'mappedtree.dat', 3000 )
-		mt.record= mt.alloc( _recordlimit* word )
-	else:
-		#open and print existing 'cache' of offsets that were stored previously
-		mt= MmapAllocTree.open( 'mappedtree.dat' )
-		print 'cache',
-		for i in range( mt.getI( mt.record ) ):
-			print i, mt.getI( mt.record+ word* i+ word ),
-			mems.add( mt.getI( mt.record+ word* i+ word ) )
-		print
-
-	#log= open( 'mappedtree.txt', 'w' )
-	for count in range( 1000 ):#while 1:
-		print len( mems ), #print current count of allocation
-
-		mt.check_used()
-		#mt.print_list()
-		#print mt.list_io()
-		if ran.choice( ( 0, 1 ) ) and mems or len( mems )+ 2> _recordlimit:
-			where= ran.choice( list( mems ) )
-			#print 'free',where, mt[where-2* word].key
-			#log.write( 'mt.free( %i )\n'% where )
-			#log.flush()
-			mt.free( where )
-			mems.remove( where )
+	mt= FlatMmapAllocTree.open( 'mappedtree.dat' )
+	mt.locking= True
+	heap= mt
+	if hitrates is not None:
+		heap= AllocCache( mt )
+	r= ran.Random( ix )
+	mems= [ ]
+	count= 0
+	stop= time.time( )+ seconds
+	while time.time( )< stop:
+		if mems and ( r.choice( ( 0, 1 ) ) or len( mems )> 50 ):
+			heap.free( mems.pop( r.randrange( len( mems ) ) ) )
 		else:
-			size= ran.randint( 5, 100 )
-			#print 'alloc', size
 			try:
-				#log.write( 'mt.alloc( %i )\n'% size )
-				#log.flush()
-				where= mt.alloc( size )
-				mems.add( where )
+				a= heap.alloc( r.randint( 5, 100 ) )
 			except AllocTree.AllocException:
-				print 'insufficient',
-				#log.write( 'insufficient\n' )
-				#log.flush()
-				pass
+				continue
+			mt.setI( a, ix ) #readers need no lock for data
+			mems.append( a )
+		count+= 1
+	for a in mems:
+		assert mt.getI( a )== ix, 'allocation shared between writers'
+	with mt.locked( ): #several operations, one lock
+		for a in mems:
+			heap.free( a )
+	if hitrates is not None:
+		hitrates[ ix ]= heap.stats( )[ 'hitrate' ]
+		heap.drain( )
+	counts[ ix ]= count
+	mt.close( )
 
-	#record cache for valid persistivity
-	mt.setI( mt.record, len( mems ) )
-	print
-	print 'cache',
-	for i, x in enumerate( mems ):
-		print i, x,
-		mt.setI( word* i+ mt.record+ word, x )
-	print
-	mt.flush()
-	mt.close()
-	print time.clock( ) #10 seconds on author's run
+def concurrency_test( seconds= 2, writers= ( 1, 2, 4, 8 ), cached= False ):
+	''' several processes allocating and freeing on one file under 'locking'.  reports
+	alloc/free throughput per writer count and checks the tree afterwards.  'cached'
+	puts an AllocCache in front of each writer. '''
+	import multiprocessing
+	for n in writers:
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+		mt.close( )
+		counts= multiprocessing.Array( 'l', n )
+		hitrates= None
+		args= ( seconds, counts )
+		if cached:
+			hitrates= multiprocessing.Array( 'd', n )
+			args+= ( hitrates, )
+		procs= [ multiprocessing.Process( target= _concurrency_writer, args= ( ix, )+ args )
+			for ix in range( n ) ]
+		for proc in procs:
+			proc.start( )
+		for proc in procs:
+			proc.join( )
+			assert proc.exitcode== 0
+		mt= MmapAllocTree.open( 'mappedtree.dat' )
+		mt.check_used( )
+		assert mt.list_io( )== [ mt.size- mt.mapheadsize- 3* mt.word ], 'leaked or lost blocks'
+		mt.close( )
+		print '%2i writers: %8.0f ops/sec'% ( n, sum( counts )/ float( seconds ) ),
+		if cached:
+			print '  hit rate %.3f'% ( sum( hitrates )/ n ),
+		print
+
+def cache_bench( seconds= 2, writers= ( 1, 2, 4, 8, 16 ) ):
+	''' scaling of shared-file throughput with and without per-process caches '''
+	for cached in ( False, True ):
+		print 'cached', cached
+		concurrency_test( seconds, writers, cached )
 #if __name__== '__main__':
-#	stress( )
+#	concurrency_test( )			
+
+def stress( ops= 1000, seed= None ):
+	''' replay a random alloc/free/realloc trace on a small file, checking the tree
+	after every call, then reopen the file and check it again.  'alloctrace.suite'
+	is the benchmark. '''
+	import alloctrace
+	trace= alloctrace.synthetic( 'random', ops, seed )
+	mt= MmapAllocTree.create( 'mappedtree.dat', 3000 )
+	report= alloctrace.replay( trace, mt, every= 100, check= 1 )
+	print 'failed %(failed)i of %(ops)i, peak %(peaklive)i bytes, fragmentation %(fragmentation).2f'% report
+	mt.close( )
+	mt= MmapAllocTree.open( 'mappedtree.dat' )
+	mt.check_used( )
+	mt.close( )
 
 def useful_test( ):
 	import random as ran
 	mt= MmapAllocTree.create( 'mappedtree.dat', 3000 )
+	word= mt.word
 	aL= 4* word
 	a= mt.alloc( aL ) #array of 4 words
 	mt.record= a #pointer to our structure in the file
@@ -930,21 +3019,898 @@ def useful_test( ):
 	mt= MmapAllocTree.open( 'mappedtree.dat' ) #reopen
 	a= mt.record
 	bL= 8* word
-	b= mt.alloc( bL ) #allocate more (realloc service by hand)
+	b= mt.realloc( a, bL ) #allocate more, keeping the old contents
 	mt.record= b
-	mt.map[ b: b+ aL ]= mt.map[ a: a+ aL ] #copy old
 	for i in range( 4, 8 ):
 		mt.setI( b+ i* word, i** 2 )
 	mt.close( )
-	''' at this point, the former records (0,1,2,3) should still be
-	at the original offset as well as at the new one.  (16,25,36,49)
-	should come after them at the second offset. '''
+	''' at this point, the former records (0,1,2,3) should be at the
+	start of the grown block.  (16,25,36,49) should come after them. '''
 	
 	mt= MmapAllocTree.open( 'mappedtree.dat' ) #reopen
 	b= mt.record
 	for i in range( 8 ):
 		print 'read', mt.getI( b+ i* word )
+	mt.map[ 1 ]= '\0' #as if from before 'fileformat'
+	mt.close( )
+	try:
+		MmapAllocTree.open( 'mappedtree.dat' )
+		assert False
+	except ValueError:
+		pass
+
+def grow_test( ):
+	''' start small, let the file double, and check earlier offsets survive '''
+	mt= MmapAllocTree.create( 'mappedtree.dat', 1000 )
+	mt.grow= 'geometric'
+	mt.maxsize= 1<< 20
+	word= mt.word
+	mems= [ ]
+	for i in range( 200 ):
+		a= mt.alloc( 10* word )
+		mt.setI( a, i )
+		mems.append( a )
+	for i, a in enumerate( mems ):
+		assert mt.getI( a )== i
+	mt.check_used( )
+	print 'size', mt.size, 'growths', mt.growths, 'grown bytes', mt.grownbytes
+	for a in mems[ ::2 ]:
+		mt.free( a )
 	mt.close( )
+	mt= MmapAllocTree.open( 'mappedtree.dat' )
+	for i, a in enumerate( mems[ 1::2 ] ):
+		assert mt.getI( a )== 2* i+ 1
+	mt.check_used( )
+	mt.close( )
+
+def realloc_test( ):
+	''' exercise each 'realloc' path and check contents survive '''
+	mt= MmapAllocTree.create( 'mappedtree.dat', 3000 )
+	word= mt.word
+	a= mt.alloc( 8* word )
+	for i in range( 8 ):
+		mt.setI( a+ i* word, i )
+	a= mt.realloc( a, 20* word ) #next node is the free remainder: grow in place
+	b= mt.alloc( 8* word )
+	a= mt.realloc( a, 10* word ) #shrink, tail freed
+	a= mt.realloc( a, 12* word ) #grow into the freed tail
+	a= mt.realloc( a, 40* word ) #b is in the way: move
+	for i in range( 8 ):
+		assert mt.getI( a+ i* word )== i
+	assert mt.realloc( b, 8* word- 1 )== b #too little to split off, a follows
+	mt.check_used( )
+	print mt.reallocs
+	assert mt.reallocs== dict( same= 1, shrink= 1, grow= 2, move= 1 )
+	mt.close( )
+
+def bins_bench( ops= 20000 ):
+	''' throughput and fragmentation with and without size-class bins, under the
+	'stress' workload: random sizes of 5 to 100 bytes, up to 100 live allocations. '''
+	import random as ran
+	import time
+	for bins in ( False, True ):
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 30000 )
+		mt.bins= bins
+		r= ran.Random( 0 )
+		mems= [ ]
+		start= time.time( )
+		for count in range( ops ):
+			if mems and ( r.choice( ( 0, 1 ) ) or len( mems )+ 2> 100 ):
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			else:
+				try:
+					mems.append( mt.alloc( r.randint( 5, 100 ) ) )
+				except AllocTree.AllocException:
+					pass
+		elapsed= time.time( )- start
+		sizes= mt.list_io( )
+		binned= 0
+		for bin in range( mt.binaddr, mt.slabaddr, mt.word ):
+			where= mt.getI( bin )
+			while where:
+				binned+= 1
+				where= mt[ where ].left
+		mt.check_used( )
+		print 'bins %-5s %8.0f ops/sec  %3i free nodes, %3i binned, largest free %5i of %5i'% (
+			bins, ops/ elapsed, len( sizes ), binned, max( sizes or [ 0 ] ), sum( sizes ) )
+		mt.close( )
+
+def slab_test( ):
+	''' fill slabs with small records, free them, and check the slabs come back '''
+	import random as ran
+	mt= MmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	mt.slabsize= 1024
+	word= mt.word
+	mems= { }
+	for i in range( 2000 ):
+		size= ran.randint( 1, 4* word )
+		a= mt.slab_alloc( size )
+		assert a not in mems
+		mt.setI( a, i )
+		mems[ a ]= i
+	for a in ran.sample( sorted( mems ), 1000 ):
+		mt.slab_free( a )
+		del mems[ a ]
+	mt.flush_bins( ) #must leave the slab heads alone
+	for a, i in mems.items( ):
+		assert mt.getI( a )== i
+	mt.check_used( )
+	for a in mems:
+		mt.slab_free( a )
+	assert mt.list_io( )== [ mt.size- mt.mapheadsize- 3* word ], 'slabs not returned'
+	mt.close( )
+
+def slab_bench( count= 20000 ):
+	''' time and space for many 12-byte records, by 'alloc' and by 'slab_alloc' '''
+	import time
+	for name in ( 'alloc', 'slab_alloc' ):
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+		method= getattr( mt, name )
+		start= time.time( )
+		mems= [ method( 12 ) for i in range( count ) ]
+		elapsed= time.time( )- start
+		used= mt.size- mt.mapheadsize- sum( mt.list_io( ) )
+		print '%-10s %8.0f allocs/sec  %6.1f bytes per 12-byte record'% (
+			name, count/ elapsed, float( used )/ count )
+		mt.close( )
+
+def batch_test( ):
+	''' alloc_many / free_many against the same work done one at a time '''
+	import random as ran
+	mt= MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	word= mt.word
+	sizes= array.array( 'I', [ ran.randint( 1, 60 ) for i in range( 100 ) ] )
+	mems= mt.alloc_many( sizes )
+	assert type( mems )== array.array and len( mems )== len( sizes )
+	for a, size in zip( mems, sizes ):
+		mt.map[ a: a+ size ]= '\xab'* size
+	for a, b in zip( mems, mems[ 1: ] ):
+		assert mt[ a- 2* word ].next.where== b- 2* word
+	mt.check_used( )
+	singles= [ mt.alloc( 20 ) for i in range( 20 ) ]
+	mt.free_many( list( mems[ ::3 ] )+ singles[ ::2 ] )
+	mt.check_used( )
+	mt.free_many( list( mems[ 1::3 ] )+ list( mems[ 2::3 ] )+ singles[ 1::2 ] )
+	mt.check_used( )
+	assert mt.list_io( )== [ mt.size- mt.mapheadsize- 3* word ]
+	mt.close( )
+
+def journal_test( ):
+	''' a process dying inside an allocator call, a transaction left open, an abort,
+	and an OS crash all come back to a consistent tree '''
+	mt= MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	mt.enable_journal( 256 )
+	mt.commitevery= 1000
+	mems= [ mt.alloc( 40 ) for i in range( 20 ) ]
+	for a in mems[ ::2 ]:
+		mt.free( a )
+	mt.checkpoint( )
+	checkpointed= mt.list_io( )
+	with mt.transaction( ):
+		a= mt.alloc( 100 )
+		mt.setI( mt.recordaddr, a )
+	committed= mt.list_io( )
+	for partial in ( False, True ):
+		pid= os.fork( )
+		if pid== 0:
+			if partial: #die between unlinking a node and adding back its tail
+				mt.add_at= lambda *args: os._exit( 0 )
+				mt.alloc( 50 )
+			else:
+				mt.begin( )
+				mt.free( mems[ 1 ] )
+				mt.alloc( 10 )
+				os._exit( 0 )
+		os.waitpid( pid, 0 )
+		assert mt.recover( )> 0
+		assert mt.list_io( )== committed and mt.getI( mt.recordaddr )== a
+		mt.check_used( )
+	try:
+		with mt.transaction( ):
+			mt.free( a )
+			raise ValueError
+	except ValueError:
+		pass
+	assert mt.list_io( )== committed
+	moves= mt.reallocs[ 'move' ]
+	for size in ( 400, 60 ): #data written, unjournaled, over the node a block came from
+		try:
+			with mt.transaction( ):
+				b= mt.realloc( mems[ 3 ], size ) if size> 100 else mt.alloc( size )
+				mt.map[ b: b+ size ]= '\xff'* size
+				raise ValueError
+		except ValueError:
+			pass
+		assert mt.list_io( )== committed
+		mt.check_used( )
+	assert mt.reallocs[ 'move' ]== moves+ 1
+	journal= mt.getI( mt.journaladdr ) #as if written before a reboot
+	mt.setI( journal+ 4* mt.word, mt.getI( journal+ 4* mt.word )^ 1 )
+	if bootmark:
+		assert mt.recover( )> 0
+		assert mt.list_io( )== checkpointed and mt.getI( mt.recordaddr )== 0
+		mt.check_used( )
+	mt.disable_journal( )
+	mt.close( )
+	mt= MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	mt.enable_journal( 4 )
+	before= mt.list_io( )
+	try:
+		mt.alloc_many( [ 20 ]* 10 )
+		assert False
+	except mt.JournalFull:
+		pass
+	assert mt.list_io( )== before
+	mt.check_used( )
+	mt.close( )
+
+def verify_test( ):
+	''' the verifier passes a busy tree, in one go and in slices, and names each
+	kind of damage '''
+	import random as ran
+	mt= MmapAllocTree.create( 'mappedtree.dat', 60000 )
+	word= mt.word
+	mt.bins= True
+	mems= [ mt.alloc( ran.randint( 5, 100 ) ) for i in range( 200 ) ]
+	slots= [ mt.slab_alloc( ran.randint( 1, 8* word ) ) for i in range( 100 ) ]
+	for a in mems[ ::3 ]+ mems[ 1::15 ]:
+		mt.free( a )
+	for a in slots[ ::2 ]:
+		mt.slab_free( a )
+	whole= mt.verify( )
+	assert not whole.errors and whole.nodes and whole.binned and whole.slabs
+	v= mt.Verifier( mt )
+	steps= 1
+	while not v.step( 7 ):
+		steps+= 1
+	assert steps> 10 and v.report( )== whole.report( )
+	def damaged( offt, val ):
+		old= mt.getI( offt )
+		mt.setI( offt, val )
+		errors= mt.verify( ).errors
+		mt.setI( offt, old )
+		assert errors, offt
+		return errors
+	node= mt.root
+	damaged( node+ 5* word, 2 ) #balance
+	damaged( mt[ node ].foot, node+ word ) #footer
+	damaged( ( mt.getI( node+ 2* word ) or mt.getI( node+ 3* word ) )+ 4* word, 0 ) #parent
+	used= mems[ 2 ]- 2* word
+	damaged( used, 0 ) #a free node outside the freetree
+	for bin in range( mt.binaddr, mt.slabaddr, word ):
+		if mt.getI( bin ):
+			damaged( mt.getI( bin )+ word, 100* word ) #binned key
+			break
+	slab= slots[ 1 ]- slots[ 1 ]% mt.getI( mt.slabsizeaddr )
+	damaged( slab+ word, 0 ) #free slot count
+	mt.check_used( )
+	v= mt.Verifier( mt )
+	v.step( 5 )
+	mt.free( mems[ 5 ] )
+	v.run( )
+	assert v.stale and not v.errors and v.done
+	mt.close( )
+
+def compact_test( ):
+	''' compact a fragmented file with bins, slabs and a journal: contents, 'record'
+	and stored offsets survive, and the file can shrink and grow again '''
+	import random as ran
+	mt= MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	word= mt.word
+	mt.bins= True
+	mt.enable_journal( 64 )
+	mems= [ mt.alloc( ran.randint( 5, 100 ) ) for i in range( 300 ) ]
+	slots= [ mt.slab_alloc( 8 ) for i in range( 10 ) ]
+	for i, a in enumerate( mems ):
+		mt.map[ a: a+ 5 ]= '%05i'% i
+	for a in mems[ ::2 ]:
+		mt.free( a )
+	kept= mems[ 1::2 ]
+	table= mt.alloc( len( kept )* word ) #offsets stored in the file itself
+	for i, a in enumerate( kept ):
+		mt.setI( table+ i* word, a )
+	mt.record= table+ word
+	before= mt.fragmentation( )
+	calls= [ ]
+	relocations= mt.compact( moved= lambda old, new, size: calls.append( old ) )
+	assert calls and len( calls )== len( relocations )
+	assert mt.record== relocations[ table ]+ word
+	relocations.rewrite( mt, [ table+ i* word for i in range( len( kept ) ) ] )
+	table= relocations[ table ]
+	for i, a in enumerate( kept ):
+		assert mt.getI( table+ i* word )== relocations[ a ]
+		a= relocations[ a ]
+		assert mt.map[ a: a+ 5 ]== '%05i'% ( 2* i+ 1 )
+	for a in slots:
+		assert relocations[ a ]== a
+		mt.slab_free( a )
+	mt.check_used( )
+	assert mt.fragmentation( )< before
+	with mt.transaction( ):
+		mt.free( mt.alloc( 30 ) )
+	mt.compact( )
+	mt.compact( truncate= True )
+	mt.check_used( )
+	assert len( mt.map )== mt.size< 30000
+	mt.grow= 'chunk'
+	mt.growchunk= 4096
+	mt.alloc( 5000 )
+	mt.check_used( )
+	mt.close( )
+
+def placement_test( ):
+	''' each policy picks the node it says it does, and leaves a sound tree '''
+	import random as ran
+	for placement in ( 'best', 'first', 'next', 'hint' ):
+		mt= MmapAllocTree.create( 'mappedtree.dat', 40000 )
+		mt.placement= placement
+		word= mt.word
+		mems= [ mt.alloc( ran.randint( 5, 100 ) ) for i in range( 200 ) ]
+		for a in ran.sample( mems, 100 ):
+			mt.free( a )
+			mems.remove( a )
+		for i in range( 100 ):
+			size= ran.randint( 5, 60 )
+			key= max( size, 4* word )
+			fits= [ where for where in mt._where_all_gte( key ) ]
+			rover= mt.getI( mt.roveraddr )
+			hint= ran.randrange( mt.size ) if i% 2 else None
+			a= mt.alloc( size, hint )- 2* word
+			if placement== 'first':
+				assert a== min( fits )
+			elif placement== 'next':
+				assert a== min( [ where for where in fits if where>= rover ] or fits )
+			elif placement== 'hint':
+				target= rover if hint is None else hint
+				assert abs( a- target )== min( abs( where- target ) for where in fits )
+			else:
+				assert mt[ a ].key- key< 7* word or mt[ a ].key== key
+			mems.append( a+ 2* word )
+			if i% 3== 0:
+				mt.free( mems.pop( ran.randrange( len( mems ) ) ) )
+		mt.check_used( )
+		mt.close( )
+	mt= MmapAllocTree.create( 'mappedtree.dat', 40000 )
+	mt.placement= 'worst'
+	try:
+		mt._where_fit( 10 )
+		assert False
+	except ValueError:
+		pass
+	mt.close( )
+
+def placement_bench( ops= 20000 ):
+	''' replay one trace under each policy: throughput, fragmentation, high water,
+	and locality: how often an allocation lands at or within a page after the one
+	before, and the mean distance in pages '''
+	import time
+	import alloctrace
+	trace= alloctrace.synthetic( 'append', ops )
+	page= mmap.PAGESIZE
+	for placement in ( 'best', 'first', 'next', 'hint' ):
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+		mt.placement= placement
+		mt.grow= 'chunk'
+		mt.growchunk= 1<< 16
+		live, addrs= { }, [ ]
+		highwater= 0
+		start= time.time( )
+		for op, id, size, delta in trace:
+			if op== alloctrace.FREE:
+				mt.free( live.pop( id ) )
+			else:
+				a= live[ id ]= mt.alloc( size )
+				addrs.append( a )
+				highwater= max( highwater, a+ size )
+		elapsed= time.time( )- start
+		near= sum( 0<= b- a< page for a, b in zip( addrs, addrs[ 1: ] ) )
+		jump= sum( abs( b- a )// page for a, b in zip( addrs, addrs[ 1: ] ) )
+		print '%-5s %8.0f ops/sec  fragmentation %.2f  high water %7i  sequential %3.0f%%  mean jump %6.1f pages'% (
+			placement, len( trace )/ elapsed, mt.fragmentation( ), highwater,
+			100.* near/ ( len( addrs )- 1 ), float( jump )/ ( len( addrs )- 1 ) )
+		mt.close( )
+
+def roots_test( ):
+	''' named roots through growth, replacement, deletion, reopening and compaction,
+	at each word width '''
+	import random as ran
+	for word in sorted( packs ):
+		mt= MmapAllocTree.create( 'mappedtree.dat', 60000, word= word )
+		assert mt.get_root( 'index' ) is None and mt.roots( )== [ ]
+		names= [ 'n%i'% i for i in range( 100 ) ]+ [ 'sixteen bytes ok' ]
+		kept= { }
+		for name in names:
+			kept[ name ]= mt.alloc( ran.randint( 5, 50 ) )
+			assert mt.set_root( name, kept[ name ] ) is None
+		assert mt.set_root( 'n5', 123 )== kept[ 'n5' ] and mt.get_root( 'n5' )== 123
+		assert mt.set_root( 'n5', kept[ 'n5' ] )== 123
+		assert not mt.swap_root( 'n6', 1, 2 ) and mt.swap_root( 'n6', kept[ 'n6' ], kept[ 'n6' ] )
+		assert mt.swap_root( 'new', None, kept[ 'n7' ] ) and mt.get_root( 'new' )== kept[ 'n7' ]
+		assert mt.swap_root( 'new', kept[ 'n7' ], None ) and mt.get_root( 'new' ) is None
+		for name in ran.sample( names, 60 ):
+			assert mt.del_root( name )== kept.pop( name )
+			mt.free( mt.alloc( 10 ) )
+		assert mt.del_root( 'n5000' ) is None
+		assert dict( mt.roots( ) )== kept
+		for name in names:
+			assert mt.get_root( name )== kept.get( name )
+		for bad in ( '', 'seventeen bytes!!', 'nul\0' ):
+			try:
+				mt.get_root( bad )
+				assert False
+			except ValueError:
+				pass
+		mt.check_used( )
+		mt.close( )
+		mt= MmapAllocTree.open( 'mappedtree.dat' )
+		assert dict( mt.roots( ) )== kept
+		relocations= mt.compact( )
+		assert dict( mt.roots( ) )== dict( ( name, relocations[ where ] ) for name, where in kept.items( ) )
+		mt.check_used( )
+		mt.close( )
+
+def stats_test( ):
+	''' counters agree between the engines and with the heap, timing comes and goes,
+	and the mirror survives a reopen '''
+	import random as ran
+	seen= [ ]
+	for cls in ( MmapAllocTree, FlatMmapAllocTree ):
+		mt= cls.create( 'mappedtree.dat', 30000 )
+		mt.bins= True
+		mt.statsroot= 'stats' #allocates the mirror, and the directory to name it in
+		assert mt.get_root( 'stats' )
+		live= mt.counts[ 'allocs' ]
+		batch= mt.alloc_many( [ 16 ]* 10 ) #ten allocs, one carve
+		mt.free_many( batch[ ::2 ] )
+		assert mt.counts[ 'allocs' ]== live+ 10 and mt.counts[ 'frees' ]== 5
+		assert sum( mt.sizehist )== mt.counts[ 'allocs' ]
+		mems= batch[ 1::2 ]
+		untimed= mt.counts[ 'allocs' ]
+		r= ran.Random( 0 )
+		mt.timed( every= 3 )
+		assert 'alloc' in mt.__dict__
+		for i in range( 600 ):
+			if mems and r.random( )< 0.45:
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			else:
+				mems.append( mt.alloc( r.randint( 5, 100 ) ) )
+		mt.untimed( )
+		assert 'alloc' not in mt.__dict__ and 'free' not in mt.__dict__
+		mt.flush( ) #mirrors the counters
+		assert mt.mirrored_stats( )[ 'allocs' ]== mt.counts[ 'allocs' ] and mt.mirrored_stats( )[ 'inuse' ]== 0
+		stats= mt.stats( )
+		assert stats[ 'allocs' ]== sum( stats[ 'sizehist' ] )>= len( mems )
+		assert stats[ 'frees' ]== stats[ 'allocs' ]- len( mems )- live
+		assert stats[ 'rotations' ] and stats[ 'searchdepth' ]>= stats[ 'searches' ]> 0
+		assert sum( stats[ 'latency' ][ 'alloc' ] )== ( stats[ 'allocs' ]- untimed+ 2 )// 3
+		assert stats[ 'largestfree' ]<= stats[ 'freebytes' ]
+		used= 0
+		where= mt.mapheadsize
+		while where< mt.size:
+			if mt[ where ].used== 1:
+				used+= mt[ where ].key+ 3* mt.word
+			where= mt[ where ].foot+ mt.word
+		assert stats[ 'inuse' ]== used
+		seen.append( dict( ( name, stats[ name ] ) for name in mt.statnames ) )
+		mt.close( )
+		mt= cls.open( 'mappedtree.dat' )
+		assert mt.mirrored_stats( 'stats' )== seen[ -1 ] and mt.mirrored_stats( ) is None
+		mt.close( )
+	assert seen[ 0 ]== seen[ 1 ], 'engines disagree'
+
+def deferred_test( ):
+	''' deferred frees reuse, drain at the threshold and on a miss, and leave a sound
+	tree, on both engines; a reopened file finds its pending list '''
+	import random as ran
+	for cls in ( MmapAllocTree, FlatMmapAllocTree ):
+		mt= cls.create( 'mappedtree.dat', 30000 )
+		mt.deferred= True
+		mt.pendingmax= 16
+		r= ran.Random( 0 )
+		mems= [ ]
+		for i in range( 1500 ):
+			if mems and ( r.random( )< 0.45 or len( mems )> 150 ):
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			else:
+				try:
+					mems.append( mt.alloc( r.choice( ( 12, 40, 100, 400 ) ) ) )
+				except AllocTree.AllocException:
+					pass
+			assert mt.getI( mt.pendingcountaddr )< mt.pendingmax
+			if i% 100== 0:
+				mt.check_used( )
+		assert mt.counts[ 'reuses' ] and mt.verify( ).pending== mt.getI( mt.pendingcountaddr )
+		pending= mt.getI( mt.pendingcountaddr )
+		mt.close( )
+		mt= cls.open( 'mappedtree.dat' )
+		mt.deferred= True
+		assert mt.getI( mt.pendingcountaddr )== pending
+		for a in mems:
+			mt.free( a )
+		assert mt.getI( mt.pendingcountaddr )
+		try:
+			mt.alloc( mt.size ) #misses, so the pending nodes join the freetree first
+			assert False
+		except AllocTree.AllocException:
+			pass
+		stats= mt.stats( )
+		assert stats[ 'pending' ]== 0 and stats[ 'freenodes' ]== 1
+		mt.check_used( )
+		mt.close( )
+
+def deferred_bench( ops= 20000 ):
+	''' rebalancing work and throughput with and without 'deferred', on churn-heavy
+	traces '''
+	import alloctrace
+	for kind in ( 'append', 'small', 'random' ):
+		trace= alloctrace.synthetic( kind, ops )
+		for deferred in ( False, True ):
+			mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+			mt.deferred= deferred
+			report= alloctrace.replay( trace, mt, every= 0 )
+			stats= mt.stats( )
+			print '%-7s deferred %-5s %8.0f ops/sec  rotations %6i  joins %6i  search steps %7i  reuses %6i'% (
+				kind, deferred, report[ 'opspersec' ], stats[ 'rotations' ], stats[ 'joinprev' ]+ stats[ 'joinnext' ],
+				stats[ 'searchdepth' ], stats[ 'reuses' ] )
+			mt.close( )
+
+def nodecache_test( ):
+	''' the cache changes nothing in the file, through eviction, rollback, and another
+	process's commits '''
+	import random as ran
+	maps= [ ]
+	for nodecache in ( 0, 64 ):
+		mt= MmapAllocTree.create( 'mappedtree.dat', 30000 )
+		mt.enable_journal( 256 )
+		mt.nodecache= nodecache
+		r= ran.Random( 0 )
+		mems= [ ]
+		for i in range( 1000 ):
+			if mems and r.random( )< 0.45:
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			elif mems and r.random( )< 0.1:
+				j= r.randrange( len( mems ) )
+				mems[ j ]= mt.realloc( mems[ j ], r.randint( 5, 200 ) )
+			else:
+				mems.append( mt.alloc( r.randint( 5, 100 ) ) )
+			if i% 250== 0:
+				try:
+					with mt.transaction( ):
+						mt.free( mems[ -1 ] )
+						mt.alloc( 30 )
+						raise KeyError
+				except KeyError:
+					pass
+		assert len( mt._nodes )<= nodecache
+		nodes, where= set( ), mt.mapheadsize
+		while where< mt.size:
+			nodes.add( where )
+			where+= mt.getI( where+ mt.word )+ 3* mt.word
+		for where, header in mt._nodes.items( ): #a header from before a join may stay, unused
+			real= list( mt.packheader.unpack_from( mt.map, where ) )
+			assert where not in nodes or real[ :2 ]== header[ :2 ] and ( real[ 0 ] or real== header[ :6 ] ), where
+		if nodecache: #written through, not decoded again
+			node= mt[ mt.root ]
+			key, balance, misses= node.key, node.balance, mt.nodemisses
+			node.key, node.balance= key+ 1, -balance
+			assert ( node.key, node.balance, mt.nodemisses )== ( key+ 1, -balance, misses )
+			node.key, node.balance= key, balance
+		mt.check_used( )
+		other= MmapAllocTree.open( 'mappedtree.dat' )
+		for a in mems[ :20 ]:
+			other.free( a )
+		mems[ :20 ]= [ other.alloc( 50 ) for i in range( 20 ) ]
+		other.close( )
+		for a in mems:
+			mt.free( a )
+		mt.disable_journal( )
+		mt.check_used( )
+		assert mt.list_io( )== [ mt.size- mt.mapheadsize- 3* mt.word ]
+		maps.append( mt.map[ : ] )
+		mt.close( )
+	assert maps[ 0 ]== maps[ 1 ], 'the cache changed the file'
+
+def nodecache_bench( ops= 20000, sizes= ( 0, 64, 1024, 16384 ), rounds= 5 ):
+	''' Node engine throughput, the best of 'rounds', and headers decoded, by cache
+	size.  with no cache, every field read decodes a word '''
+	import alloctrace
+	trace= alloctrace.synthetic( 'random', ops )
+	for nodecache in sizes:
+		rates= [ ]
+		for i in range( rounds ):
+			mt= MmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+			mt.nodecache= nodecache
+			rates.append( alloctrace.replay( trace, mt, every= 0 )[ 'opspersec' ] )
+			decodes= mt.nodemisses
+			mt.close( )
+		print 'nodecache %5i %8.0f ops/sec  decodes %8i'% ( nodecache, max( rates ), decodes )
+
+def addressed_test( ):
+	''' the address index through each placement, range allocation, rollback,
+	compaction and reopening, on both engines, which must agree '''
+	import random as ran
+	def walk( mt ): #free nodes and the end of the last used one, the long way
+		word= mt.word
+		free, where, high= [ ], mt.mapheadsize, mt.mapheadsize
+		while where< mt.size:
+			used, key= mt.getI( where ), mt.getI( where+ word )
+			if used:
+				high= where+ key+ 3* word
+			else:
+				free.append( ( where+ 2* word, key ) )
+			where+= key+ 3* word
+		return free, high
+	maps= [ ]
+	for cls in MmapAllocTree, FlatMmapAllocTree:
+		r= ran.Random( 1 )
+		mt= cls.create( 'mappedtree.dat', 60000, addressed= True )
+		word= mt.word
+		assert mt.addressed and mt.minkey== 9* word
+		mt.enable_journal( 1024 )
+		mems= [ ]
+		for i in range( 1200 ):
+			mt.placement= ( 'best', 'first', 'next', 'hint' )[ i// 300 ]
+			if mems and r.random( )< 0.4:
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+				continue
+			size= r.randint( 5, 100 )
+			key= max( size, mt.minkey )
+			fits= list( mt._where_all_gte( key ) )
+			rover= mt.getI( mt.roveraddr )
+			a= mt.alloc( size )- 2* word
+			if mt.placement== 'first':
+				assert a== min( fits )
+			elif mt.placement== 'next':
+				assert a== min( [ where for where in fits if where>= rover ] or fits )
+			mems.append( a+ 2* word )
+			if i% 100== 0:
+				mt.check_used( )
+				free, high= walk( mt )
+				assert mt.free_extents( )== free and mt.highwater( )== high
+				lo, hi= r.randrange( mt.size ), r.randrange( mt.size )
+				assert mt.free_extents( lo, hi )== [ ( b, key ) for b, key in free if b< hi and b+ key> lo ]
+		for i in range( 200 ):
+			lo= r.randrange( mt.mapheadsize, mt.size )
+			hi, size= lo+ r.randint( 0, 2000 ), r.randint( 5, 100 )
+			try:
+				a= mt.alloc_within( size, lo, hi )
+			except AllocTree.AllocException:
+				for b, key in mt.free_extents( lo, hi ):
+					first= b if b>= lo else max( lo, b+ mt.minkey+ 3* word )
+					assert first+ max( size, mt.minkey )> min( b+ key, hi )
+				continue
+			assert lo<= a and a+ size<= hi and mt[ a- 2* word ].used== 1
+			mems.append( a )
+		mt.check_used( )
+		try:
+			with mt.transaction( ):
+				for a in mems[ :5 ]:
+					mt.free( a )
+				mt.alloc_within( 100, mt.mapheadsize, mt.size )
+				raise KeyError
+		except KeyError:
+			pass
+		mt.check_used( )
+		other= cls.open( 'mappedtree.dat' )
+		assert other.addressed and other.free_extents( )== mt.free_extents( )
+		other.close( )
+		relocations= mt.compact( )
+		mems= [ relocations[ a ] for a in mems ]
+		mt.check_used( )
+		assert mt.highwater( )== walk( mt )[ 1 ]
+		assert mt.free_extents( )[ -1 ][ 0 ]== mt.highwater( )+ 2* word
+		for a in mems:
+			mt.free( a )
+		mt.disable_journal( )
+		mt.check_used( )
+		assert mt.highwater( )== mt.mapheadsize
+		maps.append( mt.map[ : ] )
+		mt.close( )
+	assert maps[ 0 ]== maps[ 1 ], 'engines disagree'
+	mt= MmapAllocTree.create( 'mappedtree.dat', 4096 )
+	try:
+		mt.highwater( )
+		assert False
+	except ValueError:
+		pass
+	mt.close( )
+
+def addressed_bench( holes= 4000, rounds= 2000 ):
+	''' on a heap of 'holes' free nodes between used ones: a 'first' fit allocation
+	and its free, then a list of the free nodes in a page, each by walking every free
+	node and by the address index '''
+	import time
+	for addressed in False, True:
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 22, addressed= addressed )
+		mt.placement= 'first'
+		word= mt.word
+		mems= [ mt.alloc( 100 ) for i in range( 2* holes ) ]
+		for a in mems[ ::2 ]:
+			mt.free( a )
+		start= time.time( )
+		for i in range( rounds ):
+			mt.free( mt.alloc( 100 ) )
+		allocs= rounds/ ( time.time( )- start )
+		start= time.time( )
+		for i in range( rounds// 10 ):
+			lo= mems[ i* 7% len( mems ) ]
+			if addressed:
+				mt.free_extents( lo, lo+ mmap.PAGESIZE )
+			else:
+				sorted( ( where+ 2* word, mt.getI( where+ word ) ) for where in mt._where_all_gte( 0 )
+					if where< lo+ mmap.PAGESIZE and where+ 2* word+ mt.getI( where+ word )> lo )
+		queries= rounds// 10/ ( time.time( )- start )
+		print 'addressed %-5s %8.0f allocs+frees/sec  %8.0f range queries/sec'% ( addressed, allocs, queries )
+		mt.close( )
+
+def page_test( ):
+	''' 'align' and 'no_cross_page' place what they say, best fit picks the smallest
+	node with room, and the gaps go back whole, under each placement and with growth '''
+	import random as ran
+	r= ran.Random( 2 )
+	for cls, addressed, placement in ( MmapAllocTree, False, 'best' ), ( FlatMmapAllocTree, False, 'best' ), \
+			( MmapAllocTree, True, 'first' ), ( FlatMmapAllocTree, False, 'hint' ):
+		mt= cls.create( 'mappedtree.dat', 1<< 15, addressed= addressed )
+		mt.placement, mt.grow, mt.bins= placement, 'geometric', True
+		word, page= mt.word, mt.pagesize
+		mems= [ ]
+		for i in range( 1500 ):
+			if mems and r.random( )< 0.4:
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+				continue
+			size= r.choice( ( r.randint( 1, 100 ), r.randint( 100, 2000 ), r.randint( page, 2* page ) ) )
+			align, no_cross_page= r.choice( ( None, word, 64, 4096 ) ), r.random( )< 0.5
+			if not align and not no_cross_page:
+				no_cross_page= True
+			key= max( size, mt.minkey )
+			place= align or 1, page if no_cross_page and key<= page else 0
+			if no_cross_page and key> page:
+				place= max( place[ 0 ], page ), 0
+			fits= dict( ( where, mt.getI( where+ word ) ) for where in mt._where_all_gte( key )
+				if mt._fit( where, key, place ) is not None )
+			a= mt.alloc( size, align= align, no_cross_page= no_cross_page )
+			mems.append( a )
+			if align:
+				assert a% align== 0, ( a, align )
+			if no_cross_page:
+				if key<= page:
+					assert a// page== ( a+ key- 1 )// page, ( a, key )
+				else:
+					assert a% page== 0
+			if placement== 'best' and fits:
+				where= max( where for where in fits if where< a )
+				assert fits[ where ]== min( fits.values( ) ) and a+ key<= where+ 2* word+ fits[ where ]
+			if i% 250== 0:
+				mt.check_used( )
+		mt.check_used( )
+		for a in mems:
+			mt.free( a )
+		mt.flush_bins( )
+		mt.check_used( )
+		assert mt.list_io( )== [ mt.size- mt.mapheadsize- 3* word ]
+		mt.close( )
+
+def page_bench( records= 20000, sizes= ( 16, 400 ), updates= 200, rounds= 50 ):
+	''' records of 'sizes' bytes, allocated plain and 'no_cross_page', then rewritten
+	at random, 'updates' a round, on a fresh mapping each round: records that
+	straddle a page, minor page faults per update, and bytes 'flush' writes back per
+	round: the mapping's dirty bytes just before it, read from /proc/self/smaps, or
+	estimated from the pages the updates touch where there is no smaps '''
+	import os
+	import random
+	import resource
+	def dirtied( path ):
+		''' dirty bytes in the mappings of 'path', or None without smaps '''
+		if not os.path.exists( '/proc/self/smaps' ):
+			return None
+		total, mine= 0, False
+		for line in open( '/proc/self/smaps' ):
+			fields= line.split( )
+			if not fields[ 0 ].endswith( ':' ):
+				mine= fields[ -1 ]== path
+			elif mine and fields[ 0 ] in ( 'Shared_Dirty:', 'Private_Dirty:' ):
+				total+= int( fields[ 1 ] )* 1024
+		return total
+	path= os.path.abspath( 'mappedtree.dat' )
+	for no_cross_page in False, True:
+		ran= random.Random( 0 )
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+		mt.grow= 'geometric'
+		page= mt.pagesize
+		mems= [ ]
+		for i in range( records ):
+			size= ran.randint( *sizes )
+			mems.append( ( mt.alloc( size, no_cross_page= no_cross_page ), size ) )
+		straddle= sum( a// page!= ( a+ size- 1 )// page for a, size in mems )
+		mt.flush( )
+		faults= dirty= 0
+		measured= True
+		for i in range( rounds ):
+			mt.remap( ) #unmapped pages fault again on first touch
+			batch= ran.sample( mems, updates )
+			before= resource.getrusage( resource.RUSAGE_SELF ).ru_minflt
+			for a, size in batch:
+				mt.map[ a: a+ size ]= 'x'* size
+			faults+= resource.getrusage( resource.RUSAGE_SELF ).ru_minflt- before
+			nbytes= dirtied( path )
+			if nbytes is None:
+				measured= False
+				nbytes= len( set( p for a, size in batch for p in range( a// page, ( a+ size- 1 )// page+ 1 ) ) )* page
+			dirty+= nbytes
+			mt.map.flush( )
+		print 'no_cross_page %-5s straddling %5.2f%%  faults/update %.3f  flushed %8i bytes/round%s  file %8i'% (
+			no_cross_page, 100.* straddle/ records, float( faults )/ ( rounds* updates ), dirty// rounds,
+			'' if measured else ' (estimated)', mt.size )
+		mt.close( )
+
+def batch_bench( count= 2000, rounds= 10 ):
+	''' time a loop of alloc/free against alloc_many/free_many '''
+	import random as ran
+	import time
+	sizes= [ ran.randint( 5, 100 ) for i in range( count ) ]
+	for batched in ( False, True ):
+		mt= FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 20 )
+		start= time.time( )
+		for i in range( rounds ):
+			if batched:
+				mems= mt.alloc_many( sizes )
+				mt.free_many( mems )
+			else:
+				mems= [ mt.alloc( size ) for size in sizes ]
+				for a in mems:
+					mt.free( a )
+		elapsed= time.time( )- start
+		print 'batched %-5s %8.0f allocs+frees/sec'% ( batched, rounds* count/ elapsed )
+		mt.close( )
+
+def word_bench( ops= 20000, size= 60000 ):
+	''' alloc/free throughput at each word width.  the same seeded sequence of
+	requests runs against a fresh file per width; 'size' stays under 64 KiB so that
+	16-bit files can take part. '''
+	import random as ran
+	import time
+	for word in sorted( packs ):
+		mt= MmapAllocTree.create( 'mappedtree.dat', size, word= word )
+		r= ran.Random( 0 )
+		mems= [ ]
+		start= time.time( )
+		for count in range( ops ):
+			if mems and ( r.choice( ( 0, 1 ) ) or len( mems )> 200 ):
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			else:
+				try:
+					mems.append( mt.alloc( r.randint( 5, 100 ) ) )
+				except AllocTree.AllocException:
+					pass
+		elapsed= time.time( )- start
+		print '%2i-bit: %8.0f ops/sec'% ( 8* word, ops/ elapsed )
+		mt.close( )
+
+def engine_bench( ops= 20000, size= 60000 ):
+	''' alloc/free per second of the Node engine against the flat engine, on the same
+	seeded requests.  the two files must come out byte-identical. '''
+	import random as ran
+	import time
+	maps= [ ]
+	for cls in ( MmapAllocTree, FlatMmapAllocTree ):
+		mt= cls.create( 'mappedtree.dat', size )
+		r= ran.Random( 0 )
+		mems= [ ]
+		start= time.time( )
+		for count in range( ops ):
+			if mems and ( r.choice( ( 0, 1 ) ) or len( mems )> 200 ):
+				mt.free( mems.pop( r.randrange( len( mems ) ) ) )
+			else:
+				try:
+					mems.append( mt.alloc( r.randint( 5, 100 ) ) )
+				except AllocTree.AllocException:
+					pass
+		elapsed= time.time( )- start
+		print '%-18s %8.0f ops/sec'% ( cls.__name__, ops/ elapsed )
+		maps.append( mt.map[ : ] )
+		mt.close( )
+	assert maps[ 0 ]== maps[ 1 ], 'engines disagree'
+	print 'files identical'
 
 if __name__ == '__main__':
 	debug= 1
@@ -952,5 +3918,27 @@ if __name__ == '__main__':
 		useful_test( )
 	elif debug == 1:
 		stress()
+	elif debug == 2:
+		word_bench( )
+	elif debug == 3:
+		engine_bench( )
+	elif debug == 4:
+		bins_bench( )
+	elif debug == 5:
+		slab_bench( )
+	elif debug == 6:
+		batch_bench( )
+	elif debug == 7:
+		cache_bench( )
+	elif debug == 8:
+		placement_bench( )
+	elif debug == 9:
+		deferred_bench( )
+	elif debug == 10:
+		nodecache_bench( )
+	elif debug == 11:
+		addressed_bench( )
+	elif debug == 12:
+		page_bench( )
 	else:
 		print 'bad debug value'
@@ -0,0 +1,267 @@
+'''
+Recording and replay of allocator traffic, for comparing configurations of
+'allocbuf' trees on the same work.
+
+A 'Recorder' stands in front of a tree and logs each 'alloc', 'free' and 'realloc'
+to a trace file.  'replay' runs a trace against any tree, or an 'AllocCache' in
+front of one, as fast as it will go, and reports throughput, latency percentiles,
+peak footprint, fragmentation over time, and the size the file reached.  'suite'
+replays the standard traces against the standard configurations; it is the
+regression benchmark for the project.
+
+Allocations are named in a trace by id, not offset, so that a trace replays
+against any layout.
+'''
+
+'''
+Trace file:
+magic     'ATR1'
+records   op, id, size, microseconds since the record before; '<BIII', 13 bytes
+'op' is ALLOC, FREE or REALLOC.  'size' is 0 for FREE.
+'''
+
+import array
+import struct
+import time
+import allocbuf
+
+ALLOC, FREE, REALLOC= 1, 2, 3
+opnames= { ALLOC: 'alloc', FREE: 'free', REALLOC: 'realloc' }
+magic= 'ATR1'
+packrecord= struct.Struct( '<BIII' )
+timer= time.time
+
+class Recorder( object ):
+	''' logs the calls made through it to 'file', then passes them to 'tree'.  other
+	attributes are the tree's. '''
+	def __init__( self, tree, file ):
+		self.tree= tree
+		self.f= open( file, 'wb' )
+		self.f.write( magic )
+		self.ids= { } #offset to id
+		self.nextid= 0
+		self.last= timer( )
+	def _write( self, op, id, size ):
+		now= timer( )
+		delta= min( int( ( now- self.last )* 1e6 ), 0xffffffff )
+		self.last= now
+		self.f.write( packrecord.pack( op, id, size, delta ) )
+	def alloc( self, size, *args ):
+		where= self.tree.alloc( size, *args )
+		self.ids[ where ]= id= self.nextid
+		self.nextid+= 1
+		self._write( ALLOC, id, size )
+		return where
+	def free( self, where ):
+		self.tree.free( where )
+		self._write( FREE, self.ids.pop( where ), 0 )
+	def realloc( self, where, size ):
+		new= self.tree.realloc( where, size )
+		self.ids[ new ]= id= self.ids.pop( where )
+		self._write( REALLOC, id, size )
+		return new
+	def close( self ):
+		self.f.close( )
+	def __getattr__( self, name ):
+		return getattr( self.tree, name )
+
+def write( file, trace ):
+	''' save a list of ( op, id, size, delta ) '''
+	with open( file, 'wb' ) as f:
+		f.write( magic )
+		for record in trace:
+			f.write( packrecord.pack( *record ) )
+
+def read( file ):
+	''' load a trace as a list of ( op, id, size, delta ) '''
+	with open( file, 'rb' ) as f:
+		data= f.read( )
+	if data[ :len( magic ) ]!= magic:
+		raise ValueError( '%s is not a trace'% file )
+	size= packrecord.size
+	return [ packrecord.unpack_from( data, offt )
+		for offt in range( len( magic ), len( data )- size+ 1, size ) ]
+
+def synthetic( kind, ops, seed= 0 ):
+	''' a trace of about 'ops' records; 'kind' is:
+	'random'  allocs of 5 to 100 bytes, frees and reallocs at random, as 'stress' did
+	'append'  records arriving in bursts of like size, older ones expiring at random
+	'small'   churn of 1 to 15 word allocations, for the bins and caches '''
+	import random
+	ran= random.Random( seed )
+	trace, live, id= [ ], [ ], 0
+	while len( trace )< ops:
+		if kind== 'random':
+			r= ran.random( )
+			if live and ( r< 0.4 or len( live )> 100 ):
+				trace.append( ( FREE, live.pop( ran.randrange( len( live ) ) ), 0, 0 ) )
+			elif live and r< 0.5:
+				trace.append( ( REALLOC, ran.choice( live ), ran.randint( 5, 100 ), 0 ) )
+			else:
+				trace.append( ( ALLOC, id, ran.randint( 5, 100 ), 0 ) )
+				live.append( id )
+				id+= 1
+		elif kind== 'append':
+			if len( live )> 1000 or live and ran.random( )< 0.4:
+				trace.append( ( FREE, live.pop( ran.randrange( len( live )// 2+ 1 ) ), 0, 0 ) )
+			else:
+				size= ran.choice( ( 24, 40, 64, 100, 200 ) )
+				for i in range( ran.randint( 1, 8 ) ):
+					trace.append( ( ALLOC, id, size+ ran.randint( 0, 8 ), 0 ) )
+					live.append( id )
+					id+= 1
+		elif kind== 'small':
+			if len( live )> 2000 or live and ran.random( )< 0.5:
+				trace.append( ( FREE, live.pop( ran.randrange( len( live ) ) ), 0, 0 ) )
+			else:
+				trace.append( ( ALLOC, id, 4* ran.randint( 1, 15 ), 0 ) )
+				live.append( id )
+				id+= 1
+		else:
+			raise ValueError( 'unknown trace kind %r'% kind )
+	return trace
+
+def _percentile( sorted_, p ):
+	if not sorted_:
+		return 0.
+	return sorted_[ min( int( p* len( sorted_ ) ), len( sorted_ )- 1 ) ]
+
+def replay( trace, target, every= 1000, check= 0 ):
+	''' run 'trace' against 'target', a tree or an 'AllocCache'.  allocations that
+	do not fit are counted and their later calls skipped.  samples fragmentation and
+	size every 'every' records, and runs 'check_used' every 'check' records if set.
+	returns a dict:
+		ops, seconds, opspersec, failed
+		latency: per op name, and 'all', a dict of p50, p90, p99, p999 and max seconds
+		peaklive: most bytes requested and not freed at once
+		highwater: furthest end of an allocation
+		size: final size of the buffer
+		fragmentation: final 'fragmentation'
+		samples: list of ( record index, fragmentation, size ) '''
+	tree= getattr( target, 'tree', target )
+	alloc, free= target.alloc, target.free
+	realloc= getattr( target, 'realloc', None )
+	offsets, sizes= { }, { }
+	latencies= dict( ( op, array.array( 'd' ) ) for op in opnames )
+	live= peaklive= highwater= failed= 0
+	samples= [ ]
+	started= timer( )
+	for i, ( op, id, size, delta ) in enumerate( trace ):
+		if op!= ALLOC and id not in offsets: #its alloc failed
+			continue
+		start= timer( )
+		try:
+			if op== ALLOC:
+				where= alloc( size )
+			elif op== FREE:
+				free( offsets[ id ] )
+			elif realloc:
+				where= realloc( offsets[ id ], size )
+			else:
+				where= alloc( size )
+				free( offsets[ id ] )
+		except allocbuf.AllocTree.AllocException:
+			failed+= 1
+			continue
+		latencies[ op ].append( timer( )- start )
+		if op== FREE:
+			del offsets[ id ]
+			live-= sizes.pop( id )
+		else:
+			live+= size- sizes.get( id, 0 )
+			offsets[ id ], sizes[ id ]= where, size
+			peaklive= max( peaklive, live )
+			highwater= max( highwater, where+ size )
+		if every and i% every== 0:
+			samples.append( ( i, tree.fragmentation( ), tree.size ) )
+		if check and i% check== 0:
+			tree.check_used( )
+	seconds= timer( )- started
+	latency= { }
+	everything= sum( latencies.values( ), array.array( 'd' ) )
+	for op, times in latencies.items( )+ [ ( 'all', everything ) ]:
+		times= sorted( times )
+		latency[ opnames.get( op, op ) ]= dict( p50= _percentile( times, .5 ),
+			p90= _percentile( times, .9 ), p99= _percentile( times, .99 ),
+			p999= _percentile( times, .999 ), max= times[ -1 ] if times else 0. )
+	return dict( ops= len( trace ), seconds= seconds, opspersec= len( trace )/ ( seconds or 1e-9 ),
+		failed= failed, latency= latency, peaklive= peaklive, highwater= highwater,
+		size= tree.size, fragmentation= tree.fragmentation( ), samples= samples )
+
+def show( name, report ):
+	''' one line of a report '''
+	latency= report[ 'latency' ][ 'all' ]
+	print '%-18s %8.0f ops/sec  p50 %5.1f p99 %6.1f max %7.1f us  peak %8i  high %8i  size %8i  frag %.2f  failed %i'% (
+		name, report[ 'opspersec' ], latency[ 'p50' ]* 1e6, latency[ 'p99' ]* 1e6, latency[ 'max' ]* 1e6,
+		report[ 'peaklive' ], report[ 'highwater' ], report[ 'size' ], report[ 'fragmentation' ],
+		report[ 'failed' ] )
+
+def _configurations( ):
+	''' name, and a function of a file name giving a fresh target '''
+	def make( cls= allocbuf.FlatMmapAllocTree, word= 4, **attrs ):
+		def create( file ):
+			mt= cls.create( file, 1<< 16, word= word )
+			mt.grow, mt.growchunk= 'chunk', 1<< 16
+			for name, val in attrs.items( ):
+				setattr( mt, name, val )
+			return mt
+		return create
+	def cached( file ):
+		return allocbuf.AllocCache( make( )( file ) )
+	return [ ( 'tree w4', make( cls= allocbuf.MmapAllocTree ) ),
+		( 'flat w4', make( ) ),
+		( 'flat w8', make( word= 8 ) ),
+		( 'flat w4 next', make( placement= 'next' ) ),
+		( 'flat w4 bins', make( bins= True ) ),
+		( 'flat w4 cache', cached ) ]
+
+def suite( ops= 20000, file= 'mappedtree.dat', traces= ( 'random', 'append', 'small' ) ):
+	''' replay each standard trace against each standard configuration '''
+	for kind in traces:
+		trace= synthetic( kind, ops )
+		print '%s, %i records'% ( kind, len( trace ) )
+		for name, create in _configurations( ):
+			target= create( file )
+			show( name, replay( trace, target ) )
+			getattr( target, 'tree', target ).close( )
+
+def trace_test( ):
+	''' a recorded session replays to the same offsets on a like tree '''
+	import random as ran
+	mt= allocbuf.MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	rec= Recorder( mt, 'mappedtree.trc' )
+	mems= [ ]
+	for i in range( 500 ):
+		if mems and ran.random( )< 0.4:
+			rec.free( mems.pop( ran.randrange( len( mems ) ) ) )
+		elif mems and ran.random( )< 0.2:
+			j= ran.randrange( len( mems ) )
+			mems[ j ]= rec.realloc( mems[ j ], ran.randint( 5, 100 ) )
+		else:
+			mems.append( rec.alloc( ran.randint( 5, 100 ) ) )
+	rec.close( )
+	expected= sorted( mems )
+	mt.close( )
+	trace= read( 'mappedtree.trc' )
+	assert len( trace )== 500 and all( op in opnames for op, id, size, delta in trace )
+	mt= allocbuf.MmapAllocTree.create( 'mappedtree.dat', 30000 )
+	report= replay( trace, mt, every= 50, check= 25 )
+	assert report[ 'failed' ]== 0 and len( report[ 'samples' ] )== 10
+	assert report[ 'highwater' ]<= report[ 'size' ]
+	ids= { }
+	for op, id, size, delta in trace:
+		if op== FREE:
+			ids.pop( id )
+		else:
+			ids[ id ]= size
+	assert report[ 'peaklive' ]>= sum( ids.values( ) )
+	used, where, word= [ ], mt.mapheadsize, mt.word
+	while where< mt.size:
+		if mt[ where ].used:
+			used.append( where+ 2* word )
+		where= mt[ where ].foot+ word
+	assert used== expected
+	mt.close( )
+
+if __name__ == '__main__':
+	suite( )
@@ -0,0 +1,403 @@
+'''
+An ordered index of fixed-size string keys to word values, kept as a B+tree in an
+'allocbuf' file and found again by name through the file's roots.
+
+Each node is one page of the file, aligned to it, so a lookup reads one page per
+level, and a level holds a couple of hundred keys rather than the freetree's one.
+Leaves are linked left to right, for range scans.  Keys are ordered by 'compare',
+which a subclass may replace, as on 'BufferTree'.  Values are words, usually the
+offset of a record allocated from the same tree.
+'''
+
+'''
+Index structure:
+root      root node
+first     leftmost leaf
+count     keys
+keysize   bytes per key slot
+pagesize  bytes per node, and their alignment
+height    levels; 1 for a lone leaf
+
+Node structure, a page less the node head and foot:
+leaf      1 for a leaf, 0 for a branch
+count     keys in use
+next      leaf to the right, or 0
+keys      'order' slots of 'keysize' bytes, padded with NUL
+values    leaf: 'order' words, the value of each key.  branch: 'order'+ 1 words, the
+          children; the one after key i holds the keys from key i up
+'''
+
+import mmap
+import struct
+import allocbuf
+
+class BPlusTree( object ):
+	''' index in 'tree', an MmapAllocTree, under root 'name'.  'keysize' and
+	'pagesize' are fixed when it is made.  keys are str of up to 'keysize' bytes, not
+	ending in NUL.  each change is one transaction of the tree.  deletes do not merge
+	nodes; 'bulk_load' into a fresh index packs them. '''
+	def __init__( self, tree, name= 'bptree', keysize= 16, pagesize= mmap.PAGESIZE ):
+		self.tree= tree
+		self.word= word= tree.word
+		with tree.transaction( ):
+			head= tree.get_root( name )
+			if head is None:
+				head= tree.alloc( 6* word )
+				tree.setI( head+ 3* word, keysize )
+				tree.setI( head+ 4* word, pagesize )
+				self._geometry( keysize, pagesize )
+				root= self._newnode( True )
+				tree.setI( head, root )
+				tree.setI( head+ word, root )
+				tree.setI( head+ 2* word, 0 )
+				tree.setI( head+ 5* word, 1 )
+				tree.set_root( name, head )
+		self.head= head
+		self._geometry( tree.getI( head+ 3* word ), tree.getI( head+ 4* word ) )
+
+	def _geometry( self, keysize, pagesize ):
+		word= self.word
+		self.keysize, self.pagesize= keysize, pagesize
+		self.nodesize= pagesize- 3* word
+		self.order= ( self.nodesize- 4* word )// ( keysize+ word )
+		if self.order< 3:
+			raise ValueError( 'pages of %i bytes hold too few keys of %i bytes'% ( pagesize, keysize ) )
+		self.keybase= 3* word
+		self.valbase= 3* word+ self.order* keysize
+
+	def compare( self, key1, key2 ):
+		if key1< key2:
+			return -1
+		if key1== key2:
+			return 0
+		return 1
+
+	def _newnode( self, leaf ):
+		''' a fresh, empty, page-aligned node '''
+		tree, word= self.tree, self.word
+		with tree.transaction( ):
+			node= tree._alloc_aligned( self.nodesize, self.pagesize )
+		tree.map[ node: node+ 3* word ]= tree.packI.pack( 1 if leaf else 0 )+ '\0'* 2* word
+		return node
+
+	def _pad( self, key ):
+		if len( key )> self.keysize or key.endswith( '\0' ) or not key:
+			raise ValueError( 'keys are 1 to %i bytes, not ending in NUL, not %r'% ( self.keysize, key ) )
+		return key.ljust( self.keysize, '\0' )
+
+	def _key( self, node, i ):
+		offt= node+ self.keybase+ i* self.keysize
+		return self.tree.map[ offt: offt+ self.keysize ].rstrip( '\0' )
+
+	def _search( self, node, key, upper ):
+		''' first slot whose key is greater than 'key', or if not 'upper', not less '''
+		lo, hi= 0, self.tree.getI( node+ self.word )
+		compare= self.compare
+		while lo< hi:
+			mid= ( lo+ hi )// 2
+			c= compare( self._key( node, mid ), key )
+			if c< 0 or upper and c== 0:
+				lo= mid+ 1
+			else:
+				hi= mid
+		return lo
+
+	def _path( self, key ):
+		''' branches above the leaf for 'key', as ( node, child index ), and the leaf '''
+		getI, word= self.tree.getI, self.word
+		node, path= getI( self.head ), [ ]
+		while not getI( node ):
+			i= self._search( node, key, True )
+			path.append( ( node, i ) )
+			node= getI( node+ self.valbase+ i* word )
+		return path, node
+
+	def _leaf( self, key ):
+		''' leaf for 'key', and the slot it has or would have there, and whether it has '''
+		path, leaf= self._path( key )
+		i= self._search( leaf, key, False )
+		found= i< self.tree.getI( leaf+ self.word ) and self.compare( self._key( leaf, i ), key )== 0
+		return path, leaf, i, found
+
+	def __getitem__( self, key ):
+		self._pad( key )
+		with self.tree.locked( ):
+			path, leaf, i, found= self._leaf( key )
+			if not found:
+				raise KeyError( key )
+			return self.tree.getI( leaf+ self.valbase+ i* self.word )
+
+	def get( self, key, default= None ):
+		try:
+			return self[ key ]
+		except KeyError:
+			return default
+
+	def __contains__( self, key ):
+		return self.get( key ) is not None
+
+	def __len__( self ):
+		return self.tree.getI( self.head+ 2* self.word )
+
+	def height( self ):
+		return self.tree.getI( self.head+ 5* self.word )
+
+	def __setitem__( self, key, value ):
+		tree, word= self.tree, self.word
+		padded= self._pad( key )
+		with tree.transaction( ):
+			path, leaf, i, found= self._leaf( key )
+			if found:
+				tree.setI( leaf+ self.valbase+ i* word, value )
+				return
+			split= self._insert( leaf, i, padded, value )
+			while split:
+				sep, right= split
+				if not path:
+					root= self._newnode( False )
+					tree.setI( root+ word, 1 )
+					tree.setB( root+ self.keybase, sep )
+					tree.setI( root+ self.valbase, tree.getI( self.head ) )
+					tree.setI( root+ self.valbase+ word, right )
+					tree.setI( self.head, root )
+					tree.setI( self.head+ 5* word, tree.getI( self.head+ 5* word )+ 1 )
+					break
+				node, i= path.pop( )
+				split= self._insert( node, i, sep, right )
+			tree.setI( self.head+ 2* word, tree.getI( self.head+ 2* word )+ 1 )
+
+	def _shiftin( self, node, i, key, value ):
+		''' put 'key' in slot 'i' of a node with room, and 'value' with it, or for a
+		branch, after it '''
+		tree, word, keysize= self.tree, self.word, self.keysize
+		count= tree.getI( node+ word )
+		v= i if tree.getI( node ) else i+ 1
+		vcount= count if tree.getI( node ) else count+ 1
+		keys, vals= node+ self.keybase, node+ self.valbase
+		if i< count:
+			tree.setB( keys+ ( i+ 1 )* keysize, tree.getB( keys+ i* keysize, ( count- i )* keysize ) )
+		if v< vcount:
+			tree.setB( vals+ ( v+ 1 )* word, tree.getB( vals+ v* word, ( vcount- v )* word ) )
+		tree.setB( keys+ i* keysize, key )
+		tree.setI( vals+ v* word, value )
+		tree.setI( node+ word, count+ 1 )
+
+	def _insert( self, node, i, key, value ):
+		''' '_shiftin', splitting a full node first.  returns None, or the key and new
+		node to add to the parent '''
+		tree, word, keysize, order= self.tree, self.word, self.keysize, self.order
+		count= tree.getI( node+ word )
+		if count< order:
+			self._shiftin( node, i, key, value )
+			return None
+		leaf= tree.getI( node )
+		right= self._newnode( leaf )
+		keys, vals= node+ self.keybase, node+ self.valbase
+		rkeys, rvals= right+ self.keybase, right+ self.valbase
+		map= tree.map
+		if leaf:
+			half= ( count+ 1 )// 2
+			map[ rkeys: rkeys+ ( count- half )* keysize ]= map[ keys+ half* keysize: keys+ count* keysize ]
+			map[ rvals: rvals+ ( count- half )* word ]= map[ vals+ half* word: vals+ count* word ]
+			tree.packI.pack_into( map, right+ word, count- half )
+			tree.packI.pack_into( map, right+ 2* word, tree.getI( node+ 2* word ) )
+			tree.setI( node+ word, half )
+			tree.setI( node+ 2* word, right )
+			if i< half:
+				self._shiftin( node, i, key, value )
+			else:
+				self._shiftin( right, i- half, key, value )
+			sep= tree.getB( rkeys, keysize )
+		else:
+			mid= count// 2
+			sep= tree.getB( keys+ mid* keysize, keysize )
+			map[ rkeys: rkeys+ ( count- mid- 1 )* keysize ]= map[ keys+ ( mid+ 1 )* keysize: keys+ count* keysize ]
+			map[ rvals: rvals+ ( count- mid )* word ]= map[ vals+ ( mid+ 1 )* word: vals+ ( count+ 1 )* word ]
+			tree.packI.pack_into( map, right+ word, count- mid- 1 )
+			tree.setI( node+ word, mid )
+			if i<= mid:
+				self._shiftin( node, i, key, value )
+			else:
+				self._shiftin( right, i- mid- 1, key, value )
+		return sep, right
+
+	def __delitem__( self, key ):
+		tree, word, keysize= self.tree, self.word, self.keysize
+		self._pad( key )
+		with tree.transaction( ):
+			path, leaf, i, found= self._leaf( key )
+			if not found:
+				raise KeyError( key )
+			count= tree.getI( leaf+ word )
+			keys, vals= leaf+ self.keybase, leaf+ self.valbase
+			if i+ 1< count:
+				tree.setB( keys+ i* keysize, tree.getB( keys+ ( i+ 1 )* keysize, ( count- i- 1 )* keysize ) )
+				tree.setB( vals+ i* word, tree.getB( vals+ ( i+ 1 )* word, ( count- i- 1 )* word ) )
+			tree.setI( leaf+ word, count- 1 )
+			tree.setI( self.head+ 2* word, tree.getI( self.head+ 2* word )- 1 )
+
+	def range( self, lo= None, hi= None ):
+		''' ( key, value ) in order, from 'lo' up to but not including 'hi'; None for
+		either end.  reads a leaf at a time under the lock. '''
+		tree, word, compare= self.tree, self.word, self.compare
+		with tree.locked( ):
+			if lo is None:
+				leaf, i= tree.getI( self.head+ word ), 0
+			else:
+				path, leaf, i, found= self._leaf( lo )
+		while leaf:
+			with tree.locked( ):
+				count= tree.getI( leaf+ word )
+				items= [ ( self._key( leaf, j ), tree.getI( leaf+ self.valbase+ j* word ) )
+					for j in xrange( i, count ) ]
+				leaf, i= tree.getI( leaf+ 2* word ), 0
+			for key, value in items:
+				if hi is not None and compare( key, hi )>= 0:
+					return
+				yield key, value
+
+	def __iter__( self ):
+		return ( key for key, value in self.range( ) )
+
+	def items( self ):
+		return list( self.range( ) )
+
+	def bulk_load( self, items, fill= 1. ):
+		''' fill an empty index from ( key, value ) in strictly increasing order,
+		leaves and branches 'fill' full.  the nodes are written outside the journal;
+		the index changes in one transaction at the end. '''
+		tree, word, keysize= self.tree, self.word, self.keysize
+		if len( self ):
+			raise ValueError( 'bulk_load needs an empty index' )
+		per= max( 2, int( self.order* fill ) )
+		level, count, last= [ ], 0, None
+		batch= [ ]
+		def flushleaf( ):
+			node= self._newnode( True )
+			map= tree.map
+			map[ node+ self.keybase: node+ self.keybase+ len( batch )* keysize ]= ''.join( self._pad( key ) for key, value in batch )
+			map[ node+ self.valbase: node+ self.valbase+ len( batch )* word ]= ''.join( tree.packI.pack( value ) for key, value in batch )
+			tree.packI.pack_into( map, node+ word, len( batch ) )
+			if level:
+				tree.packI.pack_into( map, level[ -1 ][ 1 ]+ 2* word, node )
+			level.append( ( batch[ 0 ][ 0 ], node ) )
+			del batch[ : ]
+		for key, value in items:
+			if last is not None and self.compare( last, key )>= 0:
+				raise ValueError( 'bulk_load keys out of order at %r'% key )
+			last= key
+			batch.append( ( key, value ) )
+			count+= 1
+			if len( batch )== per:
+				flushleaf( )
+		if batch or not level:
+			if batch:
+				flushleaf( )
+			else:
+				level.append( ( None, self._newnode( True ) ) )
+		first, height= level[ 0 ][ 1 ], 1
+		while len( level )> 1:
+			upper= [ ]
+			groups= -( -len( level )// ( per+ 1 ) ) #spread evenly, so none has a lone child
+			for g in range( groups ):
+				group= level[ g* len( level )// groups: ( g+ 1 )* len( level )// groups ]
+				node= self._newnode( False )
+				map= tree.map
+				map[ node+ self.keybase: node+ self.keybase+ ( len( group )- 1 )* keysize ]= ''.join( self._pad( key ) for key, child in group[ 1: ] )
+				map[ node+ self.valbase: node+ self.valbase+ len( group )* word ]= ''.join( tree.packI.pack( child ) for key, child in group )
+				tree.packI.pack_into( map, node+ word, len( group )- 1 )
+				upper.append( ( group[ 0 ][ 0 ], node ) )
+			level= upper
+			height+= 1
+		with tree.transaction( ):
+			tree.free( tree.getI( self.head ) )
+			tree.setI( self.head, level[ 0 ][ 1 ] )
+			tree.setI( self.head+ word, first )
+			tree.setI( self.head+ 2* word, count )
+			tree.setI( self.head+ 5* word, height )
+
+def bptree_test( ):
+	''' inserts and deletes against a sorted reference, through splits, ranges, bulk
+	load, a reopen, and a custom order '''
+	import random as ran
+	mt= allocbuf.FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	mt.grow= 'geometric'
+	bt= BPlusTree( mt, keysize= 8, pagesize= 512 )
+	ref= { }
+	for i in range( 4000 ):
+		key= '%06i'% ran.randrange( 10000 )
+		if key in ref and ran.random( )< 0.3:
+			del bt[ key ]
+			del ref[ key ]
+		else:
+			bt[ key ]= ref[ key ]= ran.randrange( 1<< 20 )
+	assert bt.height( )>= 3 and len( bt )== len( ref )
+	assert bt.items( )== sorted( ref.items( ) )
+	for key in ran.sample( list( ref ), 100 ):
+		assert bt[ key ]== ref[ key ]
+	assert bt.get( 'absent' ) is None and 'absent' not in bt
+	lo, hi= '%06i'% 2000, '%06i'% 3000
+	assert list( bt.range( lo, hi ) )== sorted( ( k, v ) for k, v in ref.items( ) if lo<= k< hi )
+	assert list( bt.range( hi ) )== sorted( ( k, v ) for k, v in ref.items( ) if hi<= k )
+	for node in ( mt.getI( bt.head ), mt.getI( bt.head+ mt.word ) ):
+		assert node% bt.pagesize== 0
+	mt.check_used( )
+	mt.close( )
+	mt= allocbuf.FlatMmapAllocTree.open( 'mappedtree.dat' )
+	mt.grow= 'geometric'
+	bt= BPlusTree( mt )
+	assert bt.keysize== 8 and bt.items( )== sorted( ref.items( ) )
+	for n, fill in ( ( 0, 1. ), ( 1, 1. ), ( 37, .7 ), ( 5000, .7 ), ( 3000, 1. ) ):
+		bulk= BPlusTree( mt, 'bulk%i'% n, keysize= 8, pagesize= 512 )
+		items= [ ( '%06i'% i, i ) for i in range( n ) ]
+		bulk.bulk_load( iter( items ), fill )
+		assert bulk.items( )== items and len( bulk )== n
+		if n:
+			assert bulk[ '%06i'% ( n- 1 ) ]== n- 1
+			bulk[ '%06ia'% 0 ]= 1
+			assert len( bulk )== n+ 1
+	class Reversed( BPlusTree ):
+		def compare( self, key1, key2 ):
+			return -cmp( key1, key2 )
+	rev= Reversed( mt, 'reversed', keysize= 8, pagesize= 512 )
+	for i in range( 300 ):
+		rev[ '%06i'% i ]= i
+	assert [ v for k, v in rev.range( '%06i'% 199 ) ][ :3 ]== [ 199, 198, 197 ]
+	mt.check_used( )
+	mt.close( )
+
+def bench( n= 100000, file= 'mappedtree.dat' ):
+	''' random inserts, bulk load, random lookups and a full scan of 'n' keys; pages
+	read per lookup against the levels of a binary tree of the same keys '''
+	import math
+	import random
+	import time
+	keys= [ '%012i'% i for i in range( n ) ]
+	shuffled= keys[ : ]
+	random.Random( 0 ).shuffle( shuffled )
+	mt= allocbuf.FlatMmapAllocTree.create( file, 1<< 20 )
+	mt.grow= 'geometric'
+	bt= BPlusTree( mt )
+	start= time.time( )
+	for i, key in enumerate( shuffled ):
+		bt[ key ]= i
+	inserts= n/ ( time.time( )- start )
+	bulk= BPlusTree( mt, 'bulk' )
+	start= time.time( )
+	bulk.bulk_load( ( key, i ) for i, key in enumerate( keys ) )
+	loads= n/ ( time.time( )- start )
+	start= time.time( )
+	for key in shuffled:
+		bulk[ key ]
+	lookups= n/ ( time.time( )- start )
+	start= time.time( )
+	for item in bulk.range( ):
+		pass
+	scans= n/ ( time.time( )- start )
+	print 'insert %8.0f  bulk load %8.0f  lookup %8.0f  scan %8.0f  /sec'% ( inserts, loads, lookups, scans )
+	print 'pages per lookup %i (random inserts %i), binary tree levels %.0f'% ( bulk.height( ), bt.height( ),
+		math.ceil( math.log( n+ 1, 2 ) ) )
+	mt.close( )
+
+if __name__ == '__main__':
+	bench( )
@@ -0,0 +1,318 @@
+'''
+A dictionary of strings to strings whose table, entries, keys and values all live
+in an 'allocbuf' file, found again by name through the file's roots.  Compare with
+'shelve': nothing is loaded or unpickled on open, and a value can be read where it
+lies, with 'view'.
+
+The table is grown by linear hashing: an insert that takes the load past 'maxload'
+splits one bucket, the next in turn, so that growth is spread over the inserts that
+cause it and no insert rehashes the table.  Buckets are chained.  Bucket heads are
+kept in segments of 'segment' words, listed in a segment table, so the table grows
+without moving.
+'''
+
+'''
+Dict structure:
+count      entries
+level      doublings of the table done
+split      next bucket to split
+segments   offset of the segment table
+nsegments  segments the segment table has room for
+
+Entry structure:
+next       next entry in the bucket, or 0
+hash       crc32 of the key, to the word width
+keylen     bytes of key
+vallen     bytes of value
+key, value
+'''
+
+import zlib
+import allocbuf
+
+class PersistentDict( object ):
+	''' mapping of str to str in 'tree', an MmapAllocTree, under root 'name'.  each
+	call is one transaction of the tree.  a value replaced by one no longer than its
+	entry has room for is written over in place, outside the journal, as for 'setS'.
+	offsets are held across calls, so make a new one after 'compact'. '''
+	segment= 256 #buckets per segment; the table starts with one
+	maxload= 2 #entries per bucket before a split
+
+	def __init__( self, tree, name= 'dict' ):
+		self.tree= tree
+		self.word= tree.word
+		self.getI= tree.getI
+		self.hashmask= ( 1<< 8* tree.word )- 1
+		with tree.transaction( ):
+			head= tree.get_root( name )
+			if head is None:
+				head= self._create( )
+				tree.set_root( name, head )
+		self.head= head
+
+	def _create( self ):
+		tree, word= self.tree, self.word
+		head= tree.alloc( 5* word )
+		segments= tree.alloc( 4* word )
+		tree.setI( head, 0 )
+		tree.setI( head+ word, 0 )
+		tree.setI( head+ 2* word, 0 )
+		tree.setI( head+ 3* word, segments )
+		tree.setI( head+ 4* word, 4 )
+		tree.setI( segments, self._newsegment( ) )
+		return head
+
+	def _newsegment( self ):
+		''' a segment of empty buckets; fresh, so written outside the journal '''
+		size= self.segment* self.word
+		segment= self.tree.alloc( size )
+		self.tree.map[ segment: segment+ size ]= '\0'* size
+		return segment
+
+	def _bucketat( self, index ):
+		''' address of the head word of bucket 'index' '''
+		getI, word= self.getI, self.word
+		segments= getI( self.head+ 3* word )
+		return getI( segments+ index// self.segment* word )+ index% self.segment* word
+
+	def _bucket( self, hash ):
+		getI, word, head= self.getI, self.word, self.head
+		size= self.segment<< getI( head+ word )
+		index= hash% size
+		if index< getI( head+ 2* word ):
+			index= hash% ( 2* size )
+		return self._bucketat( index )
+
+	def _find( self, key ):
+		''' address of the link to the entry for 'key', the entry or 0, and the hash '''
+		getI, word, map= self.getI, self.word, self.tree.map
+		hash= zlib.crc32( key )& self.hashmask
+		link= self._bucket( hash )
+		entry= getI( link )
+		keylen= len( key )
+		while entry:
+			if getI( entry+ word )== hash and getI( entry+ 2* word )== keylen and \
+					map[ entry+ 4* word: entry+ 4* word+ keylen ]== key:
+				return link, entry, hash
+			link, entry= entry, getI( entry )
+		return link, 0, hash
+
+	def _value( self, entry ):
+		''' offset and length of the value of 'entry' '''
+		getI, word= self.getI, self.word
+		return entry+ 4* word+ getI( entry+ 2* word ), getI( entry+ 3* word )
+
+	def __getitem__( self, key ):
+		with self.tree.locked( ):
+			link, entry, hash= self._find( key )
+			if not entry:
+				raise KeyError( key )
+			offt, len_= self._value( entry )
+			return self.tree.map[ offt: offt+ len_ ]
+
+	def view( self, key ):
+		''' the value in place, as a read-only buffer; good until the tree is next
+		remapped, or the value replaced or deleted '''
+		with self.tree.locked( ):
+			link, entry, hash= self._find( key )
+			if not entry:
+				raise KeyError( key )
+			offt, len_= self._value( entry )
+			return buffer( self.tree.map, offt, len_ )
+
+	def get( self, key, default= None ):
+		try:
+			return self[ key ]
+		except KeyError:
+			return default
+
+	def __contains__( self, key ):
+		with self.tree.locked( ):
+			return bool( self._find( key )[ 1 ] )
+
+	def __setitem__( self, key, value ):
+		assert type( key )== str and type( value )== str
+		tree, word= self.tree, self.word
+		need= 4* word+ len( key )+ len( value )
+		with tree.transaction( ):
+			link, entry, hash= self._find( key )
+			if entry and tree[ entry- 2* word ].key>= need:
+				tree.setI( entry+ 3* word, len( value ) )
+				offt= entry+ 4* word+ len( key )
+				tree.map[ offt: offt+ len( value ) ]= value
+				return
+			new= tree.alloc( need )
+			tree.setI( new+ word, hash )
+			tree.setI( new+ 2* word, len( key ) )
+			tree.setI( new+ 3* word, len( value ) )
+			tree.map[ new+ 4* word: new+ need ]= key+ value
+			if entry:
+				tree.setI( new, self.getI( entry ) )
+				tree.setI( link, new )
+				tree.free( entry )
+				return
+			bucket= self._bucket( hash )
+			tree.setI( new, self.getI( bucket ) )
+			tree.setI( bucket, new )
+			count= self.getI( self.head )+ 1
+			tree.setI( self.head, count )
+			if count> self.maxload* self.buckets( ):
+				self._split( )
+
+	def __delitem__( self, key ):
+		tree= self.tree
+		with tree.transaction( ):
+			link, entry, hash= self._find( key )
+			if not entry:
+				raise KeyError( key )
+			tree.setI( link, self.getI( entry ) )
+			tree.free( entry )
+			tree.setI( self.head, self.getI( self.head )- 1 )
+
+	def buckets( self ):
+		''' buckets in the table '''
+		getI, word= self.getI, self.word
+		return ( self.segment<< getI( self.head+ word ) )+ getI( self.head+ 2* word )
+
+	def _split( self ):
+		''' split the next bucket in turn into itself and a new one at the end '''
+		tree, getI, word, head= self.tree, self.getI, self.word, self.head
+		level, split= getI( head+ word ), getI( head+ 2* word )
+		size= self.segment<< level
+		new= split+ size
+		if new% self.segment== 0:
+			segments, nsegments= getI( head+ 3* word ), getI( head+ 4* word )
+			if new// self.segment>= nsegments:
+				segments= tree.realloc( segments, 2* nsegments* word )
+				tree.setI( head+ 3* word, segments )
+				tree.setI( head+ 4* word, 2* nsegments )
+			tree.setI( segments+ new// self.segment* word, self._newsegment( ) )
+		link, newlink= self._bucketat( split ), self._bucketat( new )
+		entry= getI( link )
+		while entry:
+			next= getI( entry )
+			if getI( entry+ word )% ( 2* size )!= split:
+				tree.setI( link, next )
+				tree.setI( entry, getI( newlink ) )
+				tree.setI( newlink, entry )
+			else:
+				link= entry
+			entry= next
+		split+= 1
+		if split== size:
+			tree.setI( head+ word, level+ 1 )
+			split= 0
+		tree.setI( head+ 2* word, split )
+
+	def __len__( self ):
+		return self.getI( self.head )
+
+	def _entries( self ):
+		getI= self.getI
+		with self.tree.locked( ):
+			entries= [ ]
+			for index in range( self.buckets( ) ):
+				entry= getI( self._bucketat( index ) )
+				while entry:
+					entries.append( entry )
+					entry= getI( entry )
+			return entries
+
+	def keys( self ):
+		word, map= self.word, self.tree.map
+		return [ map[ entry+ 4* word: entry+ 4* word+ self.getI( entry+ 2* word ) ]
+			for entry in self._entries( ) ]
+
+	def __iter__( self ):
+		return iter( self.keys( ) )
+
+	def items( self ):
+		word, map= self.word, self.tree.map
+		ret= [ ]
+		for entry in self._entries( ):
+			offt, len_= self._value( entry )
+			ret.append( ( map[ entry+ 4* word: offt ], map[ offt: offt+ len_ ] ) )
+		return ret
+
+	def values( self ):
+		return [ value for key, value in self.items( ) ]
+
+def dict_test( ):
+	''' random inserts, replacements and deletes against a dict, through splits and
+	a reopen '''
+	import random as ran
+	mt= allocbuf.FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	mt.grow= 'geometric'
+	pd= PersistentDict( mt )
+	ref= { }
+	for i in range( 5000 ):
+		key= 'k%i'% ran.randrange( 3000 )
+		if key in ref and ran.random( )< 0.3:
+			del pd[ key ]
+			del ref[ key ]
+		else:
+			pd[ key ]= ref[ key ]= 'v'* ran.randint( 0, 40 )
+	assert pd.buckets( )> PersistentDict.segment and len( pd )== len( ref )
+	assert sorted( pd.items( ) )== sorted( ref.items( ) )
+	key= ran.choice( list( ref ) )
+	assert str( pd.view( key ) )== ref[ key ] and key in pd and 'absent' not in pd
+	try:
+		pd[ 'absent' ]
+		assert False
+	except KeyError:
+		pass
+	mt.check_used( )
+	mt.close( )
+	mt= allocbuf.FlatMmapAllocTree.open( 'mappedtree.dat' )
+	pd= PersistentDict( mt )
+	for key in ref:
+		assert pd[ key ]== ref[ key ]
+	other= PersistentDict( mt, 'other' )
+	other[ 'a' ]= 'b'
+	assert len( other )== 1 and 'a' not in pd
+	for key in list( ref ):
+		del pd[ key ]
+	assert len( pd )== 0 and pd.keys( )== [ ]
+	mt.check_used( )
+	mt.close( )
+
+def bench( n= 1000000, file= 'mappedtree.dat' ):
+	''' insert, look up and delete 'n' keys, against shelve and anydbm '''
+	import anydbm
+	import os
+	import shelve
+	import time
+	keys= [ 'key%09i'% i for i in range( n ) ]
+	value= 'v'* 20
+	def run( name, d, close ):
+		times= [ ]
+		for phase in ( 'insert', 'lookup', 'delete' ):
+			start= time.time( )
+			if phase== 'insert':
+				for key in keys:
+					d[ key ]= value
+			elif phase== 'lookup':
+				for key in keys:
+					d[ key ]
+			else:
+				for key in keys:
+					del d[ key ]
+			times.append( n/ ( time.time( )- start ) )
+		close( )
+		print '%-22s insert %8.0f  lookup %8.0f  delete %8.0f  /sec'% ( ( name, )+ tuple( times ) )
+	mt= allocbuf.FlatMmapAllocTree.create( file, 1<< 20 )
+	mt.grow= 'geometric'
+	run( 'PersistentDict', PersistentDict( mt ), mt.close )
+	for name in os.listdir( '.' ):
+		if name.startswith( file+ '.' ):
+			os.remove( name )
+	db= anydbm.open( file+ '.db', 'n' )
+	run( 'anydbm (%s)'% anydbm._defaultmod.__name__, db, db.close )
+	sh= shelve.open( file+ '.shelf', 'n' )
+	run( 'shelve', sh, sh.close )
+	for name in os.listdir( '.' ):
+		if name.startswith( file+ '.' ):
+			os.remove( name )
+
+if __name__ == '__main__':
+	bench( )
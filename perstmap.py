@@ -1,49 +1,128 @@
+'''
+ctypes objects over a mapped file, without copying: 'refas' gives a Structure, or
+any ctypes type, that reads and writes the file where it lies, and 'arrayof' a
+ctypes array of them.
+
+Objects come from the map by the buffer protocol, 'from_buffer', so each holds
+the map it was made on open.  The map's address is found once per mapping, for
+'address' and the bulk copies, and again on 'remap'.  Objects made before a
+'remap' see the old mapping, which stays open until the last of them goes.
+'''
+
 import mmap
+import os
 builtinopen= open
 
 from ctypes import *
 
-prototype= PYFUNCTYPE( c_int, py_object, POINTER(c_void_p), POINTER(c_uint) )
-PyObject_AsWriteBuffer= prototype( ( "PyObject_AsWriteBuffer", pythonapi ) )
 class perstmap:
-	def __init__( self, map ):
-		_b= c_void_p(0)
-		_s= c_uint(0)
-		PyObject_AsWriteBuffer( map, byref(_b), byref(_s) )
-
+	def __init__( self, map, f= None, access= mmap.ACCESS_WRITE ):
+		self._f, self._access= f, access
+		self._setmap( map )
+	def _setmap( self, map ):
 		self._map= map
-		self._b= _b.value
+		self._b= addressof( c_char.from_buffer( map ) )
 	def refas( self, offset, tp ):
-		c= cast( self._b+ offset, POINTER( tp ) )
-		return c.contents
+		''' instance of 'tp' over the bytes at 'offset' '''
+		return tp.from_buffer( self._map, offset )
+	def arrayof( self, offset, tp, n ):
+		''' 'n' instances of 'tp' end to end from 'offset', as one ctypes array '''
+		return ( tp* n ).from_buffer( self._map, offset )
+	def readarray( self, offset, tp, n ):
+		''' copy of 'n' instances of 'tp' from 'offset', in one call '''
+		return ( tp* n ).from_buffer_copy( self._map, offset )
+	def writearray( self, offset, array ):
+		''' copy the ctypes object 'array' to 'offset', in one call '''
+		size= sizeof( array )
+		if offset< 0 or offset+ size> len( self._map ):
+			raise ValueError( '%i bytes at %i overrun the map'% ( size, offset ) )
+		memmove( self._b+ offset, addressof( array ), size )
+	def address( self, offset ):
+		''' memory address of 'offset', for foreign code; good until 'remap' '''
+		return self._b+ offset
+	def remap( self, size= None ):
+		''' map the file again, extended to 'size' bytes if given '''
+		fd= self._f.fileno( )
+		if size is not None and size> os.fstat( fd ).st_size:
+			os.ftruncate( fd, size )
+		self._setmap( mmap.mmap( fd, 0, access= self._access ) )
+	def __len__( self ):
+		return len( self._map )
+	def flush( self ):
+		self._map.flush( )
+	def close( self ):
+		''' drop the map; objects made from it keep it open until they go '''
+		self._map= None
+		if self._f is not None:
+			self._f.close( )
 
-from ctypes import *
-prototype= PYFUNCTYPE( c_int, py_object, POINTER(c_void_p), POINTER(c_uint) )
-PyObject_AsWriteBuffer= prototype( ( "PyObject_AsWriteBuffer", pythonapi ) )
 def refas( buf, offset, tp ):
 	''' return an instance of |tp| that refers to |offset| bytes into buffer |buf| '''
-	_b, _s= c_void_p(0), c_uint(0)
-	PyObject_AsWriteBuffer( buf, byref(_b), byref(_s) )
-	c= cast( _b.value+ offset, POINTER( tp ) )
-	return c.contents
+	return tp.from_buffer( buf, offset )
 
 def create( file, size, access= mmap.ACCESS_WRITE ):
-	builtinopen( file, 'w+b' )
-	f= builtinopen( file, 'r+b' )
+	f= builtinopen( file, 'w+b' )
+	f.truncate( size )
 	m= mmap.mmap( f.fileno( ), size, access= access )
-	pm= perstmap( m )
+	pm= perstmap( m, f, access )
 	return pm
 
 def open( file, access= mmap.ACCESS_WRITE ):
 	f=  builtinopen( file, 'r+b' )
 	m= mmap.mmap( f.fileno( ), 0, access= access )
-	pm= perstmap( m )
+	pm= perstmap( m, f, access )
 	return pm
 
-'''
-PyObject_AsWriteBuffer = ctypes.pythonapi.PyObject_AsWriteBuffer
-PyObject_AsWriteBuffer.restype = ctypes.c_int
-PyObject_AsWriteBuffer.argtypes = [ctypes.py_object,
-                                   ctypes.POINTER(ctypes.c_void_p),
-                                   ctypes.POINTER(Py_ssize_t)]
-'''
\ No newline at end of file
+def perstmap_test( ):
+	''' structures and arrays in place, bulk copies, and a remap '''
+	class Point( Structure ):
+		_fields_= [ ( 'x', c_double ), ( 'y', c_double ), ( 'n', c_uint32 ) ]
+	pm= create( 'mappedtree.dat', 1<< 16 )
+	p= pm.refas( 64, Point )
+	p.x, p.n= 1.5, 7
+	assert refas( pm._map, 64, c_double ).value== 1.5
+	arr= pm.arrayof( 1024, Point, 100 )
+	arr[ 3 ].y= 2.5
+	assert pm.refas( 1024+ 3* sizeof( Point ), Point ).y== 2.5
+	src= ( Point* 100 )( *[ Point( i, -i, i ) for i in range( 100 ) ] )
+	pm.writearray( 1024, src )
+	assert arr[ 99 ].y== -99. and pm.readarray( 1024, Point, 100 )[ 50 ].n== 50
+	try:
+		pm.writearray( ( 1<< 16 )- 8, src )
+		assert False
+	except ValueError:
+		pass
+	pm.remap( 1<< 17 )
+	assert len( pm )== 1<< 17 and pm.refas( 64, Point ).n== 7 and p.n== 7
+	pm.refas( ( 1<< 17 )- sizeof( Point ), Point ).n= 1
+	assert string_at( pm.address( 64 )+ 16, 4 )== string_at( addressof( p )+ 16, 4 )
+	pm.flush( )
+	pm.close( )
+	pm= open( 'mappedtree.dat' )
+	assert pm.refas( 64, Point ).x== 1.5 and pm.readarray( 1024, Point, 100 )[ 99 ].y== -99.
+	pm.close( )
+
+def bench( n= 1000000, file= 'mappedtree.dat' ):
+	''' reading and writing 'n' records: a field at a time through 'arrayof', and the
+	whole run at once '''
+	import time
+	class Row( Structure ):
+		_fields_= [ ( 'a', c_uint32 ), ( 'b', c_uint32 ), ( 'c', c_double ) ]
+	pm= create( file, n* sizeof( Row ) )
+	src= ( Row* n )( )
+	arr= pm.arrayof( 0, Row, n )
+	def perrecord_write( ):
+		for i in xrange( n ):
+			arr[ i ].a= i
+	def perrecord_read( ):
+		for row in arr:
+			row.a
+	for name, way in ( ( 'write per record', perrecord_write ), ( 'read per record', perrecord_read ),
+			( 'writearray', lambda: pm.writearray( 0, src ) ), ( 'readarray', lambda: pm.readarray( 0, Row, n ) ) ):
+		start= time.time( )
+		way( )
+		print '%-18s %12.0f records/sec'% ( name, n/ ( time.time( )- start ) )
+	pm.close( )
+
+if __name__ == '__main__':
+	bench( )
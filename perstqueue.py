@@ -0,0 +1,417 @@
+'''
+A queue of byte strings between processes, in an 'allocbuf' file, found again by
+name through the file's roots: the web session logger of 'pymmapstruct.txt', where
+producers put records, listeners take and acknowledge them, and the space is used
+again.
+
+The records go in a ring of segments allocated once, when the queue is made, so
+'put', 'get' and 'ack' never call on the freetree.  Three cursors in the file go
+round the ring: 'tail', where the next record is put; 'head', the next record to
+get; and 'ack', before which every record is acknowledged.  Space from 'ack' round
+to 'tail' is in use; a record got and not acknowledged keeps its space until it is,
+and comes round again on 'redeliver', if its getter died.
+
+Each cursor is one word, written after the record it passes, so a process dying
+mid-call leaves the queue whole without the journal.  Several processes need the
+tree's 'locking'.  A getter with nothing to get, or a putter with no room, polls;
+or with 'wakeup' set to 'futex', on Linux, sleeps on the cursor it waits for.
+'''
+
+'''
+Queue structure:
+tail       byte position after the last record put
+head       byte position of the next record to get
+ack        byte position of the oldest record not acknowledged
+segsize    bytes per segment, a power of 2
+nsegments  segments, a power of 2
+segments   offsets of the segments, 'nsegments' words
+positions count bytes from the queue's start, wrapping at the word width
+
+Record structure:
+length     bytes of data, with the top bit set once acknowledged; or SKIP, the
+           rest of the segment is unused
+data       padded to a word
+a record does not span segments.
+'''
+
+import ctypes
+import errno
+import platform
+import struct
+import sys
+import time
+import allocbuf
+
+_futexcalls= { 'x86_64': 202, 'i386': 240, 'i686': 240, 'aarch64': 98, 'armv7l': 240, 'ppc64le': 221 }
+
+def _futex( ):
+	''' the libc 'syscall' function, and the number of futex on this machine; or None '''
+	if not sys.platform.startswith( 'linux' ) or platform.machine( ) not in _futexcalls:
+		return None
+	try:
+		libc= ctypes.CDLL( None, use_errno= True )
+	except OSError:
+		return None
+	return libc.syscall, _futexcalls[ platform.machine( ) ]
+
+FUTEX_WAIT, FUTEX_WAKE= 0, 1
+
+class timespec( ctypes.Structure ):
+	_fields_= [ ( 'tv_sec', ctypes.c_long ), ( 'tv_nsec', ctypes.c_long ) ]
+
+class PersistentQueue( object ):
+	''' queue in 'tree', an MmapAllocTree, under root 'name'.  'segsize' and
+	'nsegments' are fixed when it is made; a record holds up to 'segsize' less a word
+	bytes, and the queue up to 'segsize'* 'nsegments' bytes of them. '''
+	wakeup= None #or 'futex'
+	pollmin= 1e-5 #seconds; polls back off from 'pollmin' to 'pollmax'
+	pollmax= 1e-2
+
+	class Empty( Exception ): pass
+	class Full( Exception ): pass
+
+	def __init__( self, tree, name= 'queue', segsize= 1<< 16, nsegments= 16 ):
+		self.tree= tree
+		self.word= word= tree.word
+		with tree.transaction( ):
+			head= tree.get_root( name )
+			if head is None:
+				if segsize& ( segsize- 1 ) or nsegments& ( nsegments- 1 ) or segsize< 4* word:
+					raise ValueError( 'segsize and nsegments must be powers of 2' )
+				if segsize* nsegments> 1<< ( 8* word- 1 ):
+					raise ValueError( 'a queue of %i bytes cannot be addressed with %i-byte words'% ( segsize* nsegments, word ) )
+				head= tree.alloc( ( 5+ nsegments )* word, align= word ) #futexes need aligned cursors
+				for i in range( 3 ):
+					tree.setI( head+ i* word, 0 )
+				tree.setI( head+ 3* word, segsize )
+				tree.setI( head+ 4* word, nsegments )
+				for i in range( nsegments ):
+					tree.setI( head+ ( 5+ i )* word, tree.alloc( segsize ) )
+				tree.set_root( name, head )
+		self.head= head
+		self.tailaddr, self.headaddr, self.ackaddr= head, head+ word, head+ 2* word
+		self.segsize, self.nsegments= tree.getI( head+ 3* word ), tree.getI( head+ 4* word )
+		self.segments= [ tree.getI( head+ ( 5+ i )* word ) for i in range( self.nsegments ) ]
+		self.capacity= self.segsize* self.nsegments
+		self.mask= ( 1<< 8* word )- 1
+		self.ACKED= 1<< 8* word- 1
+		self.SKIP= self.ACKED- 1
+		self._futexmap= None
+
+	def _at( self, pos ):
+		''' offset in the file of byte position 'pos' '''
+		return self.segments[ pos// self.segsize% self.nsegments ]+ pos% self.segsize
+
+	def _need( self, length ):
+		word= self.word
+		return word+ ( length+ word- 1 )// word* word
+
+	def _cursor( self, addr ):
+		return self.tree.packI.unpack_from( self.tree.map, addr )[ 0 ]
+
+	def _setcursor( self, addr, pos ):
+		self.tree.packI.pack_into( self.tree.map, addr, pos& self.mask )
+		if addr!= self.headaddr and self._futexing( ): #nobody waits on 'head'
+			self._wake( addr )
+
+	def _futexing( self ):
+		return self.wakeup== 'futex' and futex is not None and self.word>= 4
+
+	def put( self, data, block= True, timeout= None ):
+		''' add 'data', a str, waiting while the queue is full unless not 'block', up to
+		'timeout' seconds; raises Full '''
+		tree, word, segsize= self.tree, self.word, self.segsize
+		need= self._need( len( data ) )
+		if need> segsize:
+			raise ValueError( 'records are at most %i bytes, not %i'% ( segsize- word, len( data ) ) )
+		waiter= self._waiter( block, timeout )
+		while True:
+			with tree.locked( ):
+				tail, ack= self._cursor( self.tailaddr ), self._cursor( self.ackaddr )
+				skip= segsize- tail% segsize
+				if skip>= need:
+					skip= 0
+				if ( ( tail- ack )& self.mask )+ skip+ need<= self.capacity:
+					if skip:
+						tree.packI.pack_into( tree.map, self._at( tail ), self.SKIP )
+						tail+= skip
+					offt= self._at( tail )
+					tree.packI.pack_into( tree.map, offt, len( data ) )
+					tree.map[ offt+ word: offt+ word+ len( data ) ]= data
+					self._setcursor( self.tailaddr, tail+ need )
+					return
+			if not waiter( self.ackaddr, ack ):
+				raise self.Full( )
+
+	def get( self, block= True, timeout= None ):
+		''' the oldest record not yet got, as ( ticket, data ); 'ack' the ticket when it is
+		dealt with.  waits while the queue is empty unless not 'block', up to 'timeout'
+		seconds; raises Empty '''
+		tree, word= self.tree, self.word
+		waiter= self._waiter( block, timeout )
+		while True:
+			with tree.locked( ):
+				head, tail= self._skip( ), self._cursor( self.tailaddr )
+				if head!= tail:
+					offt= self._at( head )
+					length= tree.packI.unpack_from( tree.map, offt )[ 0 ]
+					data= tree.map[ offt+ word: offt+ word+ length ]
+					self._setcursor( self.headaddr, head+ self._need( length ) )
+					return head, data
+			if not waiter( self.tailaddr, tail ):
+				raise self.Empty( )
+
+	def _skip( self ):
+		''' move 'head' past padding and records acknowledged before a 'redeliver', and
+		'ack' with it if it was level; return 'head'.  call locked '''
+		tree, segsize= self.tree, self.segsize
+		head, tail= self._cursor( self.headaddr ), self._cursor( self.tailaddr )
+		start= head
+		while head!= tail:
+			length= tree.packI.unpack_from( tree.map, self._at( head ) )[ 0 ]
+			if length== self.SKIP:
+				head+= segsize- head% segsize
+			elif length& self.ACKED:
+				head+= self._need( length^ self.ACKED )
+			else:
+				break
+			head&= self.mask
+		if head!= start:
+			if self._cursor( self.ackaddr )== start:
+				self._setcursor( self.ackaddr, head )
+			self._setcursor( self.headaddr, head )
+		return head
+
+	def ack( self, ticket ):
+		''' done with the record got as 'ticket'; its space, and that of any
+		acknowledged after it, is free again once those before it are '''
+		tree, segsize= self.tree, self.segsize
+		with tree.locked( ):
+			offt= self._at( ticket )
+			length= tree.packI.unpack_from( tree.map, offt )[ 0 ]
+			if length& self.ACKED or ( ticket- self._cursor( self.ackaddr ) )& self.mask>= self.capacity:
+				raise ValueError( 'ticket %i is not outstanding'% ticket )
+			tree.packI.pack_into( tree.map, offt, length| self.ACKED )
+			ack, head= self._cursor( self.ackaddr ), self._cursor( self.headaddr )
+			start= ack
+			while ack!= head:
+				length= tree.packI.unpack_from( tree.map, self._at( ack ) )[ 0 ]
+				if length== self.SKIP:
+					ack+= segsize- ack% segsize
+				elif length& self.ACKED:
+					ack+= self._need( length^ self.ACKED )
+				else:
+					break
+				ack&= self.mask
+			if ack!= start:
+				self._setcursor( self.ackaddr, ack )
+
+	def redeliver( self ):
+		''' get again the records got and not acknowledged, after their getter died '''
+		with self.tree.locked( ):
+			self._setcursor( self.headaddr, self._cursor( self.ackaddr ) )
+
+	def used( self ):
+		''' bytes in use, from 'ack' round to 'tail' '''
+		with self.tree.locked( ):
+			return ( self._cursor( self.tailaddr )- self._cursor( self.ackaddr ) )& self.mask
+
+	def empty( self ):
+		''' nothing to get '''
+		with self.tree.locked( ):
+			return self._skip( )== self._cursor( self.tailaddr )
+
+	def _waiter( self, block, timeout ):
+		''' a function of a cursor's address and the value it was seen at, that waits
+		for a change and returns False when out of time '''
+		if not block:
+			return lambda addr, seen: False
+		deadline= None if timeout is None else time.time( )+ timeout
+		delay= [ self.pollmin ]
+		def wait( addr, seen ):
+			left= self.pollmax if deadline is None else deadline- time.time( )
+			if left<= 0:
+				return False
+			if not self._futexing( ) or not self._sleep( addr, seen, min( left, self.pollmax ) ):
+				time.sleep( min( left, delay[ 0 ] ) )
+				delay[ 0 ]= min( delay[ 0 ]* 2, self.pollmax )
+			return True
+		return wait
+
+	def _futexaddr( self, addr ):
+		''' memory address and expected value of the 32 bits of cursor 'addr' that a
+		futex watches: the low half, which moves on every change '''
+		tree= self.tree
+		if self._futexmap is not tree.map: #mapped again since
+			self._futexmap= tree.map
+			self._futexbase= ctypes.addressof( ctypes.c_char.from_buffer( tree.map ) )
+		if self.word== 8 and sys.byteorder== 'big':
+			addr+= 4
+		return self._futexbase+ addr, struct.unpack_from( '=i', tree.map, addr )[ 0 ]
+
+	def _sleep( self, addr, seen, seconds ):
+		''' sleep until the cursor at 'addr' moves from 'seen', or for 'seconds'; False
+		if the futex call failed, and the caller should poll instead '''
+		syscall, nr= futex
+		where, value= self._futexaddr( addr )
+		if value!= struct.unpack( '=i', struct.pack( '=I', seen& 0xffffffff ) )[ 0 ]:
+			return True
+		wait= timespec( int( seconds ), int( seconds% 1* 1e9 ) )
+		if syscall( nr, ctypes.c_void_p( where ), FUTEX_WAIT, ctypes.c_int( value ), ctypes.byref( wait ), None, 0 )== -1:
+			return ctypes.get_errno( ) in ( errno.EAGAIN, errno.EINTR, errno.ETIMEDOUT )
+		return True
+
+	def _wake( self, addr ):
+		syscall, nr= futex
+		where, value= self._futexaddr( addr )
+		syscall( nr, ctypes.c_void_p( where ), FUTEX_WAKE, ctypes.c_int( 0x7fffffff ), None, None, 0 )
+
+futex= _futex( )
+
+def _open( file, wakeup ):
+	mt= allocbuf.FlatMmapAllocTree.open( file )
+	mt.locking= True
+	q= PersistentQueue( mt )
+	q.wakeup= wakeup
+	return mt, q
+
+def _producer( file, wakeup, n, seed ):
+	import random
+	ran= random.Random( seed )
+	mt, q= _open( file, wakeup )
+	for i in xrange( n ):
+		q.put( struct.pack( 'd', time.time( ) )+ 'x'* ran.randint( 0, 200 ) )
+	mt.close( )
+
+def _consumer( file, wakeup, results ):
+	mt, q= _open( file, wakeup )
+	latencies= [ ]
+	while True:
+		ticket, data= q.get( )
+		q.ack( ticket )
+		if data== 'stop':
+			break
+		latencies.append( time.time( )- struct.unpack_from( 'd', data )[ 0 ] )
+	results.put( latencies )
+	mt.close( )
+
+def _run( file, wakeup, producers, consumers, n ):
+	''' seconds, and the latency of each record, of 'producers' putting 'n' records
+	each through one queue to 'consumers' '''
+	import multiprocessing
+	mt= allocbuf.FlatMmapAllocTree.create( file, 1<< 21 )
+	PersistentQueue( mt, segsize= 1<< 14, nsegments= 16 )
+	mt.close( )
+	results= multiprocessing.Queue( )
+	getters= [ multiprocessing.Process( target= _consumer, args= ( file, wakeup, results ) )
+		for i in range( consumers ) ]
+	putters= [ multiprocessing.Process( target= _producer, args= ( file, wakeup, n, i ) )
+		for i in range( producers ) ]
+	start= time.time( )
+	for proc in getters+ putters:
+		proc.start( )
+	for proc in putters:
+		proc.join( )
+		assert proc.exitcode== 0
+	mt, q= _open( file, wakeup )
+	for i in range( consumers ):
+		q.put( 'stop' )
+	latencies= sum( ( results.get( ) for i in range( consumers ) ), [ ] )
+	for proc in getters:
+		proc.join( )
+		assert proc.exitcode== 0
+	seconds= time.time( )- start
+	assert q.empty( ) and q.used( )== 0
+	mt.close( )
+	return seconds, sorted( latencies )
+
+def queue_test( ):
+	''' order, wrapping, out-of-order acks, redelivery, full and empty, a reopen, and
+	records through several processes arriving once each '''
+	import random as ran
+	mt= allocbuf.FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	q= PersistentQueue( mt, segsize= 256, nsegments= 4 )
+	try:
+		q.get( block= False )
+		assert False
+	except PersistentQueue.Empty:
+		pass
+	sent, got, outstanding= [ ], [ ], [ ]
+	for i in range( 3000 ):
+		if ran.random( )< 0.5:
+			data= '%i:'% i+ 'x'* ran.randint( 0, 100 )
+			try:
+				q.put( data, block= False )
+				sent.append( data )
+			except PersistentQueue.Full:
+				assert q.used( )> q.capacity- 256
+		elif ran.random( )< 0.7 and not q.empty( ):
+			ticket, data= q.get( block= False )
+			got.append( data )
+			outstanding.append( ticket )
+		elif outstanding:
+			q.ack( outstanding.pop( ran.randrange( len( outstanding ) ) ) )
+	assert got== sent[ :len( got ) ]
+	assert q._cursor( q.tailaddr )> 4* q.capacity, 'did not wrap'
+	try:
+		q.put( 'x'* 256 )
+		assert False
+	except ValueError:
+		pass
+	for ticket in outstanding:
+		q.ack( ticket )
+	last= len( got )
+	while not q.empty( ):
+		ticket, data= q.get( )
+		got.append( data )
+		if len( got )% 2:
+			q.ack( ticket )
+	assert got== sent
+	mt.close( )
+	mt= allocbuf.FlatMmapAllocTree.open( 'mappedtree.dat' )
+	q= PersistentQueue( mt )
+	assert q.segsize== 256 and q.empty( )
+	q.redeliver( )
+	again= [ ]
+	while not q.empty( ):
+		ticket, data= q.get( )
+		again.append( data )
+		q.ack( ticket )
+	assert again== [ data for i, data in enumerate( sent ) if i>= last and i% 2 ] and q.used( )== 0
+	start= time.time( )
+	try:
+		q.get( timeout= 0.05 )
+		assert False
+	except PersistentQueue.Empty:
+		assert time.time( )- start>= 0.05
+	mt.check_used( )
+	mt.close( )
+	for wakeup in ( None, 'futex' ) if futex else ( None, ):
+		seconds, latencies= _run( 'mappedtree.dat', wakeup, 3, 2, 500 )
+		assert len( latencies )== 1500
+	mt= allocbuf.FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	mt.alloc( 17 ) #leaves the next block unaligned, unless asked
+	q= PersistentQueue( mt, segsize= 256, nsegments= 4 )
+	assert q.head% mt.word== 0
+	q.wakeup= 'futex'
+	try:
+		q.get( timeout= 0.05 )
+		assert False
+	except PersistentQueue.Empty:
+		pass
+	mt.close( )
+
+def bench( n= 20000, shapes= ( ( 1, 1 ), ( 2, 2 ), ( 4, 4 ) ), file= 'mappedtree.dat' ):
+	''' records per second and latency, from producer to consumer processes, polling
+	and with futex wakeup.  producers put as fast as they can, so latency is mostly
+	time spent queued. '''
+	for wakeup in ( None, 'futex' ) if futex else ( None, ):
+		for producers, consumers in shapes:
+			seconds, latencies= _run( file, wakeup, producers, consumers, n )
+			pick= lambda p: latencies[ min( int( p* len( latencies ) ), len( latencies )- 1 ) ]* 1e6
+			print '%-6s %i->%i  %8.0f records/sec  latency p50 %7.1f p99 %8.1f max %9.1f us'% (
+				wakeup or 'poll', producers, consumers, len( latencies )/ seconds, pick( .5 ), pick( .99 ),
+				latencies[ -1 ]* 1e6 )
+
+if __name__ == '__main__':
+	bench( )
@@ -0,0 +1,314 @@
+'''
+Records in an 'allocbuf' file, read and written by field name instead of by hand
+computed offsets:
+
+	Point= record( 'Point', [ ( 'x', 'd' ), ( 'y', 'd' ), ( 'next', 'self' ) ] )
+	p= Point.new( mt )
+	p.x, p.y= 1., 2.
+	p.next= Point.new( mt ) #stores its offset
+
+'record' compiles the fields once, to their offsets and one 'struct.Struct' for
+the whole record, and makes a class of views.  A view is a tree and an offset; it
+reads and writes the file in place, so it stays good across 'remap' and in other
+processes.  'pack' and 'unpack' move a whole record in one call, and a
+'RecordArray' moves a run of them in one call, or maps them as a numpy structured
+array, without copying, where numpy is installed.
+
+Field types are 'struct' codes, laid out as a C compiler would, in native order:
+'b', 'B', 'h', 'H', 'i', 'I', 'q', 'Q', 'f', 'd', '?', and 'Ns' for N bytes;
+and these, a word of the tree wide:
+word      unsigned
+ref       offset of anything in the file, or 0
+self      offset of a record of the same class; reads as a view, or None
+a record class   offset of one of those; reads as a view, or None
+Reference fields take a view, an offset, or None.  Only offsets are stored, never
+addresses, so the file means the same wherever it is mapped.
+'''
+
+import struct
+import allocbuf
+
+try:
+	import numpy
+except ImportError:
+	numpy= None
+
+class Record( object ):
+	''' view of the record at 'offset' in 'tree'; the classes 'record' makes are
+	subclasses.  writes inside a transaction of a journaled tree are journaled. '''
+	__slots__= ( 'tree', 'offset' )
+	fields= ( )
+	size= 0
+
+	def __init__( self, tree, offset ):
+		self.tree= tree
+		self.offset= offset
+
+	@classmethod
+	def new( cls, tree ):
+		''' view of a new, zeroed record '''
+		offset= tree.alloc( cls.size )
+		tree.map[ offset: offset+ cls.size ]= '\0'* cls.size #'alloc' journaled the structure this overwrites
+		return cls( tree, offset )
+
+	@classmethod
+	def array( cls, tree, offset, n ):
+		return RecordArray( cls, tree, offset, n )
+
+	@classmethod
+	def newarray( cls, tree, n ):
+		''' 'n' new, zeroed records in one allocation '''
+		size= cls.size* n
+		offset= tree.alloc( size )
+		tree.map[ offset: offset+ size ]= '\0'* size #as in 'new'
+		return RecordArray( cls, tree, offset, n )
+
+	def unpack( self ):
+		''' every field, in order; references as offsets '''
+		return self.struct.unpack_from( self.tree.map, self.offset )
+
+	def pack( self, *values ):
+		''' write every field, in order '''
+		_write( self.tree, self.offset, self.struct, self._raw( values ) )
+
+	def free( self ):
+		self.tree.free( self.offset )
+
+	@classmethod
+	def _raw( cls, values ):
+		''' 'values' with references as offsets '''
+		if not cls.refs:
+			return values
+		values= list( values )
+		for i in cls.refs:
+			values[ i ]= _offset( values[ i ] )
+		return values
+
+	def __eq__( self, other ):
+		return type( self ) is type( other ) and self.tree is other.tree and self.offset== other.offset
+
+	def __ne__( self, other ):
+		return not self== other
+
+	def __hash__( self ):
+		return hash( self.offset )
+
+	def __repr__( self ):
+		return '<%s at %i %s>'% ( type( self ).__name__, self.offset,
+			', '.join( '%s=%r'% ( name, value ) for ( name, type_ ), value in zip( self.fields, self.unpack( ) ) ) )
+
+def _write( tree, offset, packer, values ):
+	if getattr( tree, '_journal', 0 ):
+		tree.setB( offset, packer.pack( *values ) )
+	else:
+		packer.pack_into( tree.map, offset, *values )
+
+def _offset( value ):
+	if value is None:
+		return 0
+	if isinstance( value, Record ):
+		return value.offset
+	return value
+
+def record( name, fields, word= allocbuf.word ):
+	''' a subclass of Record for 'fields', a list of ( name, type ), in trees of
+	'word' width '''
+	wordcode= allocbuf.packs[ word ][ 0 ].format
+	codes, targets= [ ], [ ]
+	for fieldname, type_ in fields:
+		if isinstance( type_, type ) and issubclass( type_, Record ) or type_ in ( 'word', 'ref', 'self' ):
+			codes.append( wordcode )
+			targets.append( type_ if type_ not in ( 'word', 'ref' ) else None )
+		else:
+			struct.calcsize( type_ ) #raises for a bad code
+			codes.append( type_ )
+			targets.append( None )
+	align= max( [ struct.calcsize( '@'+ code[ -1 ] ) for code in codes if code[ -1 ]!= 's' ] or [ 1 ] )
+	aligncode= dict( ( struct.calcsize( '@'+ c ), c ) for c in 'BHIQ' )[ align ]
+	format= '@'+ ''.join( codes )+ '0'+ aligncode #pads the end, so records tile
+	offsets= [ struct.calcsize( '@'+ ''.join( codes[ :i+ 1 ] ) )- struct.calcsize( '@'+ codes[ i ] )
+		for i in range( len( codes ) ) ]
+	cls= type( name, ( Record, ), dict( __slots__= ( ), fields= tuple( fields ),
+		offsets= tuple( offsets ), codes= tuple( codes ), struct= struct.Struct( format ),
+		size= struct.calcsize( format ), word= word,
+		refs= tuple( i for i, ( fieldname, type_ ) in enumerate( fields ) if type_== 'ref' or targets[ i ] ) ) )
+	for ( fieldname, type_ ), code, offset, target in zip( fields, codes, offsets, targets ):
+		setattr( cls, fieldname, _field( cls, struct.Struct( '@'+ code ), offset, cls if target== 'self' else target, type_ ) )
+	return cls
+
+def _field( cls, packer, offset, target, type_ ):
+	''' property for a field at 'offset' of 'cls' '''
+	unpack_from= packer.unpack_from
+	def get( self ):
+		return unpack_from( self.tree.map, self.offset+ offset )[ 0 ]
+	def set( self, value ):
+		_write( self.tree, self.offset+ offset, packer, ( value, ) )
+	if target is not None:
+		def get( self ):
+			where= unpack_from( self.tree.map, self.offset+ offset )[ 0 ]
+			return target( self.tree, where ) if where else None
+	if target is not None or type_== 'ref':
+		def set( self, value ):
+			_write( self.tree, self.offset+ offset, packer, ( _offset( value ), ) )
+	return property( get, set )
+
+class RecordArray( object ):
+	''' 'n' records of class 'cls' end to end from 'offset' in 'tree' '''
+	__slots__= ( 'cls', 'tree', 'offset', 'n', '_struct' )
+
+	def __init__( self, cls, tree, offset, n ):
+		self.cls, self.tree, self.offset, self.n= cls, tree, offset, n
+		self._struct= None
+
+	def __len__( self ):
+		return self.n
+
+	def __getitem__( self, i ):
+		if i< 0:
+			i+= self.n
+		if not 0<= i< self.n:
+			raise IndexError( i )
+		return self.cls( self.tree, self.offset+ i* self.cls.size )
+
+	def __iter__( self ):
+		cls, tree, size= self.cls, self.tree, self.cls.size
+		for i in xrange( self.n ):
+			yield cls( tree, self.offset+ i* size )
+
+	def _bulk( self ):
+		''' Struct of the whole array '''
+		if self._struct is None:
+			self._struct= struct.Struct( '@'+ self.cls.struct.format.lstrip( '@' )* self.n )
+		return self._struct
+
+	def unpack_all( self ):
+		''' every record as a tuple, as 'unpack' gives, in one call '''
+		flat= self._bulk( ).unpack_from( self.tree.map, self.offset )
+		width= len( self.cls.fields )
+		return [ flat[ i: i+ width ] for i in xrange( 0, len( flat ), width ) ]
+
+	def pack_all( self, rows ):
+		''' write every record from a sequence of tuples, as 'pack' takes, in one call '''
+		if len( rows )!= self.n:
+			raise ValueError( '%i rows for %i records'% ( len( rows ), self.n ) )
+		flat= [ ]
+		for row in rows:
+			flat.extend( self.cls._raw( row ) )
+		_write( self.tree, self.offset, self._bulk( ), flat )
+
+	def numpy( self ):
+		''' the records as a numpy structured array over the file, sharing its memory.
+		good until the tree is next remapped; writes to it are not journaled. '''
+		if numpy is None:
+			raise ImportError( 'numpy is not installed' )
+		return numpy.frombuffer( self.tree.map, dtype( self.cls ), self.n, self.offset )
+
+def dtype( cls ):
+	''' numpy dtype of a record class '''
+	if numpy is None:
+		raise ImportError( 'numpy is not installed' )
+	formats= [ 'S'+ code[ :-1 ] if code.endswith( 's' ) else '='+ code for code in cls.codes ]
+	return numpy.dtype( dict( names= [ fieldname for fieldname, type_ in cls.fields ], formats= formats,
+		offsets= list( cls.offsets ), itemsize= cls.size ) )
+
+def recordview_test( ):
+	''' fields, references, whole-record and whole-array moves, a reopen, and a
+	rolled back transaction '''
+	mt= allocbuf.FlatMmapAllocTree.create( 'mappedtree.dat', 1<< 16 )
+	mt.enable_journal( 256 )
+	Owner= record( 'Owner', [ ( 'name', '8s' ), ( 'count', 'word' ) ], mt.word )
+	Point= record( 'Point', [ ( 'flag', 'B' ), ( 'x', 'd' ), ( 'y', 'd' ), ( 'next', 'self' ),
+		( 'owner', Owner ), ( 'data', 'ref' ) ], mt.word )
+	assert Point.offsets[ :2 ]== ( 0, struct.calcsize( '@Bd' )- 8 ) and Point.size% 8== 0
+	owner= Owner.new( mt )
+	owner.name= 'alice'
+	first= None
+	with mt.transaction( ):
+		for i in range( 10 ):
+			p= Point.new( mt )
+			p.pack( i% 2, i, i* 2., first, owner, 0 )
+			first= p
+			owner.count+= 1
+		mt.set_root( 'points', first.offset )
+	assert first.unpack( )[ 1:3 ]== ( 9., 18. ) and first.next.x== 8. and first.owner== owner
+	assert first.owner.name.rstrip( '\0' )== 'alice' and owner.count== 10
+	mt.close( )
+	mt= allocbuf.FlatMmapAllocTree.open( 'mappedtree.dat' )
+	p, xs= Point( mt, mt.get_root( 'points' ) ), [ ]
+	while p is not None:
+		xs.append( p.x )
+		p= p.next
+	assert xs== [ float( i ) for i in range( 9, -1, -1 ) ]
+	p= Point( mt, mt.get_root( 'points' ) )
+	try:
+		with mt.transaction( ):
+			p.y= -1.
+			p.next= None
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert p.y== 18. and p.next.x== 8.
+	holes= [ mt.alloc( 100 ) for i in range( 8 ) ] #free nodes with links for 'new' to zero
+	for a in holes[ ::2 ]:
+		mt.free( a )
+	free= mt.list_io( )
+	try:
+		with mt.transaction( ):
+			Point.new( mt )
+			Point.new( mt )
+			Point.newarray( mt, 4 )
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert mt.list_io( )== free
+	mt.check_used( )
+	p.data= p.owner
+	assert p.data== p.owner.offset
+	arr= Point.newarray( mt, 50 )
+	arr.pack_all( [ ( 1, i, -i, None, p.owner, 0 ) for i in range( 50 ) ] )
+	assert arr[ 7 ].x== 7. and arr[ -1 ].y== -49. and arr[ 3 ].owner== p.owner
+	arr[ 7 ].x= 70.
+	rows= arr.unpack_all( )
+	assert len( rows )== 50 and rows[ 7 ][ 1 ]== 70. and rows[ 8 ]== arr[ 8 ].unpack( )
+	assert [ q.x for q in arr ][ :3 ]== [ 0., 1., 2. ]
+	if numpy is not None:
+		np= arr.numpy( )
+		assert np[ 'x' ][ 7 ]== 70.
+		np[ 'y' ][ 0 ]= 5.
+		assert arr[ 0 ].y== 5.
+	mt.check_used( )
+	mt.close( )
+
+def bench( n= 100000, file= 'mappedtree.dat' ):
+	''' reading 'n' records of 4 words: a 'getI' per field, a view per field, a view
+	per record, and the array at once '''
+	import time
+	mt= allocbuf.FlatMmapAllocTree.create( file, 1<< 16 )
+	mt.grow= 'geometric'
+	Row= record( 'Row', [ ( 'a', 'word' ), ( 'b', 'word' ), ( 'c', 'word' ), ( 'd', 'word' ) ], mt.word )
+	arr= Row.newarray( mt, n )
+	arr.pack_all( [ ( i, i, i, i ) for i in range( n ) ] )
+	word, offset= mt.word, arr.offset
+	def getIs( ):
+		getI= mt.getI
+		for i in xrange( n ):
+			where= offset+ i* Row.size
+			getI( where ), getI( where+ word ), getI( where+ 2* word ), getI( where+ 3* word )
+	def fields( ):
+		for row in arr:
+			row.a, row.b, row.c, row.d
+	def records( ):
+		for row in arr:
+			row.unpack( )
+	ways= [ ( 'getI per field', getIs ), ( 'view per field', fields ), ( 'view per record', records ),
+		( 'unpack_all', arr.unpack_all ) ]
+	if numpy is not None:
+		ways.append( ( 'numpy sum', lambda: arr.numpy( )[ 'a' ].sum( ) ) )
+	for name, way in ways:
+		start= time.time( )
+		way( )
+		print '%-16s %10.0f records/sec'% ( name, n/ ( time.time( )- start ) )
+	mt.close( )
+
+if __name__ == '__main__':
+	bench( )